@@ -0,0 +1,66 @@
+'''
+Benchmark of the KD-tree crossmatch against astropy's SkyCoord.match_to_catalog_sky on a crowded field.
+
+usage: python benchmark/bench_crossmatch.py [--ninst 10000] [--nref 50000]
+'''
+import argparse
+import time
+
+import numpy as np
+from astropy.coordinates import SkyCoord
+from astropy import units as u
+
+from longtermphotzp.crossmatch import SkyMatcher
+
+
+def crowdedfield(ninst, nref, ra0=270., dec0=-29., halfwidth=0.33, seed=1):
+    rng = np.random.default_rng(seed)
+    refra = ra0 + rng.uniform(-halfwidth, halfwidth, nref) / np.cos(np.radians(dec0))
+    refdec = dec0 + rng.uniform(-halfwidth, halfwidth, nref)
+    pick = rng.choice(nref, min(ninst, nref), replace=False)
+    instra = refra[pick] + rng.normal(0, 0.3 / 3600, len(pick))
+    instdec = refdec[pick] + rng.normal(0, 0.3 / 3600, len(pick))
+    return instra, instdec, refra, refdec
+
+
+def skycoord_match(instra, instdec, refra, refdec):
+    cInstrument = SkyCoord(ra=instra * u.degree, dec=instdec * u.degree)
+    cReference = SkyCoord(ra=refra * u.degree, dec=refdec * u.degree)
+    idx, d2d, d3d = cReference.match_to_catalog_sky(cInstrument)
+    distance = cReference.separation(cInstrument[idx]).arcsecond
+    return idx, distance
+
+
+def kdtree_match(instra, instdec, refra, refdec, ra0, dec0):
+    return SkyMatcher(instra, instdec, ra0, dec0).match(refra, refdec)
+
+
+def timeit(function, *args, repeat=3):
+    best = np.inf
+    for ii in range(repeat):
+        start = time.perf_counter()
+        result = function(*args)
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark catalog crossmatching')
+    parser.add_argument('--ninst', type=int, default=10000, help='Number of image sources')
+    parser.add_argument('--nref', type=int, default=50000, help='Number of reference catalog stars')
+    args = parser.parse_args()
+
+    instra, instdec, refra, refdec = crowdedfield(args.ninst, args.nref)
+    tsky, (skyidx, skydist) = timeit(skycoord_match, instra, instdec, refra, refdec)
+    tkd, (kdidx, kddist) = timeit(kdtree_match, instra, instdec, refra, refdec, 270., -29.)
+
+    good = skydist < 5
+    print(f"{args.ninst} image sources x {args.nref} reference stars")
+    print(f"SkyCoord.match_to_catalog_sky: {tsky * 1000:8.1f} ms")
+    print(f"SkyMatcher (KD-tree):          {tkd * 1000:8.1f} ms   speedup {tsky / tkd:5.1f}x")
+    print(f"Identical matches within 5\": {np.all(skyidx[good] == kdidx[good])}, "
+          f"max separation difference {np.max(np.abs(skydist - kddist)):.2e} arcsec")
+
+
+if __name__ == '__main__':
+    main()
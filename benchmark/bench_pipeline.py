@@ -0,0 +1,159 @@
+'''
+Offline end-to-end benchmark of the zeropoint pipeline.
+
+Synthetic frames with known zeropoint and color term, and a local refcat2 sqlite stand-in for the catalog service, are
+generated into a scratch directory (see longtermphotzp/syntheticframes.py). The benchmark then times
+
+    analyzeImage        on a single frame, for several star densities, with the in-memory reference catalog field
+                        cache cleared before each repeat (cold) and primed (warm)
+    process_imagelist   on a list of frames, into a fresh sqlite zeropoint database
+    plotlongtermtrend   on a database of synthetic zeropoint measurements of one telescope, for several sizes
+
+and checks the recovered zeropoints and color terms. Timings are compared to the baselines file; a benchmark that is
+slower than tolerance x its baseline is reported as a regression, and the exit code is non-zero.
+
+Baselines depend on the machine; regenerate them on the reference machine with --update-baselines.
+
+usage: python benchmark/bench_pipeline.py [--densities 500 2000 8000] [--nframes 20] [--nrecords 2000 20000]
+                                          [--baselines benchmark/baselines.json] [--update-baselines]
+'''
+import argparse
+import json
+import logging
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+from astropy.table import Table
+
+import longtermphotzp.longtermphotzp as longtermphotzp
+import longtermphotzp.photcalibration as photcal
+from longtermphotzp.photdbinterface import photdbinterface
+from longtermphotzp.syntheticframes import make_synthetic_dataset, add_synthetic_measurements
+
+ZP = 23.0
+COLORTERM = 0.03
+
+
+def timeit(function, *args, repeat=3, setup=None):
+    """ Best time of repeat calls of function(*args); setup() is called untimed before each call. """
+    best = np.inf
+    for ii in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        result = function(*args)
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def bench_analyzeimage(workdir, nstars):
+    directory = os.path.join(workdir, f'analyze{nstars}')
+    os.makedirs(directory, exist_ok=True)
+    filenames, refcat2_url = make_synthetic_dataset(directory, nframes=1, nstars=nstars, zp=ZP, colorterm=COLORTERM)
+    stage = photcal.PhotCalib(refcat2_url)
+    imageentry = Table([filenames, [-1]], names=['filename', 'frameid'])
+    results = {}
+    # cold: the reference catalog is read from the backend every time; warm: the field is served from memory
+    for mode, setup in (('cold', stage.referencecatalog.fields.clear), ('warm', None)):
+        seconds, (photzp, photzpsig, colorterm) = timeit(stage.analyzeImage, imageentry, None, None, 0, setup=setup)
+        ok = (abs(photzp - ZP) < 0.01) and (abs(colorterm - COLORTERM) < 0.01)
+        results[mode] = seconds, ok
+    return results
+
+
+def bench_process_imagelist(workdir, nframes, nstars):
+    directory = os.path.join(workdir, f'imagelist{nframes}')
+    os.makedirs(directory, exist_ok=True)
+    filenames, refcat2_url = make_synthetic_dataset(directory, nframes=nframes, nstars=nstars, zp=ZP,
+                                                    colorterm=COLORTERM)
+    dburl = f'sqlite:///{directory}/photzp.db'
+    args = photcal.parseCommandLine(['--refcat2-url', refcat2_url, '--photodb', dburl, '--mintexp', '0', '--redo',
+                                     '--log-level', 'INFO'])
+    db = photdbinterface(dburl)
+    inputlist = Table([filenames, [-1] * len(filenames)], names=['filename', 'frameid'])
+    start = time.perf_counter()
+    photcal.process_imagelist(inputlist, db, args, rewritetoarchivename=False)
+    seconds = time.perf_counter() - start
+    records = db.readRecords('cpt')
+    db.close()
+    ok = (records is not None) and (len(records) == nframes) and np.all(np.abs(records['zp'] - ZP) < 0.01)
+    return seconds, ok
+
+
+def bench_plotlongtermtrend(workdir, nrecords):
+    directory = os.path.join(workdir, f'trend{nrecords}')
+    os.makedirs(directory, exist_ok=True)
+    dburl = f'sqlite:///{directory}/photzp.db'
+    db = photdbinterface(dburl)
+    add_synthetic_measurements(db, nrecords, site='lsc', dome='domb', telescope='1m0a')
+    context = argparse.Namespace(database=dburl, imagedbPrefix=directory, errorhistogram=False)
+    start = time.perf_counter()
+    filenames = longtermphotzp.plotlongtermtrend('lsc', 'domb-1m0a', 'rp', context, cacheddb=db)
+    seconds = time.perf_counter() - start
+    db.close()
+    return seconds, (filenames is not None) and (len(filenames) > 0)
+
+
+def check_baselines(results, baselines, tolerance):
+    regressions = []
+    print(f"{'benchmark':40s} {'time[s]':>9s} {'baseline':>9s} {'ratio':>6s}  result")
+    for name, (seconds, ok) in results.items():
+        baseline = baselines.get(name)
+        ratio = seconds / baseline if baseline else float('nan')
+        status = 'ok' if ok else 'WRONG RESULT'
+        if baseline and ratio > tolerance:
+            status += ', REGRESSION'
+            regressions.append(name)
+        if not ok:
+            regressions.append(name)
+        print(f"{name:40s} {seconds:9.3f} {baseline or float('nan'):9.3f} {ratio:6.2f}  {status}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Offline benchmark of the zeropoint pipeline')
+    parser.add_argument('--densities', type=int, nargs='+', default=[500, 2000, 8000],
+                        help='Number of stars per frame for the analyzeImage benchmark')
+    parser.add_argument('--nframes', type=int, default=20, help='Number of frames for the process_imagelist benchmark')
+    parser.add_argument('--nrecords', type=int, nargs='+', default=[2000, 20000],
+                        help='Number of zeropoint measurements for the plotlongtermtrend benchmark')
+    parser.add_argument('--baselines', default=os.path.join(os.path.dirname(__file__), 'baselines.json'),
+                        help='JSON file with baseline timings [s]')
+    parser.add_argument('--update-baselines', action='store_true', help='Write the measured timings as new baselines')
+    parser.add_argument('--tolerance', type=float, default=1.5,
+                        help='Report a regression if a benchmark is slower than tolerance x its baseline')
+    parser.add_argument('--workdir', default=None, help='Scratch directory, a temporary directory by default')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+
+    with tempfile.TemporaryDirectory(dir=args.workdir) as workdir:
+        results = {}
+        for nstars in args.densities:
+            for mode, result in bench_analyzeimage(workdir, nstars).items():
+                results[f'analyzeImage[nstars={nstars},{mode}]'] = result
+        results[f'process_imagelist[nframes={args.nframes}]'] = bench_process_imagelist(workdir, args.nframes, 1000)
+        for nrecords in args.nrecords:
+            results[f'plotlongtermtrend[nrecords={nrecords}]'] = bench_plotlongtermtrend(workdir, nrecords)
+
+    baselines = {}
+    if os.path.exists(args.baselines):
+        with open(args.baselines) as f:
+            baselines = json.load(f)
+    regressions = check_baselines(results, baselines, args.tolerance)
+
+    if args.update_baselines:
+        baselines.update({name: round(seconds, 4) for name, (seconds, ok) in results.items()})
+        with open(args.baselines, 'w') as f:
+            json.dump(baselines, f, indent=2, sort_keys=True)
+            f.write('\n')
+        print(f"Baselines written to {args.baselines}")
+        return 0
+
+    return 1 if len(regressions) > 0 else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -18,18 +18,7 @@ photcalibration --useaws --photodb $DATABASE --refcat2-url $REFCAT2_URL --mintex
 photcalibration --useaws --photodb $DATABASE --refcat2-url $REFCAT2_URL --mintexp 10 --lastNdays $NDAYS --cameratype ep
 photcalibration --useaws --photodb $DATABASE --refcat2-url $REFCAT2_URL --mintexp 10 --lastNdays $NDAYS --cameratype sq
 
-longtermphotzp --database $DATABASE --outputdirectory /database --filter up
-longtermphotzp --database $DATABASE --outputdirectory /database --filter gp
-longtermphotzp --database $DATABASE --outputdirectory /database --filter rp
-longtermphotzp --database $DATABASE --outputdirectory /database --filter ip
-longtermphotzp --database $DATABASE --outputdirectory /database --filter zp
-longtermphotzp --database $DATABASE --outputdirectory /database --filter Y
-
-longtermphotzp --database $DATABASE --outputdirectory /database --filter U
-longtermphotzp --database $DATABASE --outputdirectory /database --filter B
-longtermphotzp --database $DATABASE --outputdirectory /database --filter V
-longtermphotzp --database $DATABASE --outputdirectory /database --filter R
-longtermphotzp --database $DATABASE --outputdirectory /database --filter I
+longtermphotzp --database $DATABASE --outputdirectory /database --filters up gp rp ip zp Y U B V R I
 
 # Exit successfully. None of the above commands take success/failure into
 # account, so we don't care here either...
@@ -1,8 +1,8 @@
+import collections
 import math
 import os
 
 import numpy
-import requests
 
 import numpy as np
 from astropy.table import Table
@@ -10,6 +10,9 @@ from astroquery.sdss import SDSS
 from astropy import coordinates as coords
 import logging
 import sys
+
+from longtermphotzp.refcat2backends import make_backend
+from longtermphotzp.refcat2cache import TiledCatalogCache
 _logger = logging.getLogger(__name__)
 
 class atlas_refcat2:
@@ -52,10 +55,38 @@ class atlas_refcat2:
     ps1colorterms['imag'] = [+0.01170, -0.00400, +0.00066, -0.00058][::-1]
     ps1colorterms['zmag'] = [-0.01062, +0.07529, -0.03592, +0.00890][::-1]
 
+    # PS1 band a SDSS band is derived from, and its error column
+    ps1baseband = {'umag': 'gmag', 'gmag': 'gmag', 'rmag': 'rmag', 'imag': 'imag', 'zmag': 'zmag', 'ymag': 'zmag'}
+
     JohnsonCousin_filters = ['B', 'V', 'R', 'I', 'U']
 
-    def __init__(self, refcat2_url):
+    # Based on Jordi, Grebel, & Ammon 2005  http://www.sdss3.org/dr8/algorithms/sdssUBVRITransform.php
+    # 0 -> sdss base mag
+    # 1,2 -> sdss color to use
+    # 3 -> color term
+    # 4 -> zero point
+    johnsonterms = {}
+    johnsonterms['B'] = ['gmag', 'gmag', 'rmag',  0.313,  0.219]
+    johnsonterms['V'] = ['gmag', 'gmag', 'rmag', -0.565, -0.016]
+    johnsonterms['R'] = ['rmag', 'rmag', 'imag', -0.153, -0.117]
+    johnsonterms['I'] = ['imag', 'imag', 'zmag', -0.386, -0.397]
+    johnsonterms['U'] = ['B'   , 'umag', 'gmag', +0.79,  -0.93]
+
+    def __init__(self, refcat2_url, cachedir=None, cachesize=2 * 1024 ** 3, fieldcachesize=8):
+        """
+        :param refcat2_url: URL of the refcat2 catalog service, or sqlite:///path of a local refcat2 database.
+                            See refcat2backends for the supported backends.
+        :param cachedir: if not None, directory of a persistent tiled cache of catalog rows, see refcat2cache.
+        :param cachesize: size limit of the cache in bytes
+        :param fieldcachesize: number of recently used fields kept in memory for band selective queries
+        """
         self.refcat2_url = refcat2_url
+        self.backend = make_backend(refcat2_url)
+        self.cache = None
+        if cachedir is not None:
+            self.cache = TiledCatalogCache(cachedir, self.backend.query, maxbytes=cachesize)
+        self.fieldcachesize = fieldcachesize
+        self.fields = collections.OrderedDict()
 
     def isInCatalogFootprint(self, ra, dec):
         return True
@@ -64,17 +95,7 @@ class atlas_refcat2:
         """ Based on Jordi, Grebel, & Ammon 2005  http://www.sdss3.org/dr8/algorithms/sdssUBVRITransform.php
         """
 
-        transformations={}
-        # 0 -> sdss base mag
-        # 1,2 -> sdss color to use
-        # 3 -> color term
-        # 4 -> zero point
-        transformations['B'] = ['gmag', 'gmag', 'rmag',  0.313,  0.219]
-        transformations['V'] = ['gmag', 'gmag', 'rmag', -0.565, -0.016]
-        transformations['R'] = ['rmag', 'rmag', 'imag', -0.153, -0.117]
-        transformations['I'] = ['imag', 'imag', 'zmag', -0.386, -0.397]
-        transformations['U'] = ['B'   , 'umag', 'gmag', +0.79,  -0.93]
-
+        transformations = self.johnsonterms
         for filter in transformations:
             transformation = transformations[filter]
             table.add_column(numpy.nan, name=filter)
@@ -111,17 +132,89 @@ class atlas_refcat2:
 
         return table
 
-    def get_reference_catalog(self, ra, dec, radius, generateJohnson = False):
-        " Read region of interest from the catalog"
+    def transformed_band(self, field, band):
+        """ Compute a single SDSS or Johnson-Cousins band of a field from the PS1 magnitudes.
+
+        Only the band and the bands it depends on are computed, each at most once per field.
+
+        :param field: dictionary of float32 arrays. Holds the PS1 catalog columns, and collects the transformed bands
+                      as 'ref:<band>' entries.
+        :param band: SDSS name (umag, gmag, ..) or Johnson-Cousins name (U, B, ..) of the band
+        :return: magnitude and magnitude error arrays
+        """
+        key = f'ref:{band}'
+        if key not in field:
+            if band in self.ps1baseband:
+                if 'pscolor' not in field:
+                    field['pscolor'] = field['gmag'] - field['imag']
+                c = field['pscolor']
+                p = np.asarray(self.ps1colorterms[band], dtype=np.float32)
+                base = self.ps1baseband[band]
+                field[key] = (field[base] - (((p[0] * c + p[1]) * c + p[2]) * c + p[3]), field[f'{base}err'])
+            elif band in self.johnsonterms:
+                base, color1, color2, colorterm, zeropoint = self.johnsonterms[band]
+                basemag = self.transformed_band(field, base)[0]
+                mag1 = self.transformed_band(field, color1)[0]
+                mag2 = self.transformed_band(field, color2)[0]
+                mag = basemag + (mag1 - mag2) * np.float32(colorterm) + np.float32(zeropoint)
+                field[key] = (mag, np.zeros_like(mag))
+            else:
+                raise KeyError(f"Unknown reference band {band}")
+        return field[key]
+
+    def query_field(self, ra, dec, radius):
+        """ PS1 catalog columns of a field as float32 arrays, or None. Recently used fields are kept in memory. """
+        key = (round(ra, 4), round(dec, 4), radius)
+        if key in self.fields:
+            self.fields.move_to_end(key)
+            return self.fields[key]
         try:
-            response = requests.get(self.refcat2_url + 'radius', params={'ra': ra, 'dec': dec, 'radius': radius})
-            response.raise_for_status()
+            if self.cache is not None:
+                table = self.cache.query(ra, dec, radius)
+            else:
+                table = self.backend.query(ra, dec, radius)
+        except Exception as e:
+            _logger.exception(f"While trying to read from refcat2: {e}")
+            return None
+        if table is None:
+            return None
+        field = {name: np.asarray(table[name], dtype=np.float32) for name in table.colnames}
+        self.fields[key] = field
+        while len(self.fields) > self.fieldcachesize:
+            self.fields.popitem(last=False)
+        return field
+
+    def get_reference_catalog(self, ra, dec, radius, generateJohnson = False, bands=None):
+        """ Read region of interest from the catalog
+
+        :param bands: if given, list of reference bands (e.g., ['rmag'] or ['V']) to compute. The returned table then
+                      only has the ra, dec, SDSS gmag and imag columns for the g-i color, and the requested bands
+                      with their errors. Otherwise, all bands are transformed and generateJohnson selects if the
+                      Johnson-Cousins bands are added.
+        """
+        if bands is not None:
+            field = self.query_field(ra, dec, radius)
+            if field is None:
+                return None
+            columns = {'ra': field['ra'], 'dec': field['dec']}
+            try:
+                for band in ['gmag', 'imag'] + list(bands):
+                    columns[band], columns[f'{band}err'] = self.transformed_band(field, band)
+            except Exception as e:
+                _logger.exception(f"problem with filter correction in filter {band}: {e}")
+                return None
+            return Table(columns, copy=False)
 
-            dtype=[np.float32] * 12
-            table = Table(response.json(), dtype=dtype)
+        try:
+            if self.cache is not None:
+                table = self.cache.query(ra, dec, radius)
+            else:
+                table = self.backend.query(ra, dec, radius)
         except Exception as e:
             _logger.exception(f"While trying to read from refcat2: {e}")
             return None
+        if table is None:
+            return None
 
         table = self.PStoSDSS(table)
 
@@ -0,0 +1,115 @@
+"""
+Positional cross-matching of an image source catalog against a reference catalog.
+
+Both catalogs are projected onto the tangent plane about the field centre (gnomonic projection), and nearest
+neighbours are found with a KD-tree. For the small fields of view of LCO imagers the projection is close to
+distance-preserving, and the separations of the matched pairs are evaluated exactly on the sphere.
+"""
+import logging
+
+import numpy as np
+from scipy.spatial import cKDTree
+
+_logger = logging.getLogger(__name__)
+
+
+def gnomonic_projection(ra, dec, ra0, dec0):
+    """ Project sky coordinates onto the tangent plane about (ra0, dec0).
+
+    :param ra: right ascension [deg]
+    :param dec: declination [deg]
+    :param ra0: right ascension of the tangent point [deg]
+    :param dec0: declination of the tangent point [deg]
+    :return: standard coordinates xi, eta [deg]
+    """
+    ra = np.radians(np.asarray(ra, dtype=float))
+    dec = np.radians(np.asarray(dec, dtype=float))
+    ra0 = np.radians(ra0)
+    dec0 = np.radians(dec0)
+
+    cosdec = np.cos(dec)
+    cosdra = np.cos(ra - ra0)
+    cosc = np.sin(dec0) * np.sin(dec) + np.cos(dec0) * cosdec * cosdra
+    xi = cosdec * np.sin(ra - ra0) / cosc
+    eta = (np.cos(dec0) * np.sin(dec) - np.sin(dec0) * cosdec * cosdra) / cosc
+    return np.degrees(xi), np.degrees(eta)
+
+
+def angular_separation(ra1, dec1, ra2, dec2):
+    """ Great circle distance between two sets of positions, Vincenty formula as used by astropy.
+
+    All angles in degrees.
+    """
+    ra1 = np.radians(np.asarray(ra1, dtype=float))
+    dec1 = np.radians(np.asarray(dec1, dtype=float))
+    ra2 = np.radians(np.asarray(ra2, dtype=float))
+    dec2 = np.radians(np.asarray(dec2, dtype=float))
+
+    sdra = np.sin(ra2 - ra1)
+    cdra = np.cos(ra2 - ra1)
+    sdec1 = np.sin(dec1)
+    cdec1 = np.cos(dec1)
+    sdec2 = np.sin(dec2)
+    cdec2 = np.cos(dec2)
+
+    num1 = cdec2 * sdra
+    num2 = cdec1 * sdec2 - sdec1 * cdec2 * cdra
+    denominator = sdec1 * sdec2 + cdec1 * cdec2 * cdra
+    return np.degrees(np.arctan2(np.hypot(num1, num2), denominator))
+
+
+class SkyMatcher:
+    """ Nearest neighbour lookup into a fixed catalog of sky positions.
+
+    The KD-tree is built once and can be queried repeatedly.
+    """
+
+    def __init__(self, ra, dec, ra0, dec0):
+        """
+        :param ra: right ascension of the catalog to match against [deg]
+        :param dec: declination of the catalog to match against [deg]
+        :param ra0: right ascension of the field centre, used as tangent point [deg]
+        :param dec0: declination of the field centre, used as tangent point [deg]
+        """
+        self.ra = np.asarray(ra, dtype=float)
+        self.dec = np.asarray(dec, dtype=float)
+        self.ra0 = ra0
+        self.dec0 = dec0
+        xi, eta = gnomonic_projection(self.ra, self.dec, ra0, dec0)
+        self.tree = cKDTree(np.column_stack((xi, eta)))
+
+    def __len__(self):
+        return len(self.ra)
+
+    def match(self, ra, dec, mutual=False):
+        """ For each input position, find the nearest source in the catalog.
+
+        :param ra: right ascension of the positions to match [deg]
+        :param dec: declination of the positions to match [deg]
+        :param mutual: if True, only keep pairs where the input position is also the nearest neighbour of the
+                       catalog source. The separation of all other pairs is set to infinity.
+        :return: idx, separation: index into the catalog and separation of the pair [arcsec]
+        """
+        if len(self) == 0:
+            raise ValueError("Cannot match against an empty catalog")
+
+        ra = np.asarray(ra, dtype=float)
+        dec = np.asarray(dec, dtype=float)
+        xi, eta = gnomonic_projection(ra, dec, self.ra0, self.dec0)
+        points = np.column_stack((xi, eta))
+        _, idx = self.tree.query(points, k=1)
+
+        separation = angular_separation(ra, dec, self.ra[idx], self.dec[idx]) * 3600.
+
+        if mutual:
+            _, backidx = cKDTree(points).query(self.tree.data, k=1)
+            ismutual = backidx[idx] == np.arange(len(idx))
+            separation[~ismutual] = np.inf
+            _logger.debug(f"Mutual nearest neighbour filter kept {np.sum(ismutual)} of {len(idx)} pairs")
+
+        return idx, separation
+
+
+def match_to_catalog(ra, dec, catalogra, catalogdec, ra0, dec0, mutual=False):
+    """ One-off convenience wrapper around SkyMatcher.match, see there. """
+    return SkyMatcher(catalogra, catalogdec, ra0, dec0).match(ra, dec, mutual=mutual)
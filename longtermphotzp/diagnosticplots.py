@@ -0,0 +1,197 @@
+'''
+Diagnostic plots of the photometric zeropoint fit of an image.
+
+The fit emits a compact plot payload (see make_payload), a dictionary of plain values and float32 arrays. The payload
+is rendered either inline, or out of band by a DiagnosticPlotRenderer, a pool of processes that draw with the object
+oriented matplotlib Figure API into a figure that is reused between plots.
+
+Plot types:
+    zp          zeropoint vs reference magnitude
+    color       zeropoint vs reference color, with the color term fit
+    residuals   fit residuals vs x, y, and radial position on the detector
+    peak        peak pixel value vs reference magnitude
+    counts      total source counts vs reference magnitude
+'''
+import collections
+import concurrent.futures
+import logging
+import threading
+
+import matplotlib
+import matplotlib.style
+import numpy as np
+from matplotlib.figure import Figure
+
+_logger = logging.getLogger(__name__)
+
+PLOTTYPES = ('zp', 'color', 'residuals', 'peak', 'counts')
+DEFAULT_PLOTTYPES = ('zp', 'color', 'residuals')
+
+_figures = threading.local()
+
+
+def make_payload(retCatalog, magZP, cond, photzp, colorterm, outputdir, outbasename, plottypes=DEFAULT_PLOTTYPES):
+    """ Collect what is needed to draw the diagnostic plots of an image.
+
+    :param retCatalog: matched catalog as returned by PhotCalib.generateCrossmatchedCatalog
+    :param magZP: per star zeropoints
+    :param cond: boolean array of stars used in the fit
+    """
+    arrays = {'refmag': retCatalog['refmag'], 'refcol': retCatalog['refcol'], 'magZP': magZP}
+    if 'peak' in plottypes:
+        arrays['peak'] = retCatalog['peak']
+    if 'counts' in plottypes:
+        arrays['instflux'] = retCatalog['instflux']
+    if 'residuals' in plottypes:
+        arrays['x'] = retCatalog['x']
+        arrays['y'] = retCatalog['y']
+    payload = {name: np.asarray(value, dtype=np.float32) for name, value in arrays.items()}
+    payload.update({'cond': np.asarray(cond, dtype=bool), 'photzp': float(photzp), 'colorterm': float(colorterm),
+                    'instfilter': retCatalog['instfilter'], 'reffilter': retCatalog['reffilter'],
+                    'exptime': float(retCatalog['exptime']), 'saturate': retCatalog['saturate'],
+                    'outputdir': outputdir, 'outbasename': outbasename, 'plottypes': tuple(plottypes)})
+    return payload
+
+
+def get_figure():
+    """ The figure of this thread, cleared for the next plot. """
+    if getattr(_figures, 'figure', None) is None:
+        _figures.figure = Figure()
+    _figures.figure.clear()
+    return _figures.figure
+
+
+def plot_zp(fig, p):
+    cond = p['cond']
+    corrected = p['magZP'] - (p['colorterm'] * p['refcol'] + p['photzp']) + p['photzp']
+    ax = fig.add_subplot()
+    ax.plot(p['refmag'][~cond], corrected[~cond], 'x', color='grey')
+    ax.plot(p['refmag'][cond], corrected[cond], '.', color='red')
+    ax.set_xlim([10, 22])
+    ax.set_ylim([p['photzp'] - 0.5, p['photzp'] + 0.5])
+    ax.axhline(y=p['photzp'], color='r', linestyle='-')
+    ax.set_xlabel("Reference catalog mag")
+    ax.set_ylabel("Reference Mag - Instrumental Mag (%s)" % (p['instfilter']))
+    ax.set_title("Photometric zeropoint %s %5.2f" % (p['outbasename'], p['photzp']))
+    return "%s/%s_%s_zp.png" % (p['outputdir'], p['outbasename'], p['instfilter'])
+
+
+def plot_peak(fig, p):
+    cond = p['cond']
+    ax = fig.add_subplot()
+    ax.plot(p['refmag'][cond], p['peak'][cond], '.', color='black')
+    ax.set_xlim([10, 20])
+    ax.set_ylim([0, p['saturate']])
+    ax.set_xlabel(f"Reference magnitude {p['reffilter']}")
+    ax.set_ylabel("Peak above background level [e-] (%s)" % (p['instfilter']))
+    ax.set_title(f"Peak {p['outbasename']}, texp = {p['exptime']:6.2f} ")
+    return "%s/%s_%s_refmag_peak.png" % (p['outputdir'], p['outbasename'], p['instfilter'])
+
+
+def plot_counts(fig, p):
+    cond = p['cond']
+    ax = fig.add_subplot()
+    ax.plot(p['refmag'][cond], p['instflux'][cond], '.', color='black')
+    ax.ticklabel_format(useOffset=False, style='plain')
+    ax.set_xlim([5, 20])
+    ax.set_xlabel(f"Reference magnitude {p['reffilter']}")
+    ax.set_ylabel("Total counts from object  [e-] (%s)" % (p['instfilter']))
+    ax.set_title(f"Total Counts {p['outbasename']}, texp = {p['exptime']:6.2f} ")
+    return "%s/%s_%s_refmag_counts.png" % (p['outputdir'], p['outbasename'], p['instfilter'])
+
+
+def plot_color(fig, p):
+    cond = p['cond']
+    ax = fig.add_subplot()
+    ax.plot(p['refcol'][~cond], p['magZP'][~cond], 'x', color='grey')
+    ax.plot(p['refcol'][cond], p['magZP'][cond], '.', color='red')
+    ax.axhline(y=p['photzp'], color='grey', linestyle='-', label=f"zeropoint {p['photzp']:5.2f}")
+    xp = np.linspace(-0.5, 3.5, 10)
+    ax.plot(xp, p['colorterm'] * xp + p['photzp'], '--', color='blue', label=f"color term {p['colorterm']:5.3f}")
+    ax.legend()
+    ax.set_xlim([-0.5, 3.0])
+    ax.set_ylim([p['photzp'] - 0.75, p['photzp'] + 0.75])
+    ax.set_xlabel("(g-i)$_{\\rm{SDSS}}$ Reference")
+    ax.set_ylabel("Reference Mag - Instrumental Mag  %s" % (p['instfilter']))
+    ax.set_title(f"Color correction {p['outbasename']}")
+    return f"{p['outputdir']}/{p['outbasename']}_{p['instfilter']}_color.png"
+
+
+def plot_residuals(fig, p):
+    cond = p['cond']
+    residual = p['magZP'][cond] - (p['colorterm'] * p['refcol'][cond] + p['photzp'])
+    x = p['x'][cond]
+    y = p['y'][cond]
+
+    ax = fig.add_subplot(3, 1, 1)
+    ax.plot(x, residual, '.')
+    ax.set_ylim([-0.2, 0.2])
+    ax.set_ylabel("\nCCD X")
+    ax.set_title("Residuals of zero point %s " % (p['outbasename']))
+
+    ax = fig.add_subplot(3, 1, 2)
+    ax.plot(y, residual, '.')
+    ax.set_ylim([-0.2, 0.2])
+    ax.set_xlabel("y coordinate [pixel]")
+    ax.set_ylabel(f'residual in {p["instfilter"]}[mag]\nCCD-Y')
+
+    ax = fig.add_subplot(3, 1, 3)
+    ax.plot(np.sqrt((x - 1024) ** 2 + (y - 1024) ** 2), residual, '.')
+    ax.set_ylim([-0.2, 0.2])
+    ax.set_xlabel("coordinate [pixel]")
+    ax.set_ylabel(f'\nradial')
+    return "%s/%s_%s_residuals.png" % (p['outputdir'], p['outbasename'], p['instfilter'])
+
+
+PLOTTERS = {'zp': plot_zp, 'color': plot_color, 'residuals': plot_residuals, 'peak': plot_peak,
+            'counts': plot_counts}
+
+
+def render(payload):
+    """ Draw and save the requested plots of a payload. Returns the list of files written. """
+    written = []
+    with matplotlib.style.context('ggplot'):
+        for plottype in payload['plottypes']:
+            fig = get_figure()
+            try:
+                filename = PLOTTERS[plottype](fig, payload)
+                fig.savefig(filename, bbox_inches='tight')
+                written.append(filename)
+            except Exception:
+                _logger.exception(f"Could not render {plottype} plot for {payload['outbasename']}")
+    return written
+
+
+class DiagnosticPlotRenderer:
+    ''' Pool of processes that render plot payloads in the background.
+
+    At most 2 * workers payloads are queued at any time, so a slow renderer throttles the producer instead of
+    accumulating payloads in memory.
+    '''
+
+    def __init__(self, workers=1):
+        self.maxpending = 2 * workers
+        self.executor = concurrent.futures.ProcessPoolExecutor(max_workers=workers)
+        self.pending = collections.deque()
+
+    def submit(self, payload):
+        while len(self.pending) >= self.maxpending:
+            self.wait(self.pending.popleft())
+        self.pending.append(self.executor.submit(render, payload))
+
+    def wait(self, future):
+        try:
+            future.result()
+        except Exception:
+            _logger.exception("Diagnostic plot rendering failed")
+
+    def close(self):
+        while self.pending:
+            self.wait(self.pending.popleft())
+        self.executor.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
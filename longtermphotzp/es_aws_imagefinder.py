@@ -1,20 +1,36 @@
+import collections
+import concurrent.futures
 import logging
 from opensearchpy import OpenSearch
-from opensearch_dsl import Search
+from opensearch_dsl import Search, Q
 from astropy.table import Table
 import numpy as np
-import requests
 from astropy.io import fits
 import io
 import os
 
+from longtermphotzp.fitsframes import read_extensions
+from longtermphotzp.httpsession import get_session
+
 _logger = logging.getLogger(__name__)
 
 ARCHIVE_API_TOKEN = os.getenv('ARCHIVE_API_TOKEN', '')
 
+# Header fields returned by the photometry frame queries; everything else in the documents is not transferred.
+PHOTOMETRY_SOURCE_FIELDS = ['filename', 'frameid', 'DAY-OBS', 'SITEID', 'INSTRUME']
+
+_opensearch_clients = {}
+
+
+def get_opensearch_client(os_url):
+    """ OpenSearch client of this process for os_url, created on first use and reused for all queries. """
+    if os_url not in _opensearch_clients:
+        _opensearch_clients[os_url] = OpenSearch(os_url)
+    return _opensearch_clients[os_url]
+
 
 def make_opensearch(index, filters, queries=None, exclusion_filters=None, range_filters=None, prefix_filters=None,
-                    terms_filters=None,
+                    terms_filters=None, prefix_any_filters=None, source=None,
                     os_url='https://opensearch.lco.global'):
     """
     Make an ElasticSearch query
@@ -34,6 +50,10 @@ def make_opensearch(index, filters, queries=None, exclusion_filters=None, range_
                    Each dict has a criterion an OpenSearch "range filter"
     prefix_filters:
     terms_filters:
+    prefix_any_filters: list of dicts
+                   Each dict has a criterion for an OpenSearch "prefix" filter; at least one of them has to match
+    source: list of str
+            Fields to return of each document. All fields if None.
     os_url : str
              URL of the OpenSearch host
 
@@ -52,8 +72,9 @@ def make_opensearch(index, filters, queries=None, exclusion_filters=None, range_
         terms_filters = []
     if prefix_filters is None:
         prefix_filters = []
-    opensearch = OpenSearch(os_url)
-    s = Search(using=opensearch, index=index)
+    if prefix_any_filters is None:
+        prefix_any_filters = []
+    s = Search(using=get_opensearch_client(os_url), index=index)
     for f in filters:
         s = s.filter('term', **f)
     for f in terms_filters:
@@ -62,10 +83,14 @@ def make_opensearch(index, filters, queries=None, exclusion_filters=None, range_
         s = s.filter('range', **f)
     for f in prefix_filters:
         s = s.filter('prefix', **f)
+    if len(prefix_any_filters) > 0:
+        s = s.filter('bool', should=[Q('prefix', **f) for f in prefix_any_filters], minimum_should_match=1)
     for f in exclusion_filters:
         s = s.exclude('term', **f)
     for q in queries:
         s = s.query(q['type'], **q['query'])
+    if source is not None:
+        s = s.source(source)
     return s
 
 
@@ -104,16 +129,183 @@ def get_frames_for_photometry(dayobs, site=None, cameratype=None, camera=None, m
     return records_sanitized
 
 
-def download_from_archive(frameid):
+def photometry_search(daystart, dayend, sites=None, cameratypes=None, camera=None, mintexp=30,
+                      filterlist=['gp', 'rp', 'ip', 'zp', 'zs', 'B', 'V', 'R', 'I'],
+                      os_url='https://opensearch.lco.global'):
+    """ Query for the processed images viable for a photometric zeropoint over a range of DAY-OBS, for a set of
+        sites and camera types, or for a specific camera. Only the fields in PHOTOMETRY_SOURCE_FIELDS are returned.
+
+        daystart, dayend: first and last DAY-OBS, YYYYMMDD
+     """
+    query_filters = [{'RLEVEL': 91}, {'WCSERR': 0}, {"OBSTYPE": "EXPOSE"}, {'FOCOBOFF': 0}]
+    range_filters = [{'EXPTIME': {'gte': mintexp}}, {'DAY-OBS': {'gte': daystart, 'lte': dayend}}]
+    terms_filters = [{'FILTER': list(filterlist)}]
+    prefix_any_filters = []
+
+    if sites is not None:
+        terms_filters.append({'SITEID': list(sites)})
+    if camera is not None:
+        query_filters.append({'INSTRUME': camera})
+    if cameratypes is not None:
+        prefix_any_filters = [{'INSTRUME': cameratype} for cameratype in cameratypes]
+
+    return make_opensearch('lco-fitsheaders', query_filters, exclusion_filters=None, os_url=os_url,
+                           range_filters=range_filters, terms_filters=terms_filters,
+                           prefix_any_filters=prefix_any_filters, source=PHOTOMETRY_SOURCE_FIELDS)
+
+
+def iter_frames_for_photometry(daystart, dayend, sites=None, cameratypes=None, camera=None, mintexp=30,
+                               filterlist=['gp', 'rp', 'ip', 'zp', 'zs', 'B', 'V', 'R', 'I'],
+                               os_url='https://opensearch.lco.global'):
+    """ Stream the frames of photometry_search as the scroll returns them.
+
+        :return: generator of dicts with 'filename', 'frameid', 'dayobs' (YYYYMMDD), 'site', 'camera'
+     """
+    records = photometry_search(daystart, dayend, sites=sites, cameratypes=cameratypes, camera=camera,
+                                mintexp=mintexp, filterlist=filterlist, os_url=os_url).scan()
+    for record in records:
+        yield {'filename': record['filename'], 'frameid': record['frameid'],
+               'dayobs': str(record['DAY-OBS']).replace('-', '')[:8], 'site': record['SITEID'],
+               'camera': record['INSTRUME']}
+
+
+def get_frames_for_photometry_daterange(daystart, dayend, sites=None, cameratypes=None, camera=None, mintexp=30,
+                                        filterlist=['gp', 'rp', 'ip', 'zp', 'zs', 'B', 'V', 'R', 'I'],
+                                        os_url='https://opensearch.lco.global'):
+    """ Like get_frames_for_photometry, but for all nights from daystart to dayend, and all given sites and camera
+        types, in a single query streamed back in one scroll.
+
+        :return: Table of 'filename', 'frameid', 'dayobs' (YYYYMMDD), 'site', 'camera', or None if nothing was found.
+     """
+    columns = ['filename', 'frameid', 'dayobs', 'site', 'camera']
+    rows = [[frame[column] for column in columns] for frame in
+            iter_frames_for_photometry(daystart, dayend, sites=sites, cameratypes=cameratypes, camera=camera,
+                                       mintexp=mintexp, filterlist=filterlist, os_url=os_url)]
+    if len(rows) == 0:
+        return None
+    _logger.info(f"Found {len(rows)} frames for DAY-OBS {daystart} to {dayend}")
+    return Table(np.asarray(rows), names=columns)
+
+
+def group_frames(frames, keys=('dayobs',)):
+    """ Split a frame table locally into groups by the values of the key columns, in sorted order.
+
+    :return: iterator over (tuple of key values, table of the frames of the group)
+    """
+    grouped = frames.group_by(list(keys))
+    for key, group in zip(grouped.groups.keys, grouped.groups):
+        yield tuple(key), group
+
+
+class RangeRequestsNotSupported(Exception):
+    pass
+
+
+class HTTPRangeFile:
+    """
+    Read-only, seekable file object on top of a remote file, where each read is served by a HTTP Range request.
+
+    Reads are rounded up to readahead bytes, so that consecutive small reads (e.g., FITS header blocks) are served
+    from one request. Seeking is free, so skipped parts of the file are never transferred.
+    """
+
+    def __init__(self, url, readahead=64 * 2880):
+        self.url = url
+        self.readahead = readahead
+        self.position = 0
+        self.buffer = b''
+        self.bufferstart = 0
+        self.nrequests = 0
+        self.nbytes = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            self.position = offset
+        elif whence == io.SEEK_CUR:
+            self.position += offset
+        else:
+            raise ValueError("Seeking relative to the end of a remote file is not supported")
+        return self.position
+
+    def fetch(self, start, length):
+        """ Fetch bytes [start, start+length) from the remote file. Returns b'' beyond the end of the file. """
+        headers = {'Range': f'bytes={start}-{start + length - 1}'}
+        with get_session().get(self.url, headers=headers, stream=True) as response:
+            if response.status_code == 416:
+                return b''
+            response.raise_for_status()
+            if response.status_code != 206:
+                raise RangeRequestsNotSupported(f"Server answered range request with status {response.status_code}")
+            data = response.content
+        self.nrequests += 1
+        self.nbytes += len(data)
+        return data
+
+    def read(self, size):
+        offset = self.position - self.bufferstart
+        if (offset < 0) or (offset + size > len(self.buffer)):
+            # Not in the buffer; keep what overlaps and fetch the rest.
+            if (0 <= offset < len(self.buffer)):
+                head = self.buffer[offset:]
+            else:
+                head = b''
+            missing = size - len(head)
+            self.buffer = head + self.fetch(self.position + len(head), max(missing, self.readahead))
+            self.bufferstart = self.position
+            offset = 0
+        data = self.buffer[offset:offset + size]
+        self.position += len(data)
+        return data
+
+
+def fetch_extensions(url, extensions=('SCI', 'CAT'), partial=True):
+    """
+    Fetch selected extensions of a remote FITS file, see fitsframes.read_extensions.
+
+    param partial: if True, use HTTP Range requests to transfer only the headers and the data of the wanted
+                   extensions. Falls back to streaming the whole file if the server does not honour range requests.
+    return: Astropy HDUList
+    """
+    if partial:
+        try:
+            rangefile = HTTPRangeFile(url)
+            hdulist = read_extensions(rangefile, extensions=extensions)
+            hdulist.downloaded_bytes = rangefile.nbytes
+            _logger.debug(f"Partial download: {rangefile.nbytes} bytes in {rangefile.nrequests} range requests")
+            return hdulist
+        except RangeRequestsNotSupported as e:
+            _logger.info(f"{e}. Falling back to full download.")
+
+    with get_session().get(url, stream=True) as file_response:
+        file_response.raise_for_status()
+        file_response.raw.decode_content = True
+        hdulist = read_extensions(file_response.raw, extensions=extensions)
+        hdulist.downloaded_bytes = file_response.raw.tell()
+        return hdulist
+
+
+def download_from_archive(frameid, extensions=None, partial=False):
     """
     Download a file from the LCO archive by frame id.
     param frameid: Archive API frame ID
+    param extensions: if not None, only keep the header of the SCI extension and the data of the other listed
+                      extensions. The file is then streamed, and never held in memory in full.
+    param partial: together with extensions, only transfer the needed parts of the file via HTTP range requests.
     return: Astropy HDUList
     """
     url = f'https://archive-api.lco.global/frames/{frameid}'
     _logger.info("Downloading image frameid {} from URL: {}".format(frameid, url))
     headers = {'Authorization': 'Token {}'.format(ARCHIVE_API_TOKEN)}
-    response = requests.get(url, headers=headers)
+    response = get_session().get(url, headers=headers)
     response.raise_for_status()
     response_dict = response.json()
     if response_dict == {}:
@@ -121,7 +313,47 @@ def download_from_archive(frameid):
         raise Exception('Could not find file remotely.')
     frame_url = response_dict['url']
     _logger.debug(frame_url)
-    file_response = requests.get(frame_url)
+    if extensions is not None:
+        return fetch_extensions(frame_url, extensions=extensions, partial=partial)
+
+    file_response = get_session().get(frame_url)
     file_response.raise_for_status()
     f = fits.open(io.BytesIO(file_response.content))
+    f.downloaded_bytes = len(file_response.content)
     return f
+
+
+def prefetch_from_archive(frameids, depth=4, extensions=None, partial=False):
+    """
+    Download frames from the LCO archive ahead of their use, so that download latency overlaps with the analysis of
+    the previous frames.
+
+    At most depth frames are in flight or waiting to be consumed at any time, which bounds the memory held by
+    downloaded, but not yet processed frames.
+
+    param frameids: iterable of archive API frame IDs
+    param depth: number of frames to keep downloading ahead of the consumer
+    param extensions, partial: passed on to download_from_archive
+    return: generator of (frameid, HDUList) in input order. The HDUList is None if the download failed.
+    """
+    frameids = iter(frameids)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=depth) as executor:
+        pending = collections.deque()
+
+        def submit_next():
+            for frameid in frameids:
+                pending.append((frameid, executor.submit(download_from_archive, frameid, extensions, partial)))
+                return
+
+        for ii in range(depth):
+            submit_next()
+
+        while pending:
+            frameid, future = pending.popleft()
+            try:
+                hdulist = future.result()
+            except Exception as e:
+                _logger.warning(f"Prefetch of frameid {frameid} failed: {e}")
+                hdulist = None
+            submit_next()
+            yield frameid, hdulist
@@ -0,0 +1,148 @@
+'''
+Tools to read only selected extensions out of a FITS file without materialising the whole file.
+
+The FITS block structure is walked sequentially: headers are parsed, and the data unit of each extension is either
+kept or skipped based on its size as given in the header. Extensions that are only needed for their header (e.g., the
+SCI image of a BANZAI frame when only the CAT table is used) are kept as header-only extensions.
+'''
+import io
+import logging
+
+from astropy.io import fits
+
+_logger = logging.getLogger(__name__)
+
+BLOCKSIZE = 2880
+CARDSIZE = 80
+
+
+def padded_size(nbytes):
+    """ Size of a header or data unit padded to full FITS blocks. """
+    return ((nbytes + BLOCKSIZE - 1) // BLOCKSIZE) * BLOCKSIZE
+
+
+def header_datasize(header):
+    """ Size in bytes of the data unit described by a header, without block padding. """
+    naxis = header.get('NAXIS', 0)
+    if naxis == 0:
+        return 0
+    npixels = 1
+    for ii in range(1, naxis + 1):
+        npixels *= header[f'NAXIS{ii}']
+    return abs(header['BITPIX']) // 8 * header.get('GCOUNT', 1) * (header.get('PCOUNT', 0) + npixels)
+
+
+def has_endcard(block):
+    """ Check if a header block contains the END card. """
+    for ii in range(0, len(block), CARDSIZE):
+        if block[ii:ii + CARDSIZE].rstrip() == b'END':
+            return True
+    return False
+
+
+def read_header_bytes(read):
+    """ Read header blocks until the END card is found.
+
+    param read: callable returning the next n bytes of the file
+    return: raw header bytes, or b'' at the end of the file.
+    """
+    blocks = []
+    while True:
+        block = read(BLOCKSIZE)
+        if len(block) < BLOCKSIZE:
+            if len(block) > 0 or len(blocks) > 0:
+                _logger.warning("Truncated FITS header")
+            return b''
+        blocks.append(block)
+        if has_endcard(block):
+            return b''.join(blocks)
+
+
+def headeronly(header):
+    """ Return a copy of an extension header that describes the same extension without a data unit.
+
+    For tile-compressed images the ZNAXISn keywords that describe the image are left untouched, so that
+    the header still reads as a CompImageHDU with the correct image header.
+    """
+    header = header.copy()
+    if header.get('XTENSION', '').strip() == 'BINTABLE':
+        header['NAXIS2'] = 0
+        header['PCOUNT'] = 0
+        header.remove('THEAP', ignore_missing=True)
+    else:
+        for ii in range(1, header.get('NAXIS', 0) + 1):
+            header.remove(f'NAXIS{ii}', ignore_missing=True)
+        header['NAXIS'] = 0
+    return header
+
+
+def skipper(fileobj):
+    """ Return a callable that advances a file object by n bytes, seeking where possible. """
+    try:
+        seekable = fileobj.seekable()
+    except AttributeError:
+        seekable = False
+
+    if seekable:
+        return lambda nbytes: fileobj.seek(nbytes, io.SEEK_CUR)
+
+    def skip(nbytes):
+        while nbytes > 0:
+            chunk = fileobj.read(min(nbytes, 1024 * BLOCKSIZE))
+            if len(chunk) == 0:
+                return
+            nbytes -= len(chunk)
+
+    return skip
+
+
+def read_extensions(fileobj, extensions=('SCI', 'CAT'), headeronlyextensions=('SCI',)):
+    """ Read selected extensions by EXTNAME out of a FITS file object, e.g., a local file or a streamed http response.
+
+    The primary header is always kept. Reading stops as soon as all requested extensions are found, so trailing
+    extensions are never read.
+
+    param fileobj: binary file-like object positioned at the start of the FITS file
+    param extensions: EXTNAMEs of the extensions to keep
+    param headeronlyextensions: subset of extensions for which only the header is kept; their data are skipped.
+    return: astropy HDUList with the selected extensions. Missing extensions are silently absent.
+    """
+    read = fileobj.read
+    skip = skipper(fileobj)
+    wanted = set(extensions)
+    parts = []
+
+    primary = read_header_bytes(read)
+    if len(primary) == 0:
+        raise OSError("Not a FITS file or empty file")
+    primaryheader = fits.Header.fromstring(primary.decode('ascii'))
+    datasize = padded_size(header_datasize(primaryheader))
+    if datasize > 0:
+        parts.append(headeronly(primaryheader).tostring().encode('ascii'))
+        skip(datasize)
+    else:
+        parts.append(primary)
+
+    while len(wanted) > 0:
+        raw = read_header_bytes(read)
+        if len(raw) == 0:
+            break
+        header = fits.Header.fromstring(raw.decode('ascii'))
+        extname = header.get('EXTNAME', None)
+        datasize = padded_size(header_datasize(header))
+
+        if (extname in wanted) and (extname not in headeronlyextensions):
+            parts.append(raw)
+            parts.append(read(datasize))
+        elif extname in wanted:
+            parts.append(headeronly(header).tostring().encode('ascii'))
+            skip(datasize)
+        else:
+            skip(datasize)
+        wanted.discard(extname)
+
+    if len(wanted) > 0:
+        _logger.debug(f"Extensions not found in file: {wanted}")
+
+    return fits.open(io.BytesIO(b''.join(parts)))
+
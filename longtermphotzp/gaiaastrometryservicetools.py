@@ -4,11 +4,11 @@ import math
 from datetime import datetime
 import os
 import numpy as np
-import requests
 import scipy.stats
 from astropy.io import fits
 from astropy.wcs import WCS
 from astropy.wcs.utils import proj_plane_pixel_scales
+from longtermphotzp.httpsession import get_session
 import matplotlib.pyplot as plt
 __author__ = 'drharbeck@gmail.com'
 
@@ -37,7 +37,7 @@ def astrometryServiceRefineWCSFromCatalog(sourceCatalog, wcs):
 
     try:
         response = None
-        response = requests.post("{}/catalog/".format(LCO_GAIA_ASTROMETRY_URL), json=payload)
+        response = get_session().post("{}/catalog/".format(LCO_GAIA_ASTROMETRY_URL), json=payload)
         response = response.json()
         log.debug(response)
     except:
@@ -108,7 +108,7 @@ def astrometryServiceRefineWCSFromImage(imagepath, wcs=None, makepng = True):
                }
     try:
         start = datetime.utcnow()
-        response = requests.post("{}/image/".format(LCO_GAIA_ASTROMETRY_URL), json=payload)
+        response = get_session().post("{}/image/".format(LCO_GAIA_ASTROMETRY_URL), json=payload)
         response = response.json()
         end = datetime.utcnow()
         log.info (f"Gaia processing took {(end-start).total_seconds():6.2f} s. response is [{response}]")
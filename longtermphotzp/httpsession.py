@@ -0,0 +1,104 @@
+'''
+Shared HTTP session for all outbound service calls (refcat2 service, archive API, astrometry service).
+
+Each process keeps one requests.Session, so connections to a host are kept alive and reused between calls. All
+requests get default connect / read timeouts, and failed connections or transient server errors are retried a bounded
+number of times with exponential backoff.
+
+The session is keyed by process id: worker processes of a pool create their own session on first use, and never
+share sockets with their parent.
+'''
+import logging
+import os
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+_logger = logging.getLogger(__name__)
+
+_settings = {'connect_timeout': 10., 'read_timeout': 120., 'retries': 3, 'backoff': 0.5, 'poolsize': 10}
+_session = None
+_sessionpid = None
+_lock = threading.Lock()
+
+
+class TimeoutSession(requests.Session):
+    ''' requests.Session that applies a default timeout to each request that does not set one explicitly. '''
+
+    def __init__(self, timeout):
+        super().__init__()
+        self.timeout = timeout
+
+    def request(self, method, url, **kwargs):
+        if kwargs.get('timeout') is None:
+            kwargs['timeout'] = self.timeout
+        return super().request(method, url, **kwargs)
+
+
+def configure(connect_timeout=None, read_timeout=None, retries=None, backoff=None, poolsize=None):
+    """ Change the session settings. Takes effect for sessions created after this call.
+
+    :param connect_timeout: time to wait for a connection to be established [s]
+    :param read_timeout: time to wait for data from an established connection [s]
+    :param retries: number of retries on connection errors, read errors and HTTP 429 / 5xx answers
+    :param backoff: backoff factor between retries, the n-th retry waits backoff * 2**(n-1) seconds
+    :param poolsize: number of connections kept alive per host
+    """
+    global _session
+    for key, value in (('connect_timeout', connect_timeout), ('read_timeout', read_timeout), ('retries', retries),
+                       ('backoff', backoff), ('poolsize', poolsize)):
+        if value is not None:
+            _settings[key] = value
+    with _lock:
+        _session = None
+
+
+def make_session():
+    retry = Retry(total=_settings['retries'], connect=_settings['retries'], read=_settings['retries'],
+                  status=_settings['retries'], backoff_factor=_settings['backoff'],
+                  status_forcelist=(429, 500, 502, 503, 504), raise_on_status=False)
+    adapter = HTTPAdapter(pool_connections=20, pool_maxsize=_settings['poolsize'], max_retries=retry)
+    session = TimeoutSession(timeout=(_settings['connect_timeout'], _settings['read_timeout']))
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def get_session():
+    """ The HTTP session of this process. Safe to use from several threads. """
+    global _session, _sessionpid
+    with _lock:
+        if (_session is None) or (_sessionpid != os.getpid()):
+            _session = make_session()
+            _sessionpid = os.getpid()
+        return _session
+
+
+def connection_statistics():
+    """ Number of requests sent and connections opened by the session of this process, per host.
+
+    :return: dictionary host -> (requests, connections)
+    """
+    statistics = {}
+    with _lock:
+        if (_session is None) or (_sessionpid != os.getpid()):
+            return statistics
+        adapters = set(_session.adapters.values())
+    for adapter in adapters:
+        pools = adapter.poolmanager.pools
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool is None:
+                continue
+            nrequests, nconnections = statistics.get(pool.host, (0, 0))
+            statistics[pool.host] = (nrequests + pool.num_requests, nconnections + pool.num_connections)
+    return statistics
+
+
+def log_connection_statistics(level=logging.INFO):
+    for host, (nrequests, nconnections) in connection_statistics().items():
+        reuse = 1. - nconnections / nrequests if nrequests > 0 else 0.
+        _logger.log(level, f"HTTP {host}: {nrequests} requests over {nconnections} connections, "
+                           f"{reuse * 100:.0f}% connection reuse")
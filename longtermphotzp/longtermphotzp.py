@@ -9,9 +9,9 @@ import numpy as np
 import datetime
 import sys
 import math
-import calendar
 import scipy.signal
 import argparse
+import concurrent.futures
 import logging
 import boto3
 import io
@@ -20,6 +20,8 @@ from itertools import cycle
 from matplotlib.patches import Rectangle
 import matplotlib.dates as mdates
 
+from astropy.table import Table
+
 from longtermphotzp.photdbinterface import photdbinterface
 np.set_printoptions(legacy="1.25")
 
@@ -47,6 +49,17 @@ telescopedict = {
     #  'bpl': ['doma-1m0a']
 }
 
+# East longitude of the sites [deg]; a night of a site starts at local mean noon.
+sitelongitude = {'lsc': -70.80, 'coj': 149.07, 'ogg': -156.26, 'elp': -104.02, 'cpt': 20.81, 'tfn': -16.51,
+                 'sqa': -120.04, 'bpl': -119.86}
+
+
+def night_boundary_utc(site):
+    """ UTC hour at which a night of a site starts, i.e., local mean noon. 12:00 UTC for unknown sites. """
+    if site not in sitelongitude:
+        return 12.
+    return (12. - sitelongitude[site] / 15.) % 24.
+
 # TODO: either migrate into separate file or find a better source, e.g., store in db, or query maintenance data base.
 
 telescopecleaning = {
@@ -288,17 +301,146 @@ def dateformat(starttime, endtime):
     plt.gca().grid(which='minor')
 
 
-def plotlongtermtrend(select_site, select_telescope, select_filter, context, instrument=None, cacheddb=None):
+def queryfilters(select_filter):
+    """ Filter names to read from the database for a selected filter. """
+    if (select_filter == 'zp') or (select_filter == 'zs'):
+        return ['zs', 'zp']
+    return [select_filter, ]
+
+
+def filterselection(data, select_filter):
+    """ Boolean array of the records in data taken in the selected filter, or in one of its aliases. """
+    if (select_filter == 'zp') or (select_filter == 'zs'):
+        return np.logical_or((data['filter'] == 'zs'), (data['filter'] == 'zp'))
+    if (select_filter == 'R') or (select_filter == 'Rc'):
+        return (data['filter'] == 'Rc') | (data['filter'] == 'R')
+    return data['filter'] == select_filter
+
+
+def plotlongtermtrends(select_site, select_telescope, select_filters, context, instrument=None, cacheddb=None,
+                       colorterms=colorterms):
+    """ plotlongtermtrend for several filters, reading the telescope's records from the database only once.
+
+    A filter that fails is logged and skipped; the plots and color terms of the other filters are kept.
+
+    :return: list of filenames of all filters, and None if there are no records at all
+    """
+    queried = []
+    for select_filter in select_filters:
+        queried.extend(f for f in queryfilters(select_filter) if f not in queried)
+    alldata = getCombineddataByTelescope(select_site, select_telescope, context, instrument, filter=queried,
+                                         cacheddb=cacheddb)
+    if alldata is None:
+        return None
+
     filenames = []
-    filters = None
-    if select_filter is not None:
-        if (select_filter == 'zp') or (select_filter == 'zs'):
-            filters = ['zs','zp']
-        else:
-            filters= [select_filter,]
+    for select_filter in select_filters:
+        selection = filterselection(alldata, select_filter)
+        if not np.any(selection):
+            _logger.info("No records of %s %s in filter %s" % (select_site, select_telescope, select_filter))
+            continue
+        _logger.info(
+            "Now plotting and fitting mirror model for %s %s in filter %s" % (select_site, select_telescope,
+                                                                              select_filter))
+        try:
+            result = plotlongtermtrend(select_site, select_telescope, select_filter, context, instrument=instrument,
+                                       cacheddb=cacheddb, data=alldata[selection], colorterms=colorterms)
+        except Exception:
+            # One filter must not cost the plots of the others.
+            _logger.exception("Failed while plotting %s %s in filter %s" % (select_site, select_telescope,
+                                                                             select_filter))
+            plt.close('all')
+            if cacheddb is not None:
+                cacheddb.session.rollback()
+            continue
+        if result is not None:
+            filenames += result
+    return filenames
+
 
+def telescopetrendjob(site, telescope, filters, context, cacheddb=None):
+    """ Trend plots and mirror models of one telescope in all filters.
 
-    data = getCombineddataByTelescope(select_site, select_telescope, context, instrument, filter=filters, cacheddb=cacheddb)
+    :return: list of filenames, dictionary filter -> {telescope id: median color term}
+    """
+    jobcolorterms = {}
+    db = photdbinterface(context.database) if cacheddb is None else cacheddb
+    try:
+        filenames = plotlongtermtrends(site, telescope, filters, context, cacheddb=db, colorterms=jobcolorterms)
+    except Exception:
+        # leave the session and pyplot usable for the next job
+        db.session.rollback()
+        plt.close('all')
+        raise
+    finally:
+        if cacheddb is None:
+            db.close()
+    return filenames if filenames is not None else [], jobcolorterms
+
+
+def mergecolorterms(colorterms, jobcolorterms):
+    for filter, terms in jobcolorterms.items():
+        colorterms.setdefault(filter, {}).update(terms)
+
+
+def _init_trendworker(context):
+    logging.basicConfig(level=getattr(logging, context.log_level.upper()),
+                        format='%(asctime)s.%(msecs).03d %(levelname)7s: %(module)20s: %(message)s')
+    setup_matplotlib()
+
+
+def _trendjob_in_worker(site, telescope, filters, context):
+    # The job opens and closes its own database session; the engine is reused within the worker process.
+    return telescopetrendjob(site, telescope, filters, context)
+
+
+def plottelescopetrends(jobs, filters, context):
+    """ Run telescopetrendjob for a list of (site, telescope) jobs, in a pool of context.workers processes if more
+    than one.
+
+    Jobs in workers open their own database session. Results are yielded in the order of the jobs; a job that fails is
+    logged and skipped, with or without workers.
+
+    :return: iterator over (filenames, colorterms) of the jobs
+    """
+    workers = getattr(context, 'workers', 1)
+    if workers <= 1:
+        db = photdbinterface(context.database)
+        try:
+            for site, telescope in jobs:
+                try:
+                    result = telescopetrendjob(site, telescope, filters, context, cacheddb=db)
+                except Exception:
+                    _logger.exception(f"Failed while plotting {site} {telescope}")
+                    continue
+                yield result
+        finally:
+            db.close()
+        return
+
+    _logger.info(f"Plotting {len(jobs)} telescopes with {workers} worker processes")
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers, initializer=_init_trendworker,
+                                                initargs=(context,)) as executor:
+        futures = [executor.submit(_trendjob_in_worker, site, telescope, filters, context) for site, telescope in jobs]
+        for (site, telescope), future in zip(jobs, futures):
+            try:
+                yield future.result()
+            except Exception:
+                _logger.exception(f"Worker failed while plotting {site} {telescope}")
+
+
+def plotlongtermtrend(select_site, select_telescope, select_filter, context, instrument=None, cacheddb=None,
+                      data=None, colorterms=colorterms):
+    """
+    :param data: records of the telescope as returned by getCombineddataByTelescope, read from the database if None
+    :param colorterms: dictionary filter -> {telescope id: median color term} the color term is added to; the module
+                       wide colorterms by default
+    """
+    filenames = []
+    if data is None:
+        filters = queryfilters(select_filter) if select_filter is not None else None
+        data = getCombineddataByTelescope(select_site, select_telescope, context, instrument, filter=filters,
+                                          cacheddb=cacheddb)
 
     mystarttime = starttime
     # if (select_site == 'elp') and (select_telescope=='doma-1m0a'):
@@ -310,12 +452,7 @@ def plotlongtermtrend(select_site, select_telescope, select_filter, context, ins
     selection = np.ones(len(data['name']), dtype=bool)
 
     if select_filter is not None:
-        if (select_filter == 'zp') or (select_filter == 'zs'):
-            selection = selection &  numpy.logical_or( (data['filter'] == 'zs') , (data['filter'] == 'zp'))
-        elif  (select_filter == 'R') or (select_filter == 'Rc'):
-            selection = selection &  ( (data['filter'] == 'Rc') | (data['filter'] == 'R'))
-        else:
-            selection = selection & (data['filter'] == select_filter)
+        selection = selection & filterselection(data, select_filter)
     if instrument is not None:
         selection = selection & (data['camera'] == instrument)
 
@@ -351,8 +488,9 @@ def plotlongtermtrend(select_site, select_telescope, select_filter, context, ins
 
     # find the overall trend of zeropoint variations, save to output file.
     if len(dateselect[zpsigselect < photzpmaxnoise]) > 0:
+        dayboundary = night_boundary_utc(select_site) if getattr(context, 'localnoonnights', False) else 12.
         _x, _y = findUpperEnvelope(dateselect[zpsigselect < photzpmaxnoise], zp_air[zpsigselect < photzpmaxnoise],
-                                   ymax=ymax)
+                                   ymax=ymax, dayboundary=dayboundary)
         db = photdbinterface(context.database) if cacheddb is None else cacheddb
         db.storemirrormodel("%s-%s" % (select_site, select_telescope), select_filter, _x, _y)
         if cacheddb is None:
@@ -400,12 +538,12 @@ def plotlongtermtrend(select_site, select_telescope, select_filter, context, ins
             _site, _enc, _tel = telid.split("-")
             if (_site == select_site) and (select_telescope == '%s-%s' % (_enc, _tel)):
 
-                events = mirrorreplacmenet[telid]
-                events.append(datetime.datetime.utcnow())
-                print(events)
+                # the last epoch lasts until now; do not append to the global list, it is reused for every filter.
+                events = mirrorreplacmenet[telid] + [datetime.datetime.utcnow()]
+                _logger.debug(events)
                 for ii in range(len(events) - 1):
-                    start = mirrorreplacmenet[telid][ii]
-                    end = mirrorreplacmenet[telid][ii + 1]
+                    start = events[ii]
+                    end = events[ii + 1]
                     fittrendtomirrormodel(_x, _y, start, end, plot=True)
 
     else:
@@ -520,7 +658,7 @@ def plot_referencethoughput(start, end, select_filter, select_telescope):
         rect = Rectangle((start, goodvalue), end - start, -0.2, color='#A0FFA0A0')
         plt.axes().add_patch(rect)
 
-def findUpperEnvelope(dateobs, datum, ymax=24.2):
+def findUpperEnvelope(dateobs, datum, ymax=24.2, dayboundary=12.):
     """
     Find the upper envelope of a photZP time line
 
@@ -536,40 +674,56 @@ def findUpperEnvelope(dateobs, datum, ymax=24.2):
     :param dateobs:
     :param datum:
     :param range:
+    :param dayboundary: UTC hour at which a night starts, see night_boundary_utc()
     :return:
     """
 
     stderror = 0.03
 
-    alldata = zip(dateobs, datum)
-    sorted_points = sorted(alldata)
-    x = np.asarray([point[0] for point in sorted_points])
-    y = np.asarray([point[1] for point in sorted_points])
-
-    day_x = []
-    day_y = []
-
-    # TODO: define  day / night boundary for the site.
-    startdate = datetime.datetime(year=x[0].year, month=x[0].month,
-                                  day=x[0].day, hour=12)
-    enddate = x[len(x) - 1]
-    while startdate < enddate:
-        # Calculate the best throughput of a day
-        todayzps = y[
-            (x > startdate) & (x < startdate + datetime.timedelta(days=1)) & (
-                    y < ymax) & (y is not np.nan)]
-
-        if len(todayzps) > 3:  # require a minimum amount of data for a night
-
-            todayzps = np.sort(todayzps)[1:]
-            maxzp = np.nanmax(todayzps)
-            upperEnv = np.nanmean(todayzps[todayzps > (maxzp - stderror)])
-
-            if upperEnv is not np.nan:
-                day_x.append(startdate)
-                day_y.append(upperEnv)
-
-        startdate = startdate + datetime.timedelta(days=1)
+    # Sort into nights. Night k is the open interval (firstnight + k days, firstnight + k+1 days), where firstnight
+    # starts on the day of the first observation at the day boundary.
+    t = np.asarray(dateobs, dtype='datetime64[us]')
+    y = np.asarray(datum, dtype=np.float64)
+    firstnight = t.min().astype('datetime64[D]') + np.timedelta64(int(round(dayboundary * 3600e6)), 'us')
+    day = 86400 * 10 ** 6
+    offset = (t - firstnight).astype(np.int64)
+    night = offset // day
+    select = (offset > 0) & (offset % day != 0) & (y < ymax)
+    night = night[select]
+    y = y[select]
+
+    # zeropoints in ascending order per night
+    order = np.lexsort((y, night))
+    night = night[order]
+    y = y[order]
+    nights, starts, counts = np.unique(night, return_index=True, return_counts=True)
+    segment = np.repeat(np.arange(len(nights)), counts)
+    ends = starts + counts
+
+    # Omit the lowest zeropoint of the night, and average the others within stderror of the best one. As the
+    # zeropoints are sorted, those are the last n of the night.
+    upper = (np.arange(len(y)) > starts[segment]) & (y > y[ends - 1][segment] - stderror)
+    n = np.bincount(segment, weights=upper, minlength=len(nights)).astype(np.int64)
+    first = ends - n
+
+    # require a minimum amount of data for a night
+    good = counts > 3
+    nights = nights[good]
+    first = first[good]
+    ends = ends[good]
+    n = n[good]
+
+    # Same summation order as np.mean: sequential below 8 values, pairwise otherwise.
+    total = np.zeros(len(nights))
+    for jj in range(min(np.max(n, initial=0), 8)):
+        active = n > jj
+        total[active] += y[first[active] + jj]
+    upperEnv = total / n
+    for ii in np.flatnonzero(n >= 8):
+        upperEnv[ii] = np.mean(y[first[ii]:ends[ii]])
+
+    day_x = (firstnight + nights * np.timedelta64(1, 'D')).astype(datetime.datetime)
+    day_y = list(upperEnv)
 
     # filter the daily zero point variation. Work in progress.
     medianrange = 9
@@ -578,62 +732,145 @@ def findUpperEnvelope(dateobs, datum, ymax=24.2):
     return np.asarray(day_x), newday_y
 
 
-def trendcorrectthroughput(datadate, datazp, modeldate, modelzp):
-    """ Detrend input data based in a trend model
-
-    """
-
-    modelgmt = np.zeros((len(modeldate)))
-    for ii in range(0, len(modeldate)):
-        modelgmt[ii] = calendar.timegm(modeldate[ii].timetuple())
-
-    corrected = np.zeros(len(datazp))
-    for ii in range(0, len(corrected)):
-        interpolated = np.interp(calendar.timegm(datadate[ii].timetuple()),
-                                 modelgmt, modelzp)
-        corrected[ii] = datazp[ii] - interpolated
-
-    # estimate if photometric
-
-    photomerticthres = 0.25
-    day_x = []
-    day_y = []
-    alldata = zip(datadate, corrected)
-    sorted_points = sorted(alldata)
-    x = np.asarray([point[0] for point in sorted_points])
-    y = np.asarray([point[1] for point in sorted_points])
-    startdate = datetime.datetime(year=2016, month=4, day=1, hour=16)
-    enddate = x[len(x) - 1]
-
-    while startdate < enddate:
-        todayzps = y[
-            (x > startdate) & (x < startdate + datetime.timedelta(days=1))]
-
-        photometric = -1
+def epochseconds(dates):
+    """ Seconds since 1970 of datetimes, truncated to full seconds as calendar.timegm does. """
+    return np.asarray(dates, dtype='datetime64[us]').astype(np.int64) // 10 ** 6
 
-        if len(todayzps) > 0:  # require a minium amount of data for a night
 
-            if np.min(todayzps > -0.15):
-                photometric = 1
-            else:
-                photometric = 0
+def trendcorrectthroughput(datadate, datazp, modeldate, modelzp, startdate=datetime.datetime(2016, 4, 1, 16),
+                           threshold=-0.15):
+    """ Detrend input data based in a trend model, and classify the nights since startdate as photometric.
 
-        day_x.append(startdate)
-        day_y.append(photometric)
+    :return: detrended zeropoints, start of each night, and per night 1 if photometric, i.e., all detrended
+             zeropoints of the night are above threshold, 0 if not photometric, -1 if there is no data for the night.
+    """
+    corrected = np.asarray(datazp, dtype=np.float64) - np.interp(epochseconds(datadate),
+                                                                 epochseconds(modeldate).astype(np.float64), modelzp)
 
-        startdate = startdate + datetime.timedelta(days=1)
+    day_x, day_y = classifynights(datadate, corrected, startdate, threshold=threshold)
+    return corrected, day_x, day_y
 
-    day_x = np.asarray(day_x)
-    day_y = np.asarray(day_y)
-    unclassified = len(day_y[day_y < 0])
-    photometric = len(day_y[day_y > 0])
-    nonphot = len(day_y[day_y == 0])
-    #
 
-    # print ("out of %d days\nphotometric\t%d\nnon-photometric\t%d\nunknown\t%d" %
-    #        (unclassified+photometric+nonphot, photometric, nonphot, unclassified))
+def classifynights(dates, corrected, startdate, threshold=-0.15):
+    """ Classify each night from startdate to the last date as photometric, see trendcorrectthroughput.
 
-    return corrected, day_x, day_y
+    Night k is the open interval (startdate + k days, startdate + k+1 days).
+    """
+    day = 86400 * 10 ** 6
+    offset = (np.asarray(dates, dtype='datetime64[us]') - np.datetime64(startdate, 'us')).astype(np.int64)
+    ndays = max(0, -(-np.max(offset, initial=0) // day))
+    select = (offset > 0) & (offset % day != 0)
+    night = offset[select] // day
+    nobs = np.bincount(night, minlength=ndays)
+    nbad = np.bincount(night, weights=~(corrected[select] > threshold), minlength=ndays)
+
+    day_x = (np.datetime64(startdate, 'us') + np.arange(ndays) * np.timedelta64(1, 'D')).astype(datetime.datetime)
+    day_y = np.where(nobs > 0, np.where(nbad == 0, 1, 0), -1)
+    return day_x, day_y
+
+
+def photometricnightcalendar(data, mirrormodels, startdate=datetime.date(2016, 4, 1), threshold=-0.15,
+                             dayboundary=None):
+    """ Photometric nights of any number of telescopes and filters at once.
+
+    The air mass corrected zeropoints of each telescope and filter are detrended with the mirror model of the
+    telescope and filter, and the nights since startdate are classified as in trendcorrectthroughput. Nights start at
+    the UTC hour dayboundary, or at local noon of the site if dayboundary is None.
+
+    :param data: Table of zeropoint measurements as returned by photdbinterface.readRecords
+    :param mirrormodels: dictionary (telescope id, filter) -> (model dates, model zeropoints); measurements without
+                         a model are ignored
+    :return: Table of 'telescope', 'filter', 'night' (start of night), 'nobs', and 'photometric' (1 or 0) for all
+             nights with measurements
+    """
+    telescopeid = np.char.add(np.char.add(np.char.add(np.char.add(
+        np.asarray(data['site'], dtype=str), '-'), np.asarray(data['dome'], dtype=str)), '-'),
+        np.asarray(data['telescope'], dtype=str))
+    filters = np.asarray(data['filter'], dtype=str)
+    keys, group = np.unique(np.char.add(np.char.add(telescopeid, '/'), filters), return_inverse=True)
+    keys = [tuple(key.split('/')) for key in keys]
+
+    # One interpolation for all groups: group g is shifted by g * span seconds in the model and the data; data are
+    # clamped to the range of their own model first, which is what np.interp does at the edges.
+    span = 10 ** 10
+    modelx = []
+    modely = []
+    lo = np.zeros(len(keys))
+    hi = np.full(len(keys), -1.)
+    k = np.zeros(len(keys))
+    boundary = np.zeros(len(keys))
+    for g, (telescope, filter) in enumerate(keys):
+        k[g] = airmasscorrection.get(filter, np.nan)
+        boundary[g] = night_boundary_utc(telescope[:3]) if dayboundary is None else dayboundary
+        if (telescope, filter) not in mirrormodels:
+            continue
+        mdates, mzps = mirrormodels[(telescope, filter)]
+        mx = epochseconds(mdates).astype(np.float64)
+        order = np.argsort(mx, kind='stable')
+        modelx.append(mx[order] + g * span)
+        modely.append(np.asarray(mzps, dtype=np.float64)[order])
+        lo[g] = mx[order][0]
+        hi[g] = mx[order][-1]
+
+    airmass = np.asarray(data['airmass'], dtype=np.float64)
+    zp = np.asarray(data['zp'], dtype=np.float64)
+    zp_air = zp + k[group] * airmass - k[group]
+    usable = (hi[group] >= lo[group]) & np.isfinite(zp_air)
+    if (len(modelx) == 0) or (not np.any(usable)):
+        return Table(names=['telescope', 'filter', 'night', 'nobs', 'photometric'],
+                     dtype=[str, str, object, int, int])
+    group = group[usable]
+    t = epochseconds(np.asarray(data['dateobs'])[usable])
+    x = np.clip(t, lo[group], hi[group]) + group * span
+    corrected = zp_air[usable] - np.interp(x, np.concatenate(modelx), np.concatenate(modely))
+
+    # Nights per group, from startdate at the local noon of the site.
+    day = 86400 * 10 ** 6
+    firstnight = np.datetime64(startdate, 'D').astype('datetime64[us]').astype(np.int64) + \
+                 np.round(boundary * 3600e6).astype(np.int64)
+    offset = np.asarray(data['dateobs'])[usable].astype('datetime64[us]').astype(np.int64) - firstnight[group]
+    select = (offset > 0) & (offset % day != 0)
+    group = group[select]
+    night = offset[select] // day
+    bad = ~(corrected[select] > threshold)
+
+    nightkeys, inverse, nobs = np.unique(np.stack([group, night]), axis=1, return_inverse=True, return_counts=True)
+    nbad = np.bincount(inverse.ravel(), weights=bad, minlength=nightkeys.shape[1])
+    nightstart = (firstnight[nightkeys[0]] + nightkeys[1] * day).astype('datetime64[us]').astype(datetime.datetime)
+
+    nights = Table()
+    nights['telescope'] = [keys[g][0] for g in nightkeys[0]]
+    nights['filter'] = [keys[g][1] for g in nightkeys[0]]
+    nights['night'] = nightstart
+    nights['nobs'] = nobs
+    nights['photometric'] = np.where(nbad == 0, 1, 0)
+    return nights
+
+
+def writephotometricnightcalendar(context, filename):
+    """ Photometric night calendar of all telescopes and filters in the database, written as ECSV table. """
+    db = photdbinterface(context.database)
+    data = db.readRecords()
+    if data is None:
+        db.close()
+        return None
+    mirrormodels = {}
+    telescopeids = np.char.add(np.char.add(np.char.add(np.char.add(
+        np.asarray(data['site'], dtype=str), '-'), np.asarray(data['dome'], dtype=str)), '-'),
+        np.asarray(data['telescope'], dtype=str))
+    for telescopeid, filter in set(zip(telescopeids, np.asarray(data['filter'], dtype=str))):
+        model = db.readmirrormodel(telescopeid, filter)
+        if model is not None:
+            mirrormodels[(telescopeid, filter)] = (model['dateobs'], model['zp'])
+    db.close()
+
+    # nights as in the mirror models
+    dayboundary = None if getattr(context, 'localnoonnights', False) else 12.
+    nights = photometricnightcalendar(data, mirrormodels, dayboundary=dayboundary)
+    nights['night'] = [night.isoformat() for night in nights['night']]
+    nights.write(filename, format='ascii.ecsv', overwrite=True)
+    _logger.info(f"Wrote {len(nights)} nights of {len(mirrormodels)} telescopes and filters to {filename}")
+    return filename
 
 
 def fittrendtomirrormodel(dates, zps, start, end, order=1, plot=False):
@@ -660,8 +897,12 @@ def fittrendtomirrormodel(dates, zps, start, end, order=1, plot=False):
 
 
 
-def plot_all_color_terms (context, colorterms, type='1m0'):
-    filter = next(iter(colorterms))
+def plot_all_color_terms (context, colorterms, type='1m0', filter=None):
+    if filter is None:
+        filter = next(iter(colorterms))
+    if filter not in colorterms:
+        _logger.warning(f"No color terms in filter {filter}, not plotting them.")
+        return
     myterms = colorterms[filter]
     data = list(myterms.items())
     data = np.array(data).T
@@ -684,15 +925,15 @@ def plot_all_color_terms (context, colorterms, type='1m0'):
         plt.close()
 
         # save the plot onto stable storage
-        filename = 'colorterms_{}.png'.format( context.filter)
+        filename = 'colorterms_{}.png'.format(filter)
 
         write_to_storage_backend(context.imagedbPrefix, filename, fileobj.getvalue())
 
 
-def plotallmirrormodels(context, type=['2m0a', '1m0a'], range=[22.5, 25.5], cacheddb=None):
+def plotallmirrormodels(context, type=['2m0a', '1m0a'], range=[22.5, 25.5], cacheddb=None, filter=None):
     '''
     Fetch mirror model from database for a selected class of telescopes, and
-    put them all into one single plot.
+    put them all into one single plot. The filter is context.filter unless given.
 
     Returns a list of figure names (S3 keys)
     '''
@@ -703,7 +944,7 @@ def plotallmirrormodels(context, type=['2m0a', '1m0a'], range=[22.5, 25.5], cach
     else:
         db = cacheddb
 
-    myfilter = context.filter
+    myfilter = context.filter if filter is None else filter
     modellist = []
 
     for t in type:
@@ -742,7 +983,7 @@ def plotallmirrormodels(context, type=['2m0a', '1m0a'], range=[22.5, 25.5], cach
         plt.close()
 
         # save the plot onto stable storage
-        filename = 'allmodels_{}_{}.png'.format(name, context.filter)
+        filename = 'allmodels_{}_{}.png'.format(name, myfilter)
         filenames.append(filename)
         write_to_storage_backend(context.imagedbPrefix, filename, fileobj.getvalue())
 
@@ -753,36 +994,44 @@ def plotallmirrormodels(context, type=['2m0a', '1m0a'], range=[22.5, 25.5], cach
 
 
 def renderHTMLPage(context, filenames):
+    """ Write index.html with the summary plots and the per telescope trend plots of each filter in context.filters,
+    the trend plots grouped by site.
+    """
     _logger.info("Now rendering output html page")
+    filters = getattr(context, 'filters', None) or [context.filter, ]
 
     message = """<html>
 <head></head>
 <body><title>LCO Zeropoint Plots</title>
 """
     message += "<p/>Figures updated %s UTC <p/>\n" % (datetime.datetime.utcnow())
-    message += """
-<h1> Overview </h1>
-     <a href="allmodels_2m01m0_rp.png"><img src="allmodels_2m01m0_rp.png" width="800" /></a>
-     <a href="allmodels_0m4_rp.png"><img src="allmodels_0m4_rp.png" width="800" /></a>
+    message += "\n<h1> Overview </h1>\n"
+    for filter in filters:
+        if len(filters) > 1:
+            message += " <h2> %s </h2>\n" % (filter)
+        message += """     <a href="allmodels_2m01m0_{0}.png"><img src="allmodels_2m01m0_{0}.png" width="800" /></a>
+     <a href="allmodels_0m4_{0}.png"><img src="allmodels_0m4_{0}.png" width="800" /></a>
     <p/>
+""".format(filter)
 
-<h1> Details by Site: </h1>
-"""
-
-    for site in telescopedict:
-        message = message + " <h2> %s </h2>\n" % (site)
+    zptrendimages = [k for k in filenames if k.startswith('photzptrend')]
+    for filter in filters:
+        message += "\n<h1> Details by Site in %s: </h1>\n" % (filter)
 
-        zptrendimages = [k for k in filenames if k.startswith('photzptrend')]
-        zptrendimages.sort(key=lambda x: x[-16: -4])
+        for site in telescopedict:
+            message = message + " <h2> %s </h2>\n" % (site)
 
-        _logger.debug(
-            "Found individual telescopes zp trend plots for site %s to include:\n\t %s " % (site, zptrendimages))
+            siteimages = sorted(k for k in zptrendimages
+                                if k.startswith('photzptrend-%s-' % site) and k.endswith('-%s.png' % filter))
+            _logger.debug(
+                "Found individual telescopes zp trend plots for site %s in %s to include:\n\t %s " % (
+                    site, filter, siteimages))
 
-        for zptrend in zptrendimages:
-            line = '<a href="%s"><img src="%s" height="450"/></a>  <img src="%s" height="450"/>  <img src="%s" height="450"/><p/>' % (
-                zptrend, zptrend, zptrend.replace('photzptrend', 'colortermtrend'),
-                zptrend.replace('photzptrend', 'airmasstrend'))
-            message = message + line
+            for zptrend in siteimages:
+                line = '<a href="%s"><img src="%s" height="450"/></a>  <img src="%s" height="450"/>  <img src="%s" height="450"/><p/>' % (
+                    zptrend, zptrend, zptrend.replace('photzptrend', 'colortermtrend'),
+                    zptrend.replace('photzptrend', 'airmasstrend'))
+                message = message + line
 
     message = message + "</body></html>"
 
@@ -810,10 +1059,20 @@ def parseCommandLine():
     parser.add_argument('--telescope', default=None,
                         help='Telescope id. written inform enclosure-telescope, e.g., "domb-1m0a"')
     parser.add_argument('--filter', default='rp', help='Which filter to process.', choices=['up', 'gp', 'rp', 'ip', 'zp','zs', 'Y', 'U', 'B','R','V','I'])
+    parser.add_argument('--filters', nargs='+', default=None, choices=['up', 'gp', 'rp', 'ip', 'zp','zs', 'Y', 'U', 'B','R','V','I'],
+                        help='Process several filters in one go, reading the records of each telescope only once. '
+                             'Overrides --filter.')
     parser.add_argument('--pertelescopeplots', type=bool, default=True)
     parser.add_argument('--createsummaryplots', type=bool, default=True)
     parser.add_argument('--renderhtml', type=bool, default=True)
     parser.add_argument('--errorhistogram', type=bool, default=False)
+    parser.add_argument('--photometricnights', default=None,
+                        help='Write a calendar of photometric nights of all telescopes and filters to this file')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Number of worker processes for the per telescope trend plots')
+    parser.add_argument('--localnoonnights', action='store_true',
+                        help='Start the nights of each site at its local noon instead of 12:00 UTC for the mirror '
+                             'models and the photometric night calendar. Changes the stored mirror models.')
 
     args = parser.parse_args()
 
@@ -822,15 +1081,21 @@ def parseCommandLine():
 
     args.imagedbPrefix = os.path.expanduser(args.imagedbPrefix)
     args.database = os.path.expanduser(args.database)
+    if args.filters is None:
+        args.filters = [args.filter, ]
 
     return args
 
 
-def longtermphotzp():
+def setup_matplotlib():
     plt.style.use('ggplot')
     matplotlib.rcParams['savefig.dpi'] = 300
     matplotlib.rcParams['figure.figsize'] = (8.0, 6.0)
 
+
+def longtermphotzp():
+    setup_matplotlib()
+
     filenames = []
     args = parseCommandLine()
 
@@ -840,29 +1105,28 @@ def longtermphotzp():
         crawlsites = telescopedict
 
     if args.pertelescopeplots:
-        db = photdbinterface(args.database)
-
+        jobs = []
         for site in crawlsites:
             if args.telescope is None:
                 crawlScopes = telescopedict[site]
             else:
                 crawlScopes = [args.telescope, ]
+            jobs.extend((site, telescope) for telescope in crawlScopes)
 
-            for telescope in crawlScopes:
-                _logger.info(
-                    "Now plotting and fitting mirror model for %s %s in filter %s" % (site, telescope, args.filter))
-                result = plotlongtermtrend(site, telescope, args.filter, args, cacheddb=db)
-                if result is not None:
-                    filenames += result
+        for jobfilenames, jobcolorterms in plottelescopetrends(jobs, args.filters, args):
+            filenames += jobfilenames
+            mergecolorterms(colorterms, jobcolorterms)
 
-        db.close()
+    for filter in args.filters:
+        # Generate mirror model plots for all telscopes in a single plot
+        if args.createsummaryplots:
+            filenames += plotallmirrormodels(args, type=['2m0', '1m0'], filter=filter)
+            filenames += plotallmirrormodels(args, type=['0m4'], range=[20, 23], filter=filter)
 
-    # Generate mirror model plots for all telscopes in a single plot
-    if args.createsummaryplots:
-        filenames += plotallmirrormodels(args, type=['2m0', '1m0'])
-        filenames += plotallmirrormodels(args, type=['0m4'], range=[20, 23])
+        plot_all_color_terms(args, colorterms, filter=filter)
 
-    plot_all_color_terms(args, colorterms)
+    if args.photometricnights is not None:
+        writephotometricnightcalendar(args, args.photometricnights)
 
     # Make a fancy HTML page
     if args.renderhtml:
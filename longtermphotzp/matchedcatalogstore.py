@@ -0,0 +1,186 @@
+'''
+Columnar store of the per star matched catalogs of analysed frames.
+
+Every star that went into a zeropoint fit is kept with its reference magnitude and color, instrumental magnitude,
+detector position, peak, and match distance, so the fit can be redone later with a different recipe without
+downloading and crossmatching the frames again.
+
+The store is a directory of Parquet files, partitioned hive style by telescope, filter, and night:
+
+    <root>/telescope=lsc-domb-1m0a/filter=rp/night=20240101/part-<time>-<pid>-<n>.parquet
+
+Frames are buffered and written in batches; each flush adds a new file to the partitions of the buffered frames, so a
+night is appended to by writing more files. The stars of a frame are stored in consecutive rows of one file. Files are
+read memory mapped, either all at once with read(), or one file at a time with iter_tables().
+'''
+import datetime
+import logging
+import os
+import re
+import time
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pyarrow.fs as fs
+import pyarrow.parquet as pq
+
+_logger = logging.getLogger(__name__)
+
+PARTITIONING = pa.schema([('telescope', pa.string()), ('filter', pa.string()), ('night', pa.string())])
+
+# Per star columns, and the per frame columns that are repeated for each star of the frame.
+STAR_COLUMNS = {'ra': np.float64, 'dec': np.float64, 'refmag': np.float32, 'refmagerr': np.float32,
+                'refcol': np.float32, 'refcolerr': np.float32, 'instmag': np.float32, 'instflux': np.float32,
+                'x': np.float32, 'y': np.float32, 'peak': np.float32, 'matchDistance': np.float32}
+FRAME_COLUMNS = {'name': pa.string(), 'dateobs': pa.string(), 'camera': pa.string(), 'reffilter': pa.string(),
+                 'exptime': pa.float64(), 'airmass': pa.float64()}
+
+
+def night_of(imageName, dateobs):
+    """ Night of observation as YYYYMMDD: the DAY-OBS in LCO file names, otherwise the date of the exposure. """
+    m = re.search(r'-(\d{8})-', imageName)
+    if m is not None:
+        return m.group(1)
+    return dateobs[:10].replace('-', '')
+
+
+def make_frame(imageName, retCatalog):
+    """ Collect what the store keeps of a frame from the matched catalog of PhotCalib.generateCrossmatchedCatalog.
+
+    :return: dictionary of partition keys 'telescope', 'filter', 'night', and a pyarrow table of the stars
+    """
+    nstars = len(retCatalog['ra'])
+    columns = {name: pa.array(np.asarray(retCatalog[name], dtype=dtype)) for name, dtype in STAR_COLUMNS.items()}
+    airmass = retCatalog['airmass']
+    framevalues = {'name': imageName, 'dateobs': retCatalog['dateobs'], 'camera': retCatalog['instrument'],
+                   'reffilter': retCatalog['reffilter'], 'exptime': float(retCatalog['exptime']),
+                   'airmass': float(airmass) if isinstance(airmass, (int, float)) else None}
+    for name, pytype in FRAME_COLUMNS.items():
+        columns[name] = pa.array([framevalues[name]] * nstars, type=pytype)
+    return {'telescope': f"{retCatalog['siteid']}-{retCatalog['domid']}-{retCatalog['telescope']}",
+            'filter': retCatalog['instfilter'], 'night': night_of(imageName, retCatalog['dateobs']),
+            'stars': pa.table(columns)}
+
+
+class MatchedCatalogStore:
+
+    def __init__(self, rootdir, maxrows=1000000, compression='zstd'):
+        """
+        :param rootdir: directory of the store, created if needed
+        :param maxrows: buffered frames are written once they hold more than maxrows stars
+        """
+        self.rootdir = os.path.abspath(rootdir)
+        self.maxrows = maxrows
+        self.compression = compression
+        self.buffer = {}
+        self.nrows = 0
+        self.nfiles = 0
+        os.makedirs(rootdir, exist_ok=True)
+
+    def addframe(self, frame):
+        """ Queue a frame as made by make_frame for writing. """
+        key = (frame['telescope'], frame['filter'], frame['night'])
+        self.buffer.setdefault(key, []).append(frame['stars'])
+        self.nrows += frame['stars'].num_rows
+        if self.nrows >= self.maxrows:
+            self.flush()
+
+    def flush(self):
+        """ Write one file per partition of the buffered frames. """
+        for (telescope, filter, night), tables in self.buffer.items():
+            directory = os.path.join(self.rootdir, f'telescope={telescope}', f'filter={filter}', f'night={night}')
+            os.makedirs(directory, exist_ok=True)
+            basename = f'part-{time.time_ns()}-{os.getpid()}-{self.nfiles}.parquet'
+            filename = os.path.join(directory, basename)
+            # Readers must never see a partially written file; hidden files are ignored by the dataset.
+            tmpfilename = os.path.join(directory, f'.{basename}.tmp')
+            pq.write_table(pa.concat_tables(tables), tmpfilename, compression=self.compression)
+            os.replace(tmpfilename, filename)
+            self.nfiles += 1
+            _logger.debug(f"Wrote {len(tables)} matched catalogs to {filename}")
+        self.buffer = {}
+        self.nrows = 0
+
+    def close(self):
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def dataset(self):
+        return ds.dataset(self.rootdir, format='parquet', partitioning=ds.partitioning(PARTITIONING, flavor='hive'),
+                          filesystem=fs.LocalFileSystem(use_mmap=True), ignore_prefixes=['.', '_'])
+
+    @staticmethod
+    def selection(telescope=None, filter=None, start=None, end=None, sites=None):
+        """ Partition filter expression.
+
+        :param telescope: telescope id, e.g., lsc-domb-1m0a, or list of ids
+        :param filter: filter name or list of filter names
+        :param start: first night, as date or YYYYMMDD string
+        :param end: night after the last night, as date or YYYYMMDD string
+        :param sites: list of site codes
+        """
+        expression = None
+        conditions = []
+        for name, value in (('telescope', telescope), ('filter', filter)):
+            if isinstance(value, str):
+                conditions.append(ds.field(name) == value)
+            elif value is not None:
+                conditions.append(ds.field(name).isin(list(value)))
+        if sites is not None and len(sites) > 0:
+            sitecondition = None
+            for site in sites:
+                condition = pc.starts_with(ds.field('telescope'), pattern=f'{site}-')
+                sitecondition = condition if sitecondition is None else sitecondition | condition
+            conditions.append(sitecondition)
+        if start is not None:
+            conditions.append(ds.field('night') >= as_night(start))
+        if end is not None:
+            conditions.append(ds.field('night') < as_night(end))
+        for condition in conditions:
+            expression = condition if expression is None else expression & condition
+        return expression
+
+    def read(self, telescope=None, filter=None, start=None, end=None, sites=None, columns=None):
+        """ Read the stars of the selected partitions into one pyarrow table. """
+        return self.dataset().to_table(columns=columns, filter=self.selection(telescope, filter, start, end, sites))
+
+    def iter_tables(self, telescope=None, filter=None, start=None, end=None, sites=None, columns=None):
+        """ Stream the selected stars one file at a time, so the stars of a frame are always in the same table.
+
+        :return: iterator over pyarrow tables, with the partition keys as columns
+        """
+        expression = self.selection(telescope, filter, start, end, sites)
+        dataset = self.dataset()
+        for fragment in dataset.get_fragments(filter=expression):
+            table = fragment.to_table(schema=dataset.schema, columns=columns)
+            # partition keys are constant per file
+            keys = ds.get_partition_keys(fragment.partition_expression)
+            for name in PARTITIONING.names:
+                if (columns is None or name in columns) and name not in table.column_names:
+                    table = table.append_column(name, pa.array([keys[name]] * table.num_rows, type=pa.string()))
+            yield table
+
+
+def as_night(date):
+    if isinstance(date, (datetime.date, datetime.datetime)):
+        return date.strftime('%Y%m%d')
+    return str(date)
+
+
+def frame_offsets(table):
+    """ Frame names and offsets of the consecutive rows of each frame in a table read from the store.
+
+    :return: array of frame names, array of offsets of length number of frames + 1
+    """
+    names = table['name'].to_numpy(zero_copy_only=False)
+    if len(names) == 0:
+        return names, np.zeros(1, dtype=np.int64)
+    starts = np.flatnonzero(np.concatenate(([True], names[1:] != names[:-1])))
+    return names[starts], np.append(starts, len(names))
@@ -2,11 +2,18 @@ import astropy
 import matplotlib
 from scipy import optimize
 import numpy as np
+import longtermphotzp.diagnosticplots as diagnosticplots
 import longtermphotzp.es_aws_imagefinder as es_aws_imagefinder
+import longtermphotzp.httpsession as httpsession
+import longtermphotzp.matchedcatalogstore as matchedcatalogstore
+from longtermphotzp.matchedcatalogstore import frame_offsets
+import longtermphotzp.stagetimer as stagetimer
 from longtermphotzp.aperturephot import redoAperturePhotometry
 from longtermphotzp.aperturephot import getnewtargetlist
 from longtermphotzp.atlasrefcat2 import atlas_refcat2
-from longtermphotzp.photdbinterface import photdbinterface, PhotZPMeasurement
+from longtermphotzp.crossmatch import SkyMatcher
+from longtermphotzp.zpfit import robust_colorfit, robust_colorfit_batch
+from longtermphotzp.photdbinterface import photdbinterface, PhotZPMeasurement, PhotZPWriter
 from longtermphotzp.gaiaastrometryservicetools import astrometryServiceRefineWCSFromCatalog
 matplotlib.use('Agg')
 import matplotlib.pyplot as plt
@@ -17,6 +24,8 @@ plt.style.use('ggplot')
 
 import numpy as np
 import argparse
+import concurrent.futures
+import itertools
 import re
 import glob
 import os
@@ -25,8 +34,6 @@ import logging
 from astropy.io import fits
 from astropy.wcs import WCS
 from astropy.table import Table
-from astropy.coordinates import SkyCoord
-from astropy import units as u
 import datetime
 
 _logger = logging.getLogger(__name__)
@@ -40,8 +47,8 @@ class PhotCalib():
     # default and see where it goes.
     referencecatalog = None
 
-    def __init__(self, refcat2_url):
-        self.referencecatalog = atlas_refcat2(refcat2_url)
+    def __init__(self, refcat2_url, refcat2_cachedir=None, refcat2_cachesize=2 * 1024 ** 3):
+        self.referencecatalog = atlas_refcat2(refcat2_url, cachedir=refcat2_cachedir, cachesize=refcat2_cachesize)
 
     def do_stage(self, images):
         """ future hook for BANZAI pipeline integration
@@ -130,6 +137,9 @@ class PhotCalib():
         except Exception:
             _logger.exception("No extension \'CAT\' available, skipping.")
             return None
+        timer = stagetimer.get_timer()
+        timer.lap('catalog')
+        timer.annotate(nsources=len(instCatalog))
 
         # Transform the image catalog to RA / Dec based on the WCS solution in the header.
         # TODO: rerun astrometry.net with a higher order distortion model
@@ -143,29 +153,32 @@ class PhotCalib():
         except Exception:
             _logger.exception("Failed to convert images coordinates to world coordinates. Giving up on file.")
             return None
+        timer.lap('wcs')
 
         # if not 'magerr' in instCatalog.dtype.names:
         #     _logger.exception("magerr field is not defined. how strange. ")
         #     return None
 
         # Query reference catalog TODO: paramterize FoV of query!
-        refcatalog = self.referencecatalog.get_reference_catalog(ra, dec, 0.33, generateJohnson= ( retCatalog['instfilter'] in atlas_refcat2.JohnsonCousin_filters))
+        refcatalog = self.referencecatalog.get_reference_catalog(ra, dec, 0.33, bands=[referenceFilterName])
+        timer.lap('refcat')
         if (refcatalog is None):
             _logger.warning("no reference catalog received.")
             return None
+        timer.annotate(nreference=len(refcatalog))
 
-        # Start the catalog matching, using astropy skycoords built-in functions.
-        cInstrument = SkyCoord(ra=ras * u.degree, dec=decs * u.degree)
-        cReference = SkyCoord(ra=refcatalog['ra'] * u.degree, dec=refcatalog['dec'] * u.degree)
-        idx, d2d, d3d = cReference.match_to_catalog_sky(cInstrument)
+        if len(ras) == 0:
+            _logger.info("Image catalog is empty, nothing to match.")
+            return None
 
-        # Reshuffle the source catalog to index-match the reference catalog.
-        # There is probably as smarter way of doing this!
-        instCatalogT = np.transpose(instCatalog)[idx]
-        instCatalog = np.transpose(instCatalogT)
+        # Match each reference star to its nearest image source. This also gives the distance between the matched
+        # pairs, which is important to down-select viable pairs.
+        mutual = (args is not None) and getattr(args, 'mutualmatch', False)
+        matcher = SkyMatcher(ras, decs, ra0=ra, dec0=dec)
+        idx, distance = matcher.match(refcatalog['ra'], refcatalog['dec'], mutual=mutual)
 
-        # Measure the distance between matched pairs. Important to down-select viable pairs.
-        distance = cReference.separation(cInstrument[idx]).arcsecond
+        # Reshuffle the source catalog to index-match the reference catalog.
+        instCatalog = instCatalog[idx]
 
         # Define a reasonable condition on what is a good match on good photometry
         condition = (distance < 5) & (instCatalog['FLUX'] > 0) & (refcatalog[referenceFilterName] > 0) & (
@@ -190,6 +203,8 @@ class PhotCalib():
         retCatalog['x'] = instCatalog['x'][condition]
         retCatalog['y'] = instCatalog['y'][condition]
         retCatalog['peak'] = instCatalog['peak'][condition]
+        timer.lap('crossmatch')
+        timer.annotate(nmatched=len(retCatalog['ra']))
 
         return retCatalog
 
@@ -204,34 +219,41 @@ class PhotCalib():
 
 
     def robustfit (self, deltamag, refcol):
-        #Initial preselection based on absoute values
-        cond = (refcol > -0.5) & (refcol < 2.0) & (np.abs( (deltamag - np.median (deltamag))) < 5 * np.std (deltamag))
-        colorparams = np.polyfit(refcol[cond], deltamag[cond], 1)
-        color_p = np.poly1d(colorparams)
-        delta = deltamag - color_p(refcol)
-        cond = (refcol > -0.5) & (refcol < 3) & (np.abs (delta) < 0.5) & (np.abs (delta) < 1 * np.std (delta))
-        colorparams = np.polyfit(refcol[cond], deltamag[cond], 1)
-        color_p = np.poly1d(colorparams)
-
-        delta = deltamag - color_p(refcol)
-        cond = (refcol > -0.5) & (refcol < 3) & (np.abs (delta) < 0.5) & (np.abs (delta) < 1 * np.std (delta))
-        colorparams = np.polyfit(refcol[cond], deltamag[cond], 1)
-        color_p = np.poly1d(colorparams)
-
-        new_colorterm = colorparams[0]
-        new_zeropoint = colorparams[1]
-        new_std = np.std (  (deltamag - color_p(refcol))[cond] )
-        _logger.debug (f'Fit: zp = {new_zeropoint} color = {new_colorterm} rms = {new_std}')
-        return colorparams, cond
+        """ Robust fit of zeropoint and color term, see zpfit.robust_colorfit.
+
+        :return: [colorterm, zeropoint], and the boolean array of stars used in the fit
+        """
+        fit, cond = robust_colorfit(deltamag, refcol)
+        if not np.isfinite(fit['zp']):
+            raise ValueError("Color term fit failed")
+        return np.asarray([fit['colorterm'], fit['zp']]), cond
 
 
     def analyzeImage(self, imageentry, outputdb=None,
-                     outputimageRootDir=None, mintexp=60, useaws=False, args = None):
+                     outputimageRootDir=None, mintexp=60, useaws=False, args = None, imageobject=None,
+                     plotrenderer=None, matchedcatalogs=None):
         """
             Do full photometric zeropoint analysis on an image. This is the main entry point
 
             param image entry: Table row to contain 'filename' and 'frameid'
+            param imageobject: already opened (e.g., prefetched) HDUList of the image. If None, the image is loaded
+                               from the archive or the file system.
+            param plotrenderer: if not None, diagnostic plots are submitted to this renderer instead of being drawn
+                                inline, see diagnosticplots.DiagnosticPlotRenderer
+            param matchedcatalogs: if not None, the matched catalog of the image is added to this store, see
+                                   matchedcatalogstore.MatchedCatalogStore
         """
+        timer = stagetimer.get_timer()
+        timer.start_frame()
+        try:
+            return self._analyzeImage(imageentry, outputdb=outputdb, outputimageRootDir=outputimageRootDir,
+                                      mintexp=mintexp, useaws=useaws, args=args, imageobject=imageobject,
+                                      plotrenderer=plotrenderer, matchedcatalogs=matchedcatalogs)
+        finally:
+            timer.end_frame()
+
+    def _analyzeImage(self, imageentry, outputdb=None, outputimageRootDir=None, mintexp=60, useaws=False, args=None,
+                      imageobject=None, plotrenderer=None, matchedcatalogs=None):
 
         # The filename may or may not be the full path to the image
         if len(imageentry['filename']) > 0:
@@ -247,18 +269,27 @@ class PhotCalib():
             return
         imageName = os.path.basename(filename)
         _logger.info(f'\n\nImage {filename} {frameid} imageName for DB is {imageName}\n\n')
+        timer = stagetimer.get_timer()
+        timer.annotate(image=imageName)
 
-        # Read banzai star catalog
+        # Read banzai star catalog. Science pixels are only needed if we redo the source detection or photometry.
         try:
-            if useaws:
+            if imageobject is not None:
+                _logger.debug("Use already loaded image")
+            elif useaws:
                 _logger.debug("Use AWS")
-                imageobject = es_aws_imagefinder.download_from_archive(frameid)
+                imageobject = es_aws_imagefinder.download_from_archive(
+                    frameid, extensions=frame_extensions_needed(args),
+                    partial=(args is not None) and getattr(args, 'partialdownload', False))
             else:
                 _logger.info(f"Loading from file system: {filename}")
-                imageobject = fits.open(filename)
+                # HDUs are loaded lazily, and the fpacked science pixels are not decompressed unless they are accessed.
+                imageobject = fits.open(filename, memmap=True, lazy_load_hdus=True)
         except:
             _logger.warning(f"File {filename} could not be accessed: {sys.exc_info()[0]}")
             return 0, 0, 0
+        timer.lap('load')
+        timer.annotate(bytes=getattr(imageobject, 'downloaded_bytes', None))
 
         retCatalog = self.generateCrossmatchedCatalog(imageobject, mintexp=mintexp, args = args)
         imageobject.close()
@@ -271,128 +302,47 @@ class PhotCalib():
                 _logger.info(f"{imageentry}: Catalog returned, but is has less than 10 stars. Ignoring. ")
             return 0,0,0
 
+        if matchedcatalogs is not None:
+            try:
+                matchedcatalogs.addframe(matchedcatalogstore.make_frame(imageName, retCatalog))
+            except Exception:
+                _logger.exception(f"Could not store matched catalog of {imageName}")
+            timer.lap('store')
+
         # calculate the per star zeropoint
 
         magZP = retCatalog['refmag'] - retCatalog['instmag']
-        refmag = retCatalog['refmag']
         refcol = retCatalog['refcol']
 
-        # First guess
-        cleandata = self.reject_outliers(magZP, 3)
-        #firstguess_photzp = np.median(cleandata)
-        photzpsig = np.std(cleandata)
-
-        # calculate color term
-        try:
-
-            newcolorparam, new_cond = self.robustfit(magZP,refcol)
-            colorterm = newcolorparam[0]
-            photzp = newcolorparam[1]
-            color_p = np.poly1d(newcolorparam)
+        # zeropoint scatter and color term, in one pass over the per star zeropoints
+        select = select_stars_for_fit(retCatalog['refmag'], retCatalog['matchDistance'], args)
+        fit, cond = robust_colorfit(magZP[select], refcol[select], **fit_recipe_from_args(args))
+        new_cond = np.zeros(len(magZP), dtype=bool)
+        new_cond[select] = cond
+        photzpsig = fit['zpsig']
+        if np.isfinite(fit['zp']):
+            colorterm = fit['colorterm']
+            photzp = fit['zp']
             _logger.debug (f"New zeropoint, color term: {photzp}, {colorterm}")
-
-        except:
+        else:
             _logger.warning("could not fit a color term. ")
-            color_p = None
             colorterm = 0
             photzp = None
+        timer.lap('fit')
 
 
-        # if requested, generate all sorts of diagnostic plots
-        if (outputimageRootDir is not None) and (os.path.exists(outputimageRootDir)):
+        # if requested, generate diagnostic plots; rendered in the background if a plot renderer is given.
+        if (outputimageRootDir is not None) and (os.path.exists(outputimageRootDir)) and (photzp is not None):
             outbasename = os.path.basename(imageName)
             outbasename = re.sub('.fits.fz', '', outbasename)
-
-            ### Zeropoint plot
-            plt.figure()
-            plt.plot(refmag[~new_cond], (magZP - color_p(refcol) + photzp)[~new_cond], 'x', color='grey')
-            plt.plot(refmag[new_cond], (magZP - color_p(refcol)+photzp)[new_cond], '.', color='red')
-            plt.xlim([10, 22])
-            plt.ylim([photzp - 0.5, photzp + 0.5])
-            plt.axhline(y=photzp, color='r', linestyle='-')
-            plt.xlabel("Reference catalog mag")
-            plt.ylabel("Reference Mag - Instrumental Mag (%s)" % (retCatalog['instfilter']))
-            plt.title("Photometric zeropoint %s %5.2f" % (outbasename, photzp))
-            plt.savefig("%s/%s_%s_zp.png" % (outputimageRootDir, outbasename, retCatalog['instfilter']),
-                        bbox_inches='tight')
-            plt.close()
-
-            ### Plot Peak value vs absolute mag.
-            plt.figure()
-            plt.plot(refmag[new_cond], retCatalog['peak'][new_cond], '.', color='black')
-
-            plt.xlim([10, 20])
-            plt.ylim([0, retCatalog['saturate']])
-            plt.xlabel(f"Reference magnitude {retCatalog['reffilter']}")
-            plt.ylabel("Peak above background level [e-] (%s)" % (retCatalog['instfilter']))
-            plt.title(f"Peak {outbasename}, texp = {retCatalog['exptime']:6.2f} ")
-            #plt.savefig("%s/%s_%s_refmag_peak.png" % (outputimageRootDir, outbasename, retCatalog['instfilter']),
-            #            bbox_inches='tight')
-            plt.close()
-
-            ### Plot Counts value vs absolute mag.
-            plt.figure()
-            plt.plot(refmag[new_cond], retCatalog['instflux'][new_cond], '.', color='black')
-            plt.gca().ticklabel_format(useOffset=False, style='plain')
-            plt.xlim([5, 20])
-            #plt.ylim([0, retCatalog['saturate']])
-            plt.xlabel(f"Reference magnitude {retCatalog['reffilter']}")
-            plt.ylabel("Total counts from object  [e-] (%s)" % (retCatalog['instfilter']))
-            plt.title(f"Total Counts {outbasename}, texp = {retCatalog['exptime']:6.2f} ")
-            #plt.savefig("%s/%s_%s_refmag_counts.png" % (outputimageRootDir, outbasename, retCatalog['instfilter']),
-            #            bbox_inches='tight')
-            plt.close()
-
-
-
-
-            ### Color term plot
-            plt.figure()
-            plt.plot(refcol[~new_cond], magZP[~new_cond] , 'x',  color='grey')
-            plt.plot(refcol[new_cond], magZP[new_cond] , '.',  color='red')
-            plt.axhline(y=photzp, color='grey', linestyle='-', label=f"zeropoint {photzp:5.2f}")
-
-            if color_p is not None:
-                xp = np.linspace(-0.5, 3.5, 10)
-                plt.plot(xp, color_p(xp), '--', color='blue', label=f"color term {colorterm:5.3f}" )
-                plt.legend()
-
-            plt.xlim([-0.5, 3.0])
-            plt.ylim([photzp - 0.75, photzp + 0.75])
-            plt.xlabel("(g-i)$_{\\rm{SDSS}}$ Reference")
-            plt.ylabel("Reference Mag - Instrumental Mag  %s" % ( retCatalog['instfilter']))
-            plt.title(f"Color correction {outbasename}")
-            plt.savefig(f"{outputimageRootDir}/{outbasename}_{retCatalog['instfilter']}_color.png", bbox_inches='tight')
-            plt.close()
-
-            ### x/y/r variations in photometric zeropoint
-
-            plt.figure ()
-
-            residual = magZP[new_cond] - color_p (refcol[new_cond])
-            plt.subplot (3,1,1)
-            plt.plot (retCatalog['x'][new_cond], residual,'.')
-            plt.ylim([-0.2,0.2])
-            plt.ylabel ("\nCCD X")
-
-            plt.title("Residuals of zero point %s " % (outbasename))
-
-            plt.subplot (3,1,2)
-            plt.plot (retCatalog['y'][new_cond], residual,'.')
-            plt.ylim([-0.2,0.2])
-            plt.xlabel ("y coordinate [pixel]")
-            plt.ylabel (f'residual in {retCatalog["instfilter"]}[mag]\nCCD-Y')
-
-            plt.subplot (3,1,3)
-            plt.plot (np.sqrt (  (retCatalog['x'][new_cond]-1024) **2 + (retCatalog['x'][new_cond]-1024) **2), residual,'.')
-            plt.ylim([-0.2,0.2])
-            plt.xlabel ("coordinate [pixel]")
-            plt.ylabel (f'\nradial')
-
-
-            plt.savefig("%s/%s_%s_residuals.png" % (outputimageRootDir, outbasename, retCatalog['instfilter']), bbox_inches='tight')
-            plt.close()
-
+            plottypes = getattr(args, 'diagnosticplots', diagnosticplots.DEFAULT_PLOTTYPES)
+            payload = diagnosticplots.make_payload(retCatalog, magZP, new_cond, photzp, colorterm,
+                                                   outputimageRootDir, outbasename, plottypes=plottypes)
+            if plotrenderer is not None:
+                plotrenderer.submit(payload)
+            else:
+                diagnosticplots.render(payload)
+            timer.lap('plot')
 
         if (outputdb is not None):
             try:
@@ -404,6 +354,8 @@ class PhotCalib():
                 outputdb.addphotzp(m)
             except:
                 _logger.exception("Could not save output to database")
+            # Only queues the measurement with a PhotZPWriter; the write itself is timed as the 'db-flush' event.
+            timer.lap('db-queue')
 
         else:
             _logger.warning("Not saving output for image %s " % imageName)
@@ -411,37 +363,341 @@ class PhotCalib():
         return photzp, photzpsig, colorterm
 
 
+def fit_recipe_from_args(args):
+    """ Keyword arguments of zpfit.robust_colorfit for the --fit-* options that are set. """
+    recipe = {}
+    if args is None:
+        return recipe
+    for option, keyword in (('fit_colorrange', 'colorrange'), ('fit_refitcolorrange', 'refitcolorrange'),
+                            ('fit_presigma', 'presigma'), ('fit_sigma', 'sigma'), ('fit_maxresidual', 'maxresidual'),
+                            ('fit_niter', 'niter')):
+        value = getattr(args, option, None)
+        if value is not None:
+            recipe[keyword] = tuple(value) if isinstance(value, list) else value
+    return recipe
+
+
+def select_stars_for_fit(refmag, matchdistance, args):
+    """ Boolean array of the matched stars within --fit-maglimits and --fit-maxdistance. """
+    select = np.ones(len(refmag), dtype=bool)
+    maglimits = getattr(args, 'fit_maglimits', None)
+    if maglimits is not None:
+        select &= (refmag >= maglimits[0]) & (refmag <= maglimits[1])
+    maxdistance = getattr(args, 'fit_maxdistance', None)
+    if maxdistance is not None:
+        select &= matchdistance < maxdistance
+    return select
+
+
+def refit_daterange(args):
+    """ First night and the night after the last night of --date / --lastNdays, or None, None for all nights. """
+    if len(args.date) == 0:
+        return None, None
+    last = datetime.datetime.strptime(max(args.date), '%Y%m%d') + datetime.timedelta(days=1)
+    return min(args.date), last.strftime('%Y%m%d')
+
+
+def refit_matchedcatalogs(store, db, args):
+    """ Redo the zeropoint fits from the stored matched catalogs, and write the results to db.
+
+    Frames are selected by --date / --lastNdays, --site, --camera or --cameratype, and --filters; stars and the fit
+    follow the --fit-* options. Neither the archive nor the reference catalog are accessed. The stars of a store
+    file are fitted in one batch.
+
+    :param store: matchedcatalogstore.MatchedCatalogStore
+    :param db: photdbinterface or PhotZPWriter
+    :return: number of frames refitted
+    """
+    start, end = refit_daterange(args)
+    sites = args.site.split(',') if args.site is not None else None
+    recipe = fit_recipe_from_args(args)
+    columns = ['name', 'dateobs', 'camera', 'airmass', 'refmag', 'instmag', 'refcol', 'matchDistance', 'telescope',
+               'filter']
+    nframes = 0
+    for table in store.iter_tables(filter=args.filters, start=start, end=end, sites=sites, columns=columns):
+        camera = table['camera'].to_numpy(zero_copy_only=False).astype(str)
+        select = select_stars_for_fit(table['refmag'].to_numpy(), table['matchDistance'].to_numpy(), args)
+        if args.camera is not None:
+            select &= camera == args.camera
+        if args.cameratype is not None:
+            select &= np.char.startswith(camera, args.cameratype)
+        # Rows of a frame stay consecutive after the selection.
+        table = table.filter(select)
+        if table.num_rows == 0:
+            continue
+
+        names, offsets = frame_offsets(table)
+        refmag = table['refmag'].to_numpy().astype(np.float64)
+        instmag = table['instmag'].to_numpy().astype(np.float64)
+        refcol = table['refcol'].to_numpy().astype(np.float64)
+        fit, cond = robust_colorfit_batch(refmag - instmag, refcol, offsets, **recipe)
+
+        site, dome, telescope = table['telescope'][0].as_py().split('-')
+        filter = table['filter'][0].as_py()
+        first = offsets[:-1]
+        dateobs = table['dateobs'].to_numpy(zero_copy_only=False)[first]
+        camera = table['camera'].to_numpy(zero_copy_only=False)[first]
+        airmass = table['airmass'].to_numpy(zero_copy_only=False)[first]
+        for ii, name in enumerate(names):
+            if offsets[ii + 1] - offsets[ii] < 10:
+                _logger.info(f"{name}: less than 10 stars selected. Ignoring.")
+                continue
+            fitted = np.isfinite(fit['zp'][ii])
+            m = PhotZPMeasurement(name=name, dateobs=dateobs[ii].replace('T', ' '), site=site, dome=dome,
+                                  telescope=telescope, camera=camera[ii], filter=filter, airmass=float(airmass[ii]),
+                                  zp=float(fit['zp'][ii]) if fitted else None,
+                                  colorterm=float(fit['colorterm'][ii]) if fitted else 0,
+                                  zpsig=float(fit['zpsig'][ii]))
+            try:
+                db.addphotzp(m)
+            except Exception:
+                _logger.exception("Could not save output to database")
+            nframes += 1
+    _logger.info(f"Refitted {nframes} frames from matched catalogs in {store.rootdir}")
+    return nframes
+
+
+def photcalib_from_args(args):
+    return PhotCalib(args.refcat2_url, refcat2_cachedir=getattr(args, 'refcat2_cache', None),
+                     refcat2_cachesize=int(getattr(args, 'refcat2_cachesize', 2) * 1024 ** 3))
+
+
+def configure_http_from_args(args):
+    httpsession.configure(connect_timeout=getattr(args, 'http_connect_timeout', None),
+                          read_timeout=getattr(args, 'http_read_timeout', None),
+                          retries=getattr(args, 'http_retries', None))
+
+
+def frame_extensions_needed(args):
+    """ FITS extensions to load for the analysis, or None if the full frame including science pixels is needed. """
+    if (args is not None) and (args.fromraw or args.aperturephot):
+        return None
+    return ('SCI', 'CAT')
+
+
 def process_imagelist(inputlist: astropy.table.Table, db, args, rewritetoarchivename=True, inputlistIsArchiveID=False):
     """ Invoke the per image processing for a list of files, but check for duplication. """
     # get list of files of interest from OpenSearch
     initialsize = len(inputlist)
-    rejects = []
-    if not args.redo:
-        for image in inputlist['filename']:
-            if (db is not None) and db.exists(image):
-                rejects.append(image)
-
-        for r in rejects:
-            pass
-            # TODO: find out how to delete table entries that are duplicate
-            row = np.where(inputlist['filename'] == r)
-            if len(row) > 0:
-                row = row[0][0]
-                _logger.debug(f"remove duplicate from table: {r} at row {row}")
-                inputlist.remove_row(row)
-
-            # inputlist.remove(r)
+    if not args.redo and (db is not None) and (initialsize > 0):
+        # The database knows images by their file name without the path.
+        existing = db.existing_names([os.path.basename(str(image)) for image in inputlist['filename']])
+        if len(existing) > 0:
+            keep = np.asarray([os.path.basename(str(image)) not in existing for image in inputlist['filename']])
+            inputlist = inputlist[keep]
     _logger.info("Found %d files initially, but cleaned %d already measured images. Starting analysis of %d files" % (
-        initialsize, len(rejects), len(inputlist)))
+        initialsize, initialsize - len(inputlist), len(inputlist)))
+
+    images = [imageentry_for_analysis(image, args, rewritetoarchivename) for image in inputlist]
+    process_images(images, db, args)
+
 
-    photzpStage = PhotCalib(args.refcat2_url)
-    for image in inputlist:
-        if rewritetoarchivename:
-            fn = lcofilename_to_archivepath(image['filename'], args.rootdir)
-            image = Table(np.asarray([fn, image['frameid']]), names=['filename', 'frameid'])
+def process_framestream(frames, db, args, rewritetoarchivename=True, batchsize=500):
+    """ Invoke the per image processing for a stream of frame records, e.g., from
+    es_aws_imagefinder.iter_frames_for_photometry, as they arrive.
+
+    Already measured images are skipped, checked against the database in batches of batchsize frames.
+
+    :param frames: iterable of records with 'filename' and 'frameid'
+    """
+    images = (imageentry_for_analysis(frame, args, rewritetoarchivename)
+              for frame in deduplicated_frames(frames, db, args, batchsize=batchsize))
+    process_images(images, db, args)
+
+
+def deduplicated_frames(frames, db, args, batchsize=500):
+    """ Pass on the frames that do not have an entry in the database yet, or all frames with --redo. """
+    frames = iter(frames)
+    ntotal = nskipped = 0
+    while True:
+        batch = list(itertools.islice(frames, batchsize))
+        if len(batch) == 0:
+            break
+        ntotal += len(batch)
+        if not args.redo and (db is not None):
+            existing = db.existing_names([os.path.basename(str(frame['filename'])) for frame in batch])
+            nskipped += len(existing)
+            batch = [frame for frame in batch if os.path.basename(str(frame['filename'])) not in existing]
+        _logger.info(f"Frame stream: {ntotal} frames received, {nskipped} already measured")
+        yield from batch
+
+
+def process_images(images, db, args):
+    """ Analyse the images, serially or in a pool of workers, and write the results to db.
+
+    :param images: iterable of single row tables as made by imageentry_for_analysis
+    """
+    plotrenderer = make_plotrenderer(args)
+    matchedcatalogs = make_matchedcatalogstore(args)
+    # Results are written in batches instead of one commit per image.
+    writer = PhotZPWriter(db, batchsize=getattr(args, 'db_batchsize', 200),
+                          maxdelay=getattr(args, 'db_flushinterval', 60.)) if db is not None else None
+    try:
+        if getattr(args, 'workers', 1) > 1:
+            process_imagelist_parallel(images, writer, args, plotrenderer=plotrenderer,
+                                       matchedcatalogs=matchedcatalogs)
+        else:
+            process_imagelist_serial(images, writer, args, plotrenderer=plotrenderer,
+                                     matchedcatalogs=matchedcatalogs)
+    finally:
+        if plotrenderer is not None:
+            plotrenderer.close()
+        if matchedcatalogs is not None:
+            matchedcatalogs.close()
+        if writer is not None:
+            writer.close()
+
+
+def make_plotrenderer(args):
+    """ Background renderer for diagnostic plots, or None if plots are off or to be drawn inline. """
+    if (args.outputimageRootDir is None) or (getattr(args, 'plotworkers', 0) < 1):
+        return None
+    return diagnosticplots.DiagnosticPlotRenderer(workers=args.plotworkers)
+
+
+def make_matchedcatalogstore(args):
+    """ Store for the matched catalogs of the analysed images, or None if they are not kept. """
+    if getattr(args, 'matchedcatalogdir', None) is None:
+        return None
+    return matchedcatalogstore.MatchedCatalogStore(args.matchedcatalogdir)
+
+
+def process_imagelist_serial(images, db, args, plotrenderer=None, matchedcatalogs=None):
+    photzpStage = photcalib_from_args(args)
+    if args.useaws and getattr(args, 'prefetch', 0) > 0:
+        # Keep downloading the next frames while the current one is being analysed.
+        images, toprefetch = itertools.tee(images)
+        prefetched = es_aws_imagefinder.prefetch_from_archive((int(image['frameid'][0]) for image in toprefetch),
+                                                              depth=args.prefetch,
+                                                              extensions=frame_extensions_needed(args),
+                                                              partial=getattr(args, 'partialdownload', False))
+        for image, (frameid, imageobject) in zip(images, prefetched):
+            if imageobject is None:
+                _logger.warning(f"Frame {frameid} could not be downloaded, skipping.")
+                continue
+            _logger.info("processimagelist: send of to analyze image: \n{}".format(image))
+            photzpStage.analyzeImage(image, outputdb=db, outputimageRootDir=args.outputimageRootDir,
+                                     mintexp=args.mintexp, useaws=args.useaws, args=args, imageobject=imageobject,
+                                     plotrenderer=plotrenderer, matchedcatalogs=matchedcatalogs)
+            if db is not None:
+                db.flush_if_due()
+        return
+
+    for image in images:
         _logger.info("processimagelist: send of to analyze image: \n{}".format(image))
         photzpStage.analyzeImage(image, outputdb=db, outputimageRootDir=args.outputimageRootDir, mintexp=args.mintexp,
-                                 useaws=args.useaws, args=args)
+                                 useaws=args.useaws, args=args, plotrenderer=plotrenderer,
+                                 matchedcatalogs=matchedcatalogs)
+        if db is not None:
+            db.flush_if_due()
+
+
+def imageentry_for_analysis(image, args, rewritetoarchivename=True):
+    """ Turn a row of the input list into the single row table that analyzeImage expects. """
+    if rewritetoarchivename:
+        fn = lcofilename_to_archivepath(image['filename'], args.rootdir)
+        return Table(np.asarray([fn, image['frameid']]), names=['filename', 'frameid'])
+    return Table([[image['filename']], [image['frameid']]], names=['filename', 'frameid'])
+
+
+class MeasurementCollector:
+    """ Stand-in for a photdbinterface, a plot renderer, and a matched catalog store in pool workers: keeps
+    measurements, plot payloads, and matched catalogs instead of writing or rendering them.
+
+    The collected measurements are shipped back to the parent process, which is the only one writing to the database.
+    """
+
+    def __init__(self):
+        self.measurements = []
+        self.plotpayloads = []
+        self.frames = []
+
+    def addphotzp(self, photmeasurementObject, commit=True):
+        self.measurements.append(photmeasurementObject)
+
+    def submit(self, payload):
+        self.plotpayloads.append(payload)
+
+    def addframe(self, frame):
+        self.frames.append(frame)
+
+
+# Per worker process state, set up once by the pool initializer.
+_workerstage = None
+_workerargs = None
+
+
+def _init_worker(args):
+    global _workerstage, _workerargs
+    logging.basicConfig(level=getattr(logging, args.log_level.upper()),
+                        format='%(asctime)s.%(msecs).03d %(levelname)7s: %(module)20s: %(message)s')
+    _workerargs = args
+    configure_http_from_args(args)
+    stagetimer.configure(enabled=getattr(args, 'timing', False))
+    _workerstage = photcalib_from_args(args)
+
+
+def _analyze_in_worker(image):
+    collector = MeasurementCollector()
+    # Plots are rendered inline in the worker, unless there is a renderer pool in the parent.
+    plotrenderer = collector if getattr(_workerargs, 'plotworkers', 0) > 0 else None
+    matchedcatalogs = collector if getattr(_workerargs, 'matchedcatalogdir', None) is not None else None
+    _workerstage.analyzeImage(image, outputdb=collector, outputimageRootDir=_workerargs.outputimageRootDir,
+                              mintexp=_workerargs.mintexp, useaws=_workerargs.useaws, args=_workerargs,
+                              plotrenderer=plotrenderer, matchedcatalogs=matchedcatalogs)
+    httpsession.log_connection_statistics(level=logging.DEBUG)
+    return collector.measurements, collector.plotpayloads, collector.frames, stagetimer.get_timer().take_records()
+
+
+def process_imagelist_parallel(images, db, args, plotrenderer=None, matchedcatalogs=None):
+    """ Fan out the image analysis to a pool of worker processes.
+
+    Each worker holds its own PhotCalib stage; measurements are sent back and written by this process
+    through the single database connection db. Diagnostic plot payloads are passed on to plotrenderer, and matched
+    catalogs to the matchedcatalogs store.
+
+    images may be a stream; at most 2 * workers images are submitted to the pool ahead of their results.
+    """
+    _logger.info(f"Analysing images with {args.workers} worker processes")
+    images = iter(images)
+    with concurrent.futures.ProcessPoolExecutor(max_workers=args.workers, initializer=_init_worker,
+                                                initargs=(args,)) as executor:
+        futures = {}
+
+        def submit_next():
+            for image in images:
+                futures[executor.submit(_analyze_in_worker, image)] = image
+                return
+
+        for ii in range(2 * args.workers):
+            submit_next()
+
+        while futures:
+            done, _ = concurrent.futures.wait(futures, return_when=concurrent.futures.FIRST_COMPLETED)
+            future = done.pop()
+            image = futures.pop(future)
+            submit_next()
+            try:
+                measurements, plotpayloads, frames, timingrecords = future.result()
+            except Exception:
+                _logger.exception(f"Worker failed while analysing image {image['filename'][0]}")
+                continue
+            for record in timingrecords:
+                stagetimer.get_timer().add_record(record)
+            if plotrenderer is not None:
+                for payload in plotpayloads:
+                    plotrenderer.submit(payload)
+            if matchedcatalogs is not None:
+                for frame in frames:
+                    matchedcatalogs.addframe(frame)
+            if db is None:
+                continue
+            for m in measurements:
+                try:
+                    db.addphotzp(m)
+                except Exception:
+                    _logger.exception("Could not save output to database")
+            db.flush_if_due()
 
 
 def lcofilename_to_archivepath(filename, rootpath):
@@ -454,8 +710,10 @@ def lcofilename_to_archivepath(filename, rootpath):
     return "{}/{}/{}/{}/processed/{}".format(rootpath, site, camera, dateobs, filename)
 
 
-def parseCommandLine():
+def parseCommandLine(argv=None):
     """ Read command line parameters
+
+    :param argv: list of arguments to parse instead of sys.argv, e.g., for tests and benchmarks
     """
 
     parser = argparse.ArgumentParser(
@@ -464,21 +722,79 @@ def parseCommandLine():
     parser.add_argument('--log-level', dest='log_level', default='INFO', choices=['DEBUG', 'INFO'],
                         help='Set the log level')
     parser.add_argument('--refcat2-url', dest='refcat2_url', default='http://phot-catalog.lco.gtn/',
-                        help='URL of Atlas refcat2 catalog database')
+                        help='URL of Atlas refcat2 catalog service, sqlite:///path to a local refcat2 database, '
+                             'or healpix:///path to a HEALPix partitioned refcat2 store')
+    parser.add_argument('--refcat2-cache', dest='refcat2_cache', default=None,
+                        help='Directory of a persistent local cache of refcat2 catalog tiles. No caching if omitted.')
+    parser.add_argument('--refcat2-cachesize', dest='refcat2_cachesize', type=float, default=2,
+                        help='Size limit of the refcat2 cache in GB; least recently used tiles are evicted.')
     parser.add_argument("--diagnosticplotsdir", dest='outputimageRootDir', default=None,
-                        help='Output directory for diagnostic photometry plots. No plots generated if option is omitted. This is a time consuming task. ')
+                        help='Output directory for diagnostic photometry plots. No plots generated if option is omitted.')
+    parser.add_argument('--diagnosticplots', nargs='+', choices=diagnosticplots.PLOTTYPES,
+                        default=list(diagnosticplots.DEFAULT_PLOTTYPES),
+                        help='Types of diagnostic plots to generate with --diagnosticplotsdir')
+    parser.add_argument('--plotworkers', type=int, default=1,
+                        help='Number of background processes rendering diagnostic plots. 0 renders plots inline.')
+    parser.add_argument('--matchedcatalogdir', default=None,
+                        help='Directory of a Parquet store where the matched catalogs of all analysed images are kept '
+                             'for later reanalysis. Matched catalogs are not kept if option is omitted.')
+    parser.add_argument('--refit', action='store_true',
+                        help='Redo the zeropoint fits from the matched catalogs in --matchedcatalogdir and update the '
+                             'database, without accessing images or the reference catalog. Frames are selected by '
+                             '--date / --lastNdays, --site, --camera / --cameratype, and --filters.')
+    parser.add_argument('--fit-colorrange', dest='fit_colorrange', type=float, nargs=2, default=None,
+                        help='Range of reference (g-i) color of stars in the first fit pass. Default: -0.5 2.0')
+    parser.add_argument('--fit-refitcolorrange', dest='fit_refitcolorrange', type=float, nargs=2, default=None,
+                        help='Range of reference (g-i) color of stars in the later fit passes. Default: -0.5 3.0')
+    parser.add_argument('--fit-presigma', dest='fit_presigma', type=float, default=None,
+                        help='Outlier cut around the median zeropoint in the first fit pass, in std. Default: 5')
+    parser.add_argument('--fit-sigma', dest='fit_sigma', type=float, default=None,
+                        help='Outlier cut of fit residuals in the later fit passes, in std. Default: 1')
+    parser.add_argument('--fit-maxresidual', dest='fit_maxresidual', type=float, default=None,
+                        help='Largest fit residual in mag accepted in the later fit passes. Default: 0.5')
+    parser.add_argument('--fit-niter', dest='fit_niter', type=int, default=None,
+                        help='Number of fit passes. Default: 3')
+    parser.add_argument('--fit-maglimits', dest='fit_maglimits', type=float, nargs=2, default=None,
+                        help='Only fit stars with reference magnitudes within these limits')
+    parser.add_argument('--fit-maxdistance', dest='fit_maxdistance', type=float, default=None,
+                        help='Only fit stars matched within this distance [arcsec]. Matches are accepted up to 5 arcsec')
     parser.add_argument('--photodb', dest='imagedbPrefix', default=f'sqlite:///{os.path.expanduser("~/lcophotzp.db")}',
                         help='Result output directory. .db file is written here')
     parser.add_argument('--imagerootdir', dest='rootdir', default='/archive/engineering',
                         help="LCO archive root directory")
     parser.add_argument('--aperturephot' , nargs=3, type=float, help = "Force aperture phtoemtry with paramters obj aaoperture radius, inner and outer sky aperture radii")
     parser.add_argument('--fromraw', action='store_true', help="process e00 data from scratch")
+    parser.add_argument('--mutualmatch', action='store_true',
+                        help="Only accept reference / image source pairs that are mutual nearest neighbours")
     parser.add_argument('--site', dest='site', default=None, help='sites code for camera')
     parser.add_argument('--mintexp', dest='mintexp', default=10, type=float, help='Minimum exposure time to accept')
     parser.add_argument('--redo', action='store_true')
+    parser.add_argument('--db-batchsize', dest='db_batchsize', type=int, default=200,
+                        help='Number of measurements written to the database per transaction')
+    parser.add_argument('--db-flushinterval', dest='db_flushinterval', type=float, default=60,
+                        help='Write pending measurements to the database once the oldest has waited this many seconds; '
+                             'checked after each analysed image')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Number of worker processes to analyse images in parallel. Results are written to the database by the main process.')
     parser.add_argument('--preview', dest='processstatus', default='processed', action='store_const', const='preview')
     parser.add_argument('--useaws', action='store_true',
                         help="Use LCO archive API to retrieve frame vs direct /archive file mount access")
+    parser.add_argument('--partialdownload', action='store_true',
+                        help="With --useaws, only download the FITS headers and source catalog via HTTP range requests")
+    parser.add_argument('--prefetch', type=int, default=0,
+                        help="With --useaws, number of frames to download ahead of the analysis. 0 disables prefetching.")
+    parser.add_argument('--http-connect-timeout', dest='http_connect_timeout', type=float, default=10,
+                        help="Timeout in seconds to connect to the catalog, archive and astrometry services")
+    parser.add_argument('--http-read-timeout', dest='http_read_timeout', type=float, default=120,
+                        help="Timeout in seconds to wait for an answer from the catalog, archive and astrometry services")
+    parser.add_argument('--http-retries', dest='http_retries', type=int, default=3,
+                        help="Number of retries with backoff for failed connections and transient service errors")
+    parser.add_argument('--stream', action='store_true',
+                        help="Analyse frames as the archive query returns them, instead of querying for all frames first")
+    parser.add_argument('--timing', action='store_true',
+                        help="Time each stage of the analysis per frame, and print percentiles per stage at the end")
+    parser.add_argument('--timing-jsonl', dest='timing_jsonl', default=None,
+                        help="Append per frame stage timing records as JSON lines to this file. Implies --timing")
     parser.add_argument('--filters', default=['up', 'gp','rp','ip','zp', 'zs', 'Y', 'U', 'B', 'V', 'R', 'Rc', 'I'], nargs='+')
     mutex = parser.add_mutually_exclusive_group()
     mutex.add_argument('--date', dest='date', default=[], nargs='+', help='Specific date to process.')
@@ -491,7 +807,9 @@ def parseCommandLine():
     cameragroup.add_argument('--crawldirectory', default=None, type=str,
                              help="process all reduced image in specific directoy")
 
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
+    if args.refit and args.matchedcatalogdir is None:
+        parser.error("--refit requires --matchedcatalogdir")
 
     logging.basicConfig(level=getattr(logging, args.log_level.upper()),
                         format='%(asctime)s.%(msecs).03d %(levelname)7s: %(module)20s: %(message)s')
@@ -515,49 +833,49 @@ def parseCommandLine():
 
 def photzpmain():
     args = parseCommandLine()
+    configure_http_from_args(args)
+    timer = stagetimer.configure(enabled=args.timing, jsonlfile=args.timing_jsonl)
+
+    if args.refit:
+        imagedb = photdbinterface(args.imagedbPrefix)
+        with PhotZPWriter(imagedb, batchsize=args.db_batchsize, maxdelay=args.db_flushinterval) as writer:
+            refit_matchedcatalogs(matchedcatalogstore.MatchedCatalogStore(args.matchedcatalogdir), writer, args)
+        imagedb.close()
+        sys.exit(0)
 
     if args.site is not None:
         sites = [site for site in args.site.split(',')]
     else:
         sites = ('lsc', 'cpt', 'ogg', 'coj', 'tfn', 'elp')
 
-    _logger.info('DATES: ', args.date)
-    for date in args.date:
-        _logger.info(f"Processing DAY-OBS {date}")
-        if args.cameratype is not None:
-            # crawl by camera type
-            cameratypes = [x for x in args.cameratype.split(',')]
-            for site in sites:
-                for cameratype in cameratypes:
-                    inputlist = es_aws_imagefinder.get_frames_for_photometry(date, site, cameratype=cameratype,
-                                                                             mintexp=args.mintexp, filterlist=args.filters)
-                    if inputlist is None:
-                        _logger.info(f"None list returned for date {date}. Nothing to do here.")
-                        continue
-                    imagedb = photdbinterface(args.imagedbPrefix)
-                    _logger.info(f"Processing image list N={len(inputlist)} for type {cameratype} at site  {site} for date {date}")
-                    process_imagelist(inputlist, imagedb, args)
-                    if imagedb is not None:
-                        imagedb.close()
-
-        elif args.camera is not None:
-            # crawl for a specific camera
-            inputlist = es_aws_imagefinder.get_frames_for_photometry(date, site=None, camera=args.camera,
-                                                                     mintexp=args.mintexp,filterlist=args.filters)
-            if inputlist is None:
-                _logger.info(f"None list returned for date {date}. Nothing to do here.")
-                continue
-            _logger.info(
-                f"Processing image list N={len(inputlist)} for camera {args.camera} at for date {date}")
-            imagedb = photdbinterface(args.imagedbPrefix)
-            process_imagelist(inputlist, imagedb, args)
-            if imagedb is not None:
-                imagedb.close()
-
-
-
+    _logger.info(f"DATES: {args.date}")
+    if len(args.date) > 0 and (args.cameratype is not None or args.camera is not None):
+        # One query for all nights, and sites and camera types, or for a specific camera at any site.
+        cameratypes = args.cameratype.split(',') if args.cameratype is not None else None
+        query = dict(sites=sites if args.camera is None else None, cameratypes=cameratypes, camera=args.camera,
+                     mintexp=args.mintexp, filterlist=args.filters)
+        imagedb = photdbinterface(args.imagedbPrefix)
+        if args.stream:
+            frames = es_aws_imagefinder.iter_frames_for_photometry(min(args.date), max(args.date), **query)
+            # --date may list nights that are not contiguous.
+            process_framestream((frame for frame in frames if frame['dayobs'] in args.date), imagedb, args)
         else:
-            print("Need to specify either a camera, or a camera type.")
+            inputlist = es_aws_imagefinder.get_frames_for_photometry_daterange(min(args.date), max(args.date), **query)
+            if inputlist is not None:
+                # --date may list nights that are not contiguous.
+                inputlist = inputlist[np.isin(inputlist['dayobs'], args.date)]
+            if (inputlist is None) or (len(inputlist) == 0):
+                _logger.info(f"No frames returned for dates {args.date}. Nothing to do here.")
+            else:
+                for (date,), frames in es_aws_imagefinder.group_frames(inputlist, keys=('dayobs',)):
+                    _logger.info(f"Image list N={len(frames)} for date {date} at sites {sorted(set(frames['site']))}")
+                # All nights go through one worker pool, database writer and plot renderer, night by night.
+                inputlist = inputlist[np.argsort(inputlist['dayobs'], kind='stable')]
+                process_imagelist(inputlist, imagedb, args)
+        imagedb.close()
+    elif len(args.date) > 0:
+        print("Need to specify either a camera, or a camera type.")
+
     if args.crawldirectory is not None:
         # Crawl files in a local directory
         print(f"Not tested {args.crawldirectory}")
@@ -570,6 +888,10 @@ def photzpmain():
         if imagedb is not None:
             imagedb.close()
 
+    httpsession.log_connection_statistics()
+    if args.timing or args.timing_jsonl is not None:
+        print(timer.format_summary())
+    timer.close()
     sys.exit(0)
 
 
@@ -5,12 +5,17 @@ import numpy as np
 from astropy.table import Table
 import astropy.time as astt
 import math
+import time
+import warnings
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy_utils import database_exists, create_database
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy import Column, Integer, String, Float, create_engine
+from sqlalchemy import Column, Integer, String, Float, create_engine, insert, select
+from sqlalchemy.dialects import postgresql
 import os
 
+from longtermphotzp import stagetimer
+
 assert sys.version_info >= (3, 5)
 _logger = logging.getLogger(__name__)
 
@@ -110,6 +115,18 @@ class photdbinterface:
         """
         return self.session.query(PhotZPMeasurement).filter_by(name=filename).first()
 
+    def existing_names(self, names, chunksize=500):
+        """ Return the set of names from the list that already have an entry in the database.
+
+        Lookups are done in chunks of IN (...) queries instead of one query per name.
+        """
+        names = list(set(str(name) for name in names))
+        existing = set()
+        for ii in range(0, len(names), chunksize):
+            q = self.session.query(PhotZPMeasurement.name).filter(PhotZPMeasurement.name.in_(names[ii:ii + chunksize]))
+            existing.update(e.name for e in q.all())
+        return existing
+
     def close(self):
         """ Close the database safely"""
         _logger.info("Closing data base session")
@@ -118,80 +135,65 @@ class photdbinterface:
     def readRecords(self, site=None, dome=None, telescope=None, camera=None, filter = None):
         """  Read the photometry records from the database, optionally filtered by site, dome, telescope, and camera.
 
+        :return: astropy Table with dateobs as datetime, or None if there are no records; see readRecordArrays.
         """
+        records = self.readRecordArrays(site, dome, telescope, camera, filter=filter)
+        if len(records) == 0:
+            return None
+
+        _logger.info (f"Filter set:  {set (records.categories['filter'].tolist())}")
+        _logger.info (f"Camera set:  {set (records.categories['camera'].tolist())}")
+        return records.to_table()
+
+    def readRecordArrays(self, site=None, dome=None, telescope=None, camera=None, filter=None, chunksize=100000):
+        """ Read the photometry records into typed numpy arrays, with the same selection as readRecords.
+
+        Rows are fetched with a Core select in chunks of chunksize rows, and each chunk is converted to arrays right
+        away, so no ORM objects or intermediate string arrays are built. Zeropoints are corrected for known wrong
+        camera gains, see applygaincorrections.
 
-        q = self.session.query(PhotZPMeasurement)
+        :return: PhotZPRecordArrays
+        """
+        c = PhotZPMeasurement.__table__.c
+        q = select(*[c[name] for name in PhotZPRecordArrays.COLUMNS])
         if site is not None:
-            q = q.filter(PhotZPMeasurement.site == site)
+            q = q.where(c.site == site)
         if dome is not None:
-            q = q.filter(PhotZPMeasurement.dome == dome)
+            q = q.where(c.dome == dome)
         if telescope is not None:
-            q = q.filter(PhotZPMeasurement.telescope == telescope)
+            q = q.where(c.telescope == telescope)
         if camera is not None:
-            q = q.filter(PhotZPMeasurement.camera == camera)
+            q = q.where(c.camera == camera)
         if filter is not None:
-            q = q.filter(PhotZPMeasurement.filter.in_(filter))
-
-        # TODO: This might consume too much memory.
-        allrows = [
-            [e.name, e.dateobs, e.site, e.dome, e.telescope, e.camera, e.filter, e.airmass, e.zp, e.colorterm, e.zpsig]
-            for e in q.all()]
-
-        if len(allrows) == 0:
-            return None
-        allrows = np.asarray(allrows)
-
-        t = Table(allrows, names=['name', 'dateobs', 'site', 'dome', 'telescope', 'camera', 'filter', 'airmass', 'zp',
-                                  'colorterm', 'zpsig'])
-        t['dateobs'] = t['dateobs'].astype(str)
-        t['dateobs'] = astt.Time(t['dateobs'], scale='utc', format=None).to_datetime()
-        t['zp'] = t['zp'].astype(float)
-        t['airmass']['UNKNOWN' == t['airmass']] = 'nan'
-        t['airmass'] = t['airmass'].astype(float)
-        t['zpsig'] = t['zpsig'].astype(float)
-        t['colorterm'] = t['colorterm'].astype(float)
-
-
-        _logger.info (f"Filter set:  {set (t['filter'])}")
-        _logger.info (f"Camera set:  {set (t['camera'])}")
-
-        if 'fl06' in t['camera']:
-            # fl06 was misconfigured with a wrong gain, which trickles down through the banzai processing.
-            # The correct gain was validated Nov 27th 2017 on existing data.
-            dateselect = (t['dateobs'] < datetime.datetime(year=2017, month=11, day=17)) & (t['camera'] == 'fl06')
-            t['zp'][dateselect] = t['zp'][dateselect] - 2.5 * math.log10(1.82 / 2.45)
-
-        if 'fl05' in t['camera']:
-            # fl06 was misconfigured with a wrong gain, which trickles down through the banzai processing.
-            # The correct gain was validated Nov 27th 2017 on existing data.
-            dateselect = (t['camera'] == 'fl05')
-            t['zp'][dateselect] = t['zp'][dateselect] - 2.5 * math.log10(1.69 / 2.09)
-
-        if 'fl11' in t['camera']:
-            #
-            dateselect = (t['camera'] == 'fl11')
-            t['zp'][dateselect] = t['zp'][dateselect] - 2.5 * math.log10(1.85 / 2.16)
-
-        if 'kb96' in t['camera']:
-            dateselect = (t['dateobs'] > datetime.datetime(year=2017, month=11, day=15)) & (
-                    t['dateobs'] < datetime.datetime(year=2018, month=4, day=10)) & (t['camera'] == 'kb96')
-            t['zp'][dateselect] = t['zp'][dateselect] - 2.5 * math.log10(0.851 / 2.74)
-
-        if 'kb95' in t['camera']:
-            dateselect = (t['dateobs'] > datetime.datetime(year=2018, month=9, day=18)) & (t['camera'] == 'kb95')
-            t['zp'][dateselect] = t['zp'][dateselect] - 2.5 * math.log10(2.75 / 1.6)
-
-        if 'fs02' in t['camera']:
-            # https://github.com/LCOGT/site-configuration/commit/26d03f28868579d49dcc5e5e4e6a6650651ae72c
-            dateselect = (t['dateobs'] < datetime.datetime(year=2019, month=3, day=12)) & (t['camera'] == 'fs02')
-            t['zp'][dateselect] = t['zp'][dateselect] - 2.5 * math.log10(8.09 / 7.7)
-
-        if 'fs01' in t['camera']:
-            # https://github.com/LCOGT/site-configuration/commit/26d03f28868579d49dcc5e5e4e6a6650651ae72c
-            dateselect = (t['dateobs'] < datetime.datetime(year=2019, month=3, day=12)) & (t['camera'] == 'fs01')
-            t['zp'][dateselect] = t['zp'][dateselect] - 2.5 * math.log10(8.14 / 7.7)
-
-        return t
+            q = q.where(c.filter.in_(filter))
+
+        chunks = {name: [] for name in PhotZPRecordArrays.COLUMNS}
+        lookups = {name: {} for name in PhotZPRecordArrays.CATEGORICAL}
+        result = self.session.execute(q.execution_options(yield_per=chunksize))
+        for rows in result.partitions():
+            values = dict(zip(PhotZPRecordArrays.COLUMNS, zip(*rows)))
+            chunks['name'].append(np.asarray(values['name'], dtype=str))
+            chunks['dateobs'].append(_datetime64array(values['dateobs']))
+            for name in PhotZPRecordArrays.FLOAT:
+                chunks[name].append(_floatarray(values[name]))
+            for name in PhotZPRecordArrays.CATEGORICAL:
+                lookup = lookups[name]
+                chunks[name].append(np.fromiter((lookup.setdefault(v, len(lookup)) for v in values[name]),
+                                                dtype=np.int32, count=len(rows)))
+        result.close()
+
+        empty = {'name': np.zeros(0, dtype=str), 'dateobs': np.zeros(0, dtype='datetime64[us]')}
+        columns = {}
+        for name in PhotZPRecordArrays.COLUMNS:
+            if len(chunks[name]) > 0:
+                columns[name] = np.concatenate(chunks[name])
+            else:
+                columns[name] = empty.get(name, np.zeros(0, dtype=np.int32 if name in lookups else np.float64))
+        categories = {name: np.asarray(['' if v is None else v for v in lookup], dtype=str)
+                      for name, lookup in lookups.items()}
+        records = PhotZPRecordArrays(columns, categories)
+        applygaincorrections(records)
+        return records
 
     def readmirrormodel(self, telescopeid, filter):
         """ read a mirrormodel by telesope identifer and filter .
@@ -250,6 +252,205 @@ class photdbinterface:
         return allrows
 
 
+class PhotZPRecordArrays:
+    ''' Photometry records as typed numpy arrays, as read by photdbinterface.readRecordArrays.
+
+    dateobs is datetime64[us], airmass, zp, colorterm, and zpsig are float64, with NaN for missing values. site, dome,
+    telescope, camera, and filter are categorical: int32 codes into the array of names categories[column]. Use
+    decoded(column) for an array of names.
+    '''
+
+    COLUMNS = ('name', 'dateobs', 'site', 'dome', 'telescope', 'camera', 'filter', 'airmass', 'zp', 'colorterm',
+               'zpsig')
+    CATEGORICAL = ('site', 'dome', 'telescope', 'camera', 'filter')
+    FLOAT = ('airmass', 'zp', 'colorterm', 'zpsig')
+
+    def __init__(self, columns, categories):
+        self.columns = columns
+        self.categories = categories
+
+    def __len__(self):
+        return len(self.columns['name'])
+
+    def __getitem__(self, name):
+        return self.columns[name]
+
+    def code(self, column, value):
+        """ Code of a category name, or -1 if there is no such category. """
+        matches = np.flatnonzero(self.categories[column] == value)
+        return matches[0] if len(matches) > 0 else -1
+
+    def decoded(self, column):
+        return self.categories[column][self.columns[column]]
+
+    def to_table(self):
+        """ The records as an astropy Table, with names instead of codes, and dateobs as datetime objects. """
+        t = Table()
+        for name in self.COLUMNS:
+            if name in self.CATEGORICAL:
+                t[name] = self.decoded(name)
+            elif name == 'dateobs':
+                t[name] = self.columns[name].astype(datetime.datetime)
+            else:
+                t[name] = self.columns[name]
+        return t
+
+
+# Zeropoint corrections for cameras that were misconfigured with a wrong gain, which trickles down through the banzai
+# processing: camera, exposures after, exposures before, gain ratio. The zeropoint of affected exposures is corrected by
+# -2.5 log10(ratio).
+GAINCORRECTIONS = [
+    # The correct gain of fl06 was validated Nov 27th 2017 on existing data.
+    ('fl06', None, datetime.datetime(year=2017, month=11, day=17), 1.82 / 2.45),
+    ('fl05', None, None, 1.69 / 2.09),
+    ('fl11', None, None, 1.85 / 2.16),
+    ('kb96', datetime.datetime(year=2017, month=11, day=15), datetime.datetime(year=2018, month=4, day=10),
+     0.851 / 2.74),
+    ('kb95', datetime.datetime(year=2018, month=9, day=18), None, 2.75 / 1.6),
+    # https://github.com/LCOGT/site-configuration/commit/26d03f28868579d49dcc5e5e4e6a6650651ae72c
+    ('fs02', None, datetime.datetime(year=2019, month=3, day=12), 8.09 / 7.7),
+    ('fs01', None, datetime.datetime(year=2019, month=3, day=12), 8.14 / 7.7),
+]
+
+
+def applygaincorrections(records):
+    """ Correct the zeropoints of PhotZPRecordArrays in place for the GAINCORRECTIONS. """
+    for camera, after, before, ratio in GAINCORRECTIONS:
+        code = records.code('camera', camera)
+        if code < 0:
+            continue
+        dateselect = records['camera'] == code
+        if after is not None:
+            dateselect &= records['dateobs'] > np.datetime64(after, 'us')
+        if before is not None:
+            dateselect &= records['dateobs'] < np.datetime64(before, 'us')
+        records['zp'][dateselect] = records['zp'][dateselect] - 2.5 * math.log10(ratio)
+
+
+def _datetime64array(values):
+    """ Parse date strings to datetime64[us], with astropy Time for formats numpy does not read. """
+    try:
+        with warnings.catch_warnings():
+            # numpy only warns about time zone designators
+            warnings.simplefilter('error')
+            return np.array(values, dtype='datetime64[us]')
+    except (ValueError, TypeError, UserWarning, DeprecationWarning):
+        dates = astt.Time([str(v) for v in values], scale='utc', format=None).to_datetime()
+        return np.array(dates, dtype='datetime64[us]')
+
+
+def _floatarray(values):
+    """ float64 array, with NaN for missing values and entries that are not numbers, such as 'UNKNOWN' air masses. """
+    try:
+        return np.array(values, dtype=np.float64)
+    except (ValueError, TypeError):
+        result = np.full(len(values), np.nan)
+        for ii, v in enumerate(values):
+            try:
+                result[ii] = float(v)
+            except (ValueError, TypeError):
+                pass
+        return result
+
+
+class PhotZPWriter:
+    ''' Buffered bulk writer of PhotZPMeasurement records into a photdbinterface.
+
+    Measurements are accumulated and written in one transaction per batch with a native upsert: INSERT ... ON CONFLICT
+    (name) DO UPDATE on Postgres, INSERT OR REPLACE on sqlite. An existing entry of the same image name is replaced.
+    Other databases fall back to a merge per record, still with one commit per batch.
+
+    A batch is written when batchsize measurements are pending, on flush() or close(), and on flush_if_due() or
+    addphotzp() once the oldest pending measurement is older than maxdelay seconds. There is no timer; callers that
+    produce measurements slowly should call flush_if_due() between frames. If a batch fails, its measurements are
+    written one by one, so only the failing ones are lost. The writer can be used as a context manager, and as
+    stand-in for the photdbinterface where only addphotzp is needed.
+    '''
+
+    def __init__(self, db, batchsize=200, maxdelay=60.):
+        self.db = db
+        self.batchsize = batchsize
+        self.maxdelay = maxdelay
+        # keyed by image name, so a remeasured image within a batch is written only once, last one wins.
+        self.pending = {}
+        self.oldest = None
+        self.nwritten = 0
+        self.dialect = db.session.get_bind().dialect.name
+        self.columns = [c.name for c in PhotZPMeasurement.__table__.columns]
+
+    def addphotzp(self, photmeasurementObject, commit=True):
+        """ Queue a measurement. commit is accepted for compatibility with photdbinterface.addphotzp. """
+        _logger.debug("Queue: %s" % str(photmeasurementObject))
+        if self.oldest is None:
+            self.oldest = time.monotonic()
+        self.pending[photmeasurementObject.name] = {c: getattr(photmeasurementObject, c) for c in self.columns}
+        if len(self.pending) >= self.batchsize:
+            self.flush()
+        else:
+            self.flush_if_due()
+
+    def flush_if_due(self):
+        """ Write the pending measurements if the oldest one has been waiting for more than maxdelay seconds. """
+        if (self.oldest is not None) and (time.monotonic() - self.oldest > self.maxdelay):
+            self.flush()
+
+    def upsert_statement(self):
+        table = PhotZPMeasurement.__table__
+        if self.dialect == 'postgresql':
+            stmt = postgresql.insert(table)
+            return stmt.on_conflict_do_update(index_elements=[table.c.name],
+                                              set_={c: stmt.excluded[c] for c in self.columns if c != 'name'})
+        if self.dialect == 'sqlite':
+            return insert(table).prefix_with('OR REPLACE')
+        return None
+
+    def flush(self):
+        """ Write all pending measurements in one transaction. """
+        if len(self.pending) == 0:
+            return
+        rows = list(self.pending.values())
+        _logger.info(f"Writing {len(rows)} photometric zeropoint measurements to database")
+        start = time.perf_counter()
+        try:
+            stmt = self.upsert_statement()
+            if stmt is not None:
+                self.db.session.execute(stmt, rows)
+            else:
+                for row in rows:
+                    self.db.session.merge(PhotZPMeasurement(**row))
+            self.db.session.commit()
+        except Exception:
+            _logger.exception(f"Could not write batch of {len(rows)} measurements to database, writing one by one")
+            self.db.session.rollback()
+            self.write_singly(rows)
+        else:
+            self.nwritten += len(rows)
+        self.pending = {}
+        self.oldest = None
+        stagetimer.get_timer().event('db-flush', time.perf_counter() - start, nrows=len(rows))
+
+    def write_singly(self, rows):
+        """ Merge and commit each row on its own, logging the ones that fail. """
+        for row in rows:
+            try:
+                self.db.session.merge(PhotZPMeasurement(**row))
+                self.db.session.commit()
+            except Exception:
+                _logger.exception(f"Could not save {row['name']} to database")
+                self.db.session.rollback()
+            else:
+                self.nwritten += 1
+
+    def close(self):
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
 if __name__ == '__main__':
     # some testing code that should be modified and migrated into the test suite.
     logging.basicConfig(level=getattr(logging, 'DEBUG'),
@@ -0,0 +1,125 @@
+'''
+Backends that serve cone searches into the Atlas refcat2 catalog for atlas_refcat2.
+
+All backends return an astropy Table with the same float32 column layout as the refcat2 web service; the PS1 to
+SDSS transformation is applied by atlas_refcat2 on top of this.
+
+Backends are selected by the scheme of the catalog url:
+    http://, https://   refcat2 web service, e.g., http://phot-catalog.lco.gtn/
+    sqlite:///path      sqlite database with R-tree index as created by refcat2tools/refcat2csv2sqlite.py
+    healpix:///path     memory mapped HEALPix partitioned store, see longtermphotzp/refcat2healpix.py
+'''
+import logging
+import math
+import os
+import sqlite3
+
+import numpy as np
+from astropy.table import Table
+
+from longtermphotzp.crossmatch import angular_separation
+from longtermphotzp.httpsession import get_session
+
+_logger = logging.getLogger(__name__)
+
+# refcat2 database column -> column name as delivered to atlas_refcat2
+REFCAT2_COLUMNS = {'RA': 'ra', 'Dec': 'dec', 'pmra': 'pmra', 'pmdec': 'pmdec',
+                   'g': 'gmag', 'dg': 'gmagerr', 'r': 'rmag', 'dr': 'rmagerr',
+                   'i': 'imag', 'di': 'imagerr', 'z': 'zmag', 'dz': 'zmagerr'}
+
+
+def ra_ranges_for_cone(ra, dec, radius):
+    """ Right ascension intervals that contain a cone, split at the 0/360 wrap. """
+    if (dec + radius >= 90.) or (dec - radius <= -90.) or \
+            (math.sin(math.radians(radius)) >= math.cos(math.radians(dec))):
+        return [(0., 360.)]
+    deltara = math.degrees(math.asin(math.sin(math.radians(radius)) / math.cos(math.radians(dec))))
+    ra = ra % 360.
+    if ra - deltara < 0:
+        return [(ra - deltara + 360., 360.), (0., ra + deltara)]
+    if ra + deltara > 360.:
+        return [(ra - deltara, 360.), (0., ra + deltara - 360.)]
+    return [(ra - deltara, ra + deltara)]
+
+
+class Refcat2ServiceBackend:
+    ''' Cone searches via the refcat2 web service. '''
+
+    def __init__(self, url):
+        self.url = url
+
+    def query(self, ra, dec, radius):
+        response = get_session().get(self.url + 'radius', params={'ra': ra, 'dec': dec, 'radius': radius})
+        response.raise_for_status()
+
+        dtype = [np.float32] * 12
+        return Table(response.json(), dtype=dtype)
+
+
+class Refcat2SqliteBackend:
+    ''' In-process cone searches in a refcat2 sqlite database, using its R-tree positions index.
+
+    The database is opened read-only, and one connection is kept per process.
+    '''
+
+    def __init__(self, url):
+        self.filename = os.path.expanduser(url[len('sqlite:///'):])
+        if not os.path.exists(self.filename):
+            raise FileNotFoundError(f"refcat2 database {self.filename} does not exist")
+        self.connection = None
+        self.pid = None
+        columns = ', '.join(f's.{column}' for column in REFCAT2_COLUMNS)
+        self.sql = f'SELECT {columns} FROM positions p JOIN sources s ON s.objid = p.objid ' \
+                   f'WHERE p.ramax >= ? AND p.ramin <= ? AND p.decmax >= ? AND p.decmin <= ?'
+
+    def connect(self):
+        if (self.connection is None) or (self.pid != os.getpid()):
+            _logger.info(f"Opening refcat2 database {self.filename}")
+            self.connection = sqlite3.connect(f'file:{self.filename}?mode=ro', uri=True, check_same_thread=False)
+            self.pid = os.getpid()
+        return self.connection
+
+    def query(self, ra, dec, radius):
+        connection = self.connect()
+        decmin = max(-90., dec - radius)
+        decmax = min(90., dec + radius)
+        rows = []
+        for ramin, ramax in ra_ranges_for_cone(ra, dec, radius):
+            rows.extend(connection.execute(self.sql, (ramin, ramax, decmin, decmax)).fetchall())
+
+        data = np.asarray(rows, dtype=np.float64).reshape(-1, len(REFCAT2_COLUMNS))
+        incone = angular_separation(ra, dec, data[:, 0], data[:, 1]) <= radius
+        data = data[incone]
+        return Table([data[:, ii].astype(np.float32) for ii in range(len(REFCAT2_COLUMNS))],
+                     names=list(REFCAT2_COLUMNS.values()))
+
+
+def make_backend(url):
+    """ Create the catalog backend matching the url scheme. """
+    if url.startswith('sqlite:///'):
+        return Refcat2SqliteBackend(url)
+    if url.startswith('healpix:///'):
+        from longtermphotzp.refcat2healpix import Refcat2HealpixBackend
+        return Refcat2HealpixBackend(url)
+    return Refcat2ServiceBackend(url)
+
+
+def write_refcat2_sqlite(filename, table):
+    """ Write a (small) refcat2 sqlite database with the same schema as refcat2tools/refcat2csv2sqlite.py.
+
+    Meant for test fixtures and local stand-ins of the catalog service.
+
+    :param table: astropy Table with columns as delivered by the backends (ra, dec, gmag, gmagerr, ...)
+    """
+    connection = sqlite3.connect(filename)
+    fields = ', '.join(f'{column} FLOAT' for column in REFCAT2_COLUMNS)
+    connection.execute(f'CREATE TABLE IF NOT EXISTS sources (objid INTEGER NOT NULL PRIMARY KEY, {fields});')
+    rows = [[ii] + [float(table[name][ii]) for name in REFCAT2_COLUMNS.values()] for ii in range(len(table))]
+    connection.executemany(f"insert into sources (objid, {', '.join(REFCAT2_COLUMNS)}) values "
+                           f"({', '.join('?' * (len(REFCAT2_COLUMNS) + 1))})", rows)
+    connection.execute(
+        'CREATE VIRTUAL TABLE if not exists positions using rtree(objid, ramin, ramax, decmin, decmax);')
+    connection.execute(
+        'insert into positions (objid, ramin, ramax, decmin, decmax) select objid, RA, RA, Dec, Dec from sources;')
+    connection.commit()
+    connection.close()
@@ -0,0 +1,232 @@
+'''
+Persistent on-disk cache of reference catalog rows, partitioned into sky tiles.
+
+The sky is divided into declination bands of fixed height, and each band into right ascension tiles of about the
+same width on the sky. Each tile is stored as a numpy structured array in its own file. A cone query is assembled
+from the cached tiles that overlap the cone; tiles not yet in the cache are fetched from the catalog backend with a
+single cone query, centered on the query, that covers all of them. Tiles are small, so that cone is only larger than
+the query by about a tile diagonal: at most radius + sqrt(2) tilesize.
+
+The cache is safe for concurrent use by several processes: tiles are written to a temporary file and atomically
+renamed into place, and readers treat a tile that disappeared through eviction as a cache miss. The total size of the
+cache is bounded by evicting the least recently used tiles. The cache directory is only scanned for eviction when the
+size estimate of this process, the size at the last scan plus the tiles written since, exceeds the limit, or when the
+last scan is more than rescaninterval seconds old, as other processes write into the cache, too.
+'''
+import logging
+import math
+import os
+import tempfile
+import time
+
+import numpy as np
+from astropy.table import Table
+
+from longtermphotzp.crossmatch import angular_separation
+
+_logger = logging.getLogger(__name__)
+
+
+class TiledCatalogCache:
+
+    def __init__(self, cachedir, fetch, tilesize=0.1, maxbytes=2 * 1024 ** 3, rescaninterval=300.):
+        """
+        :param cachedir: directory where tiles are stored
+        :param fetch: callable(ra, dec, radius) returning an astropy Table with at least 'ra' and 'dec' columns
+        :param tilesize: height of the declination bands, and approximate width of the tiles [deg]
+        :param maxbytes: size limit of the cache on disk
+        :param rescaninterval: longest time between scans of the cache directory for eviction [s]
+        """
+        self.fetch = fetch
+        self.tilesize = tilesize
+        self.maxbytes = maxbytes
+        self.rescaninterval = rescaninterval
+        # bytes in the cache at the last scan plus the tiles this process wrote since; None before the first scan.
+        self.estimatedsize = None
+        self.lastscan = None
+        self.nbands = int(math.ceil(180. / tilesize))
+        self.cachedir = os.path.join(os.path.expanduser(cachedir), f"tiles_{tilesize:g}")
+        os.makedirs(self.cachedir, exist_ok=True)
+
+    def band_declinations(self, band):
+        dec0 = -90. + band * self.tilesize
+        return dec0, min(90., dec0 + self.tilesize)
+
+    def tiles_in_band(self, band):
+        dec0, dec1 = self.band_declinations(band)
+        equatorward = 0. if dec0 < 0 < dec1 else min(abs(dec0), abs(dec1))
+        return max(1, int(360. * math.cos(math.radians(equatorward)) / self.tilesize))
+
+    def tile_bounds(self, tile):
+        """ return ra0, ra1, dec0, dec1 of a tile. """
+        band, index = tile
+        dec0, dec1 = self.band_declinations(band)
+        width = 360. / self.tiles_in_band(band)
+        return index * width, (index + 1) * width, dec0, dec1
+
+    def tiles_for_cone(self, ra, dec, radius):
+        """ List of all tiles that overlap with a cone. """
+        decmin = max(-90., dec - radius)
+        decmax = min(90., dec + radius)
+        firstband = min(int((decmin + 90.) / self.tilesize), self.nbands - 1)
+        lastband = min(int((decmax + 90.) / self.tilesize), self.nbands - 1)
+
+        # The cone contains a pole, or its widest right ascension extent is beyond a pole.
+        allra = (dec + radius >= 90.) or (dec - radius <= -90.) or \
+                (math.sin(math.radians(radius)) >= math.cos(math.radians(dec)))
+        # Declination where the cone is widest in right ascension.
+        widest = math.degrees(math.asin(max(-1., min(1., math.sin(math.radians(dec)) /
+                                                     math.cos(math.radians(radius))))))
+
+        tiles = []
+        for band in range(firstband, lastband + 1):
+            ntiles = self.tiles_in_band(band)
+            # Largest right ascension offset of any point of the cone within the band.
+            deltara = 180.
+            if not allra:
+                dec0, dec1 = self.band_declinations(band)
+                bandwidest = math.radians(min(max(widest, dec0), dec1))
+                cosdeltara = (math.cos(math.radians(radius)) - math.sin(math.radians(dec)) * math.sin(bandwidest)) / (
+                        math.cos(math.radians(dec)) * math.cos(bandwidest))
+                deltara = math.degrees(math.acos(max(-1., min(1., cosdeltara))))
+            if deltara >= 180.:
+                indices = range(ntiles)
+            else:
+                width = 360. / ntiles
+                first = int(math.floor((ra - deltara) / width))
+                last = int(math.floor((ra + deltara) / width))
+                indices = sorted(set(ii % ntiles for ii in range(first, last + 1)))
+            tiles.extend((band, index) for index in indices)
+        return tiles
+
+    def tile_outline(self, tile, npoints=5):
+        """ Points along the boundary of a tile, used to find a cone that covers the tile. """
+        ra0, ra1, dec0, dec1 = self.tile_bounds(tile)
+        ras = np.linspace(ra0, ra1, npoints)
+        decs = np.linspace(dec0, dec1, npoints)
+        outlinera = np.concatenate((ras, ras, np.full(npoints, ra0), np.full(npoints, ra1)))
+        outlinedec = np.concatenate((np.full(npoints, dec0), np.full(npoints, dec1), decs, decs))
+        return outlinera, outlinedec
+
+    def tilefile(self, tile):
+        band, index = tile
+        return os.path.join(self.cachedir, f"b{band:04d}", f"t{band:04d}_{index:05d}.npy")
+
+    def read_tile(self, tile):
+        """ Return the cached rows of a tile, or None if the tile is not in the cache. """
+        filename = self.tilefile(tile)
+        try:
+            rows = np.load(filename, allow_pickle=False)
+            # mark as recently used for the LRU eviction.
+            os.utime(filename)
+        except (FileNotFoundError, ValueError, OSError):
+            return None
+        return rows
+
+    def write_tile(self, tile, rows):
+        filename = self.tilefile(tile)
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        with tempfile.NamedTemporaryFile(dir=os.path.dirname(filename), suffix='.tmp', delete=False) as f:
+            np.save(f, rows, allow_pickle=False)
+            size = f.tell()
+        os.replace(f.name, filename)
+        if self.estimatedsize is not None:
+            self.estimatedsize += size
+
+    def fetch_tiles(self, tiles, ra, dec, radius):
+        """ Fetch a set of tiles with a single cone query centered at ra, dec, and add them to the cache.
+
+        :return: dictionary tile -> rows, or None if the query failed.
+        """
+        outlines = [self.tile_outline(tile) for tile in tiles]
+        outlinera = np.concatenate([outline[0] for outline in outlines])
+        outlinedec = np.concatenate([outline[1] for outline in outlines])
+        fetchradius = max(radius, np.max(angular_separation(ra, dec, outlinera, outlinedec))) + 1e-3
+        _logger.debug(f"Fetching {len(tiles)} tiles with cone query radius {fetchradius:.3f}")
+
+        table = self.fetch(ra, dec, fetchradius)
+        if table is None:
+            return None
+        rows = table.as_array()
+        if hasattr(rows, 'filled'):
+            rows = rows.filled()
+        rowra = np.asarray(rows['ra'], dtype=float) % 360.
+        rowdec = np.asarray(rows['dec'], dtype=float)
+
+        fetched = {}
+        for tile in tiles:
+            ra0, ra1, dec0, dec1 = self.tile_bounds(tile)
+            intile = (rowra >= ra0) & (rowra < ra1) & (rowdec >= dec0) & ((rowdec < dec1) | (dec1 >= 90.))
+            fetched[tile] = rows[intile]
+            self.write_tile(tile, fetched[tile])
+        self.evict()
+        return fetched
+
+    def query(self, ra, dec, radius):
+        """ Cone query served from the cache, fetching missing tiles as needed.
+
+        :return: astropy Table with the same columns as returned by fetch, or None if fetching failed.
+        """
+        tiles = self.tiles_for_cone(ra, dec, radius)
+        rows = {tile: self.read_tile(tile) for tile in tiles}
+        missing = [tile for tile in tiles if rows[tile] is None]
+        _logger.debug(f"Cone query ({ra:.4f}, {dec:.4f}, {radius}) needs {len(tiles)} tiles, {len(missing)} missing")
+
+        if len(missing) > 0:
+            fetched = self.fetch_tiles(missing, ra, dec, radius)
+            if fetched is None:
+                return None
+            rows.update(fetched)
+
+        dtypes = set(rows[tile].dtype for tile in tiles)
+        if len(dtypes) > 1:
+            # Tiles written by different catalog versions; start over with a fresh copy.
+            _logger.warning("Inconsistent column layout in cached tiles, refetching")
+            fetched = self.fetch_tiles(tiles, ra, dec, radius)
+            if fetched is None:
+                return None
+            rows = fetched
+
+        allrows = np.concatenate([rows[tile] for tile in tiles])
+        incone = angular_separation(ra, dec, allrows['ra'], allrows['dec']) <= radius
+        return Table(allrows[incone])
+
+    def evict(self):
+        """ Delete least recently used tiles until the cache is below its size limit.
+
+        The cache directory is scanned only if the size estimate exceeds the limit, or the last scan is older than
+        rescaninterval.
+        """
+        if (self.estimatedsize is not None) and (self.estimatedsize <= self.maxbytes) and \
+                (time.monotonic() - self.lastscan < self.rescaninterval):
+            return
+        self.lastscan = time.monotonic()
+        tilefiles = []
+        totalsize = 0
+        for dirpath, dirnames, filenames in os.walk(self.cachedir):
+            for filename in filenames:
+                if not filename.endswith('.npy'):
+                    continue
+                try:
+                    stat = os.stat(os.path.join(dirpath, filename))
+                except FileNotFoundError:
+                    continue
+                tilefiles.append((stat.st_mtime, stat.st_size, os.path.join(dirpath, filename)))
+                totalsize += stat.st_size
+
+        self.estimatedsize = totalsize
+        if totalsize <= self.maxbytes:
+            return
+
+        tilefiles.sort()
+        target = 0.9 * self.maxbytes
+        for mtime, size, filename in tilefiles:
+            if totalsize <= target:
+                break
+            try:
+                os.remove(filename)
+            except FileNotFoundError:
+                pass
+            totalsize -= size
+        self.estimatedsize = totalsize
+        _logger.info(f"Evicted tiles from refcat cache, size is now {totalsize / 1024 ** 2:.1f} MB")
@@ -0,0 +1,211 @@
+'''
+HEALPix partitioned binary store of the Atlas refcat2 catalog.
+
+All catalog rows are kept in a single numpy structured array file, sorted by their HEALPix pixel (NESTED scheme),
+plus an index of row offsets per pixel:
+
+    <storedir>/refcat2.npy     rows, in column layout as delivered by the refcat2 backends
+    <storedir>/offsets.npy     int64 array of length 12 * nside**2 + 1; rows of pixel p are [offsets[p], offsets[p+1])
+
+Cone searches memory-map the store and only touch the pixels overlapping the cone, so the operating system page cache
+is shared between all worker processes on a host.
+
+To convert a refcat2 sqlite database (as generated by refcat2tools/refcat2csv2sqlite.py) into a store:
+
+    python -m longtermphotzp.refcat2healpix --input sqlite:///refcat2.db --output /data/refcat2-healpix --nside 64
+
+The store is then used with --refcat2-url healpix:///data/refcat2-healpix
+'''
+import argparse
+import logging
+import math
+import os
+import sqlite3
+
+import numpy as np
+from astropy.table import Table
+
+from longtermphotzp.crossmatch import angular_separation
+from longtermphotzp.refcat2backends import REFCAT2_COLUMNS
+
+_logger = logging.getLogger(__name__)
+
+DATAFILE = 'refcat2.npy'
+OFFSETFILE = 'offsets.npy'
+
+STORE_DTYPE = np.dtype([(name, np.float64 if name in ('ra', 'dec') else np.float32)
+                        for name in REFCAT2_COLUMNS.values()])
+
+
+def spread_bits(values):
+    """ Interleave the bits of an integer array with zeros: ...b2 b1 b0 -> ...0 b2 0 b1 0 b0 """
+    values = values.astype(np.int64)
+    result = np.zeros_like(values)
+    for bit in range(30):
+        result |= ((values >> bit) & 1) << (2 * bit)
+    return result
+
+
+def ang2pix_nest(nside, ra, dec):
+    """ HEALPix pixel index in the NESTED scheme for positions in degrees. nside must be a power of 2. """
+    ra = np.atleast_1d(np.asarray(ra, dtype=float))
+    dec = np.atleast_1d(np.asarray(dec, dtype=float))
+    z = np.sin(np.radians(dec))
+    za = np.abs(z)
+    tt = np.mod(np.radians(ra), 2 * np.pi) / (np.pi / 2)
+    tt[tt >= 4] = 0.
+
+    face = np.zeros(len(ra), dtype=np.int64)
+    ix = np.zeros(len(ra), dtype=np.int64)
+    iy = np.zeros(len(ra), dtype=np.int64)
+
+    equatorial = za <= 2. / 3.
+    temp1 = nside * (0.5 + tt[equatorial])
+    temp2 = nside * (z[equatorial] * 0.75)
+    jp = (temp1 - temp2).astype(np.int64)
+    jm = (temp1 + temp2).astype(np.int64)
+    ifp = jp // nside
+    ifm = jm // nside
+    face[equatorial] = np.where(ifp == ifm, ifp | 4, np.where(ifp < ifm, ifp, ifm + 8))
+    ix[equatorial] = jm & (nside - 1)
+    iy[equatorial] = nside - (jp & (nside - 1)) - 1
+
+    polar = ~equatorial
+    ntt = np.minimum(tt[polar].astype(np.int64), 3)
+    tp = tt[polar] - ntt
+    tmp = nside * np.sqrt(3 * (1 - za[polar]))
+    jp = np.minimum((tp * tmp).astype(np.int64), nside - 1)
+    jm = np.minimum(((1. - tp) * tmp).astype(np.int64), nside - 1)
+    north = z[polar] >= 0
+    face[polar] = np.where(north, ntt, ntt + 8)
+    ix[polar] = np.where(north, nside - jm - 1, jp)
+    iy[polar] = np.where(north, nside - jp - 1, jm)
+
+    return face * nside * nside + spread_bits(ix) + (spread_bits(iy) << 1)
+
+
+def pixel_resolution(nside):
+    """ Approximate pixel size [deg]. """
+    return math.degrees(math.sqrt(4 * math.pi / (12 * nside * nside)))
+
+
+def cone_pixels(nside, ra, dec, radius):
+    """ Pixels that overlap with a cone.
+
+    The cone, widened by one pixel size, is sampled on a grid in the tangent plane that is fine compared to the pixel
+    size. This may include a few pixels just outside the cone, which is harmless for the subsequent distance cut.
+    """
+    resolution = pixel_resolution(nside)
+    outer = math.radians(radius + resolution)
+    step = math.radians(resolution / 4.)
+    n = int(math.ceil(math.tan(min(outer, 1.5)) / step))
+    grid = np.arange(-n, n + 1) * step
+    xi, eta = np.meshgrid(grid, grid)
+    rho = np.hypot(xi, eta)
+    inside = np.arctan(rho) <= outer
+    xi = xi[inside]
+    eta = eta[inside]
+    rho = rho[inside]
+
+    # inverse gnomonic projection about the cone centre.
+    ra0 = math.radians(ra)
+    dec0 = math.radians(dec)
+    c = np.arctan(rho)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        sindec = np.cos(c) * math.sin(dec0) + np.where(rho > 0, eta * np.sin(c) * math.cos(dec0) / rho, 0.)
+    sampledec = np.degrees(np.arcsin(np.clip(sindec, -1, 1)))
+    samplera = np.degrees(ra0 + np.arctan2(xi * np.sin(c),
+                                           rho * math.cos(dec0) * np.cos(c) - eta * math.sin(dec0) * np.sin(c)))
+    return np.unique(ang2pix_nest(nside, np.append(samplera, ra), np.append(sampledec, dec)))
+
+
+class Refcat2HealpixBackend:
+    ''' Cone searches in a memory mapped HEALPix partitioned refcat2 store. '''
+
+    def __init__(self, url):
+        self.storedir = os.path.expanduser(url[len('healpix:///'):])
+        self.rows = np.load(os.path.join(self.storedir, DATAFILE), mmap_mode='r')
+        self.offsets = np.load(os.path.join(self.storedir, OFFSETFILE))
+        self.nside = int(round(math.sqrt((len(self.offsets) - 1) / 12)))
+        _logger.info(f"Opened refcat2 healpix store {self.storedir} with nside={self.nside}, {len(self.rows)} rows")
+
+    def query(self, ra, dec, radius):
+        pixels = cone_pixels(self.nside, ra, dec, radius)
+        rows = np.concatenate([self.rows[self.offsets[p]:self.offsets[p + 1]] for p in pixels])
+        incone = angular_separation(ra, dec, rows['ra'], rows['dec']) <= radius
+        rows = rows[incone]
+        return Table([rows[name].astype(np.float32) for name in rows.dtype.names], names=rows.dtype.names)
+
+
+def write_healpix_store(chunks, storedir, nside=64):
+    """ Write a HEALPix partitioned store from a catalog given in chunks.
+
+    Two passes are made over the input, one to count the rows per pixel and one to fill the rows into place,
+    so the catalog never has to fit into memory.
+
+    :param chunks: callable returning a fresh iterator over astropy Tables / structured arrays with the refcat2
+                   backend columns (ra, dec, pmra, pmdec, gmag, gmagerr, ...)
+    """
+    npix = 12 * nside * nside
+    counts = np.zeros(npix, dtype=np.int64)
+    for chunk in chunks():
+        counts += np.bincount(ang2pix_nest(nside, chunk['ra'], chunk['dec']), minlength=npix)
+
+    offsets = np.zeros(npix + 1, dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
+    _logger.info(f"Writing {offsets[-1]} rows into {npix} pixels")
+
+    os.makedirs(storedir, exist_ok=True)
+    rows = np.lib.format.open_memmap(os.path.join(storedir, DATAFILE), mode='w+', dtype=STORE_DTYPE,
+                                     shape=(int(offsets[-1]),))
+    cursor = offsets[:-1].copy()
+    for chunk in chunks():
+        pix = ang2pix_nest(nside, chunk['ra'], chunk['dec'])
+        order = np.argsort(pix, kind='stable')
+        sortedpix = pix[order]
+        # rank of each row within its pixel, in this chunk
+        rank = np.arange(len(sortedpix)) - np.searchsorted(sortedpix, sortedpix, side='left')
+        destination = cursor[sortedpix] + rank
+        for name in STORE_DTYPE.names:
+            rows[name][destination] = np.asarray(chunk[name])[order]
+        cursor += np.bincount(pix, minlength=npix)
+    rows.flush()
+    del rows
+    np.save(os.path.join(storedir, OFFSETFILE), offsets)
+
+
+def sqlite_chunks(url, chunksize=1000000):
+    """ Chunked reader over a refcat2 sqlite database for write_healpix_store. """
+    filename = os.path.expanduser(url[len('sqlite:///'):])
+    columns = ', '.join(REFCAT2_COLUMNS)
+
+    def chunks():
+        connection = sqlite3.connect(f'file:{filename}?mode=ro', uri=True)
+        cursor = connection.execute(f'SELECT {columns} FROM sources')
+        while True:
+            data = cursor.fetchmany(chunksize)
+            if len(data) == 0:
+                break
+            data = np.asarray(data, dtype=np.float64)
+            yield {name: data[:, ii] for ii, name in enumerate(REFCAT2_COLUMNS.values())}
+        connection.close()
+
+    return chunks
+
+
+def parseCommandLine():
+    parser = argparse.ArgumentParser(description='Convert a refcat2 sqlite database into a HEALPix partitioned store')
+    parser.add_argument('--input', required=True, help='refcat2 database, sqlite:///path')
+    parser.add_argument('--output', required=True, help='output directory of the store')
+    parser.add_argument('--nside', type=int, default=64, help='HEALPix nside, a power of 2')
+    parser.add_argument('--loglevel', dest='log_level', default='INFO', choices=['DEBUG', 'INFO', 'WARN'],
+                        help='Set the debug level')
+    args = parser.parse_args()
+    logging.basicConfig(level=getattr(logging, args.log_level.upper()),
+                        format='%(asctime)s.%(msecs).03d %(levelname)7s: %(module)20s: %(message)s')
+    return args
+
+
+if __name__ == '__main__':
+    args = parseCommandLine()
+    write_healpix_store(sqlite_chunks(args.input), os.path.expanduser(args.output), nside=args.nside)
@@ -0,0 +1,158 @@
+'''
+Per stage timing of the photometric zeropoint analysis.
+
+Each analysed frame gets a record with the wall clock time spent in each stage (download, catalog decode, WCS
+transform, reference catalog query, crossmatch, fit, plots, handing the result to the database writer), plus
+annotations such as star counts and bytes downloaded. Stages are timed as laps: timer.lap('wcs') books the time since
+the previous lap of the frame to the stage 'wcs'.
+
+Work that is not done per frame, such as writing a batch of results to the database, is recorded as an event with
+timer.event('db-flush', seconds). Events have their own record, and are summarised like stages but do not count to
+the frame totals. Time spent in an event while a frame is open is not booked to the frame's current lap.
+
+The timer is per process, see configure() and get_timer(). When timing is disabled, get_timer() returns a
+NullStageTimer whose methods do nothing.
+
+Worker processes keep their records and hand them to the parent with take_records(); the parent adds them to its
+own timer with add_record(), writes them as JSON lines if requested, and aggregates them into percentiles per stage.
+'''
+import json
+import logging
+import time
+
+import numpy as np
+
+_logger = logging.getLogger(__name__)
+
+
+class NullStageTimer:
+    ''' Stand-in when timing is disabled. '''
+
+    def start_frame(self):
+        pass
+
+    def lap(self, stage):
+        pass
+
+    def annotate(self, **kwargs):
+        pass
+
+    def end_frame(self):
+        pass
+
+    def event(self, stage, seconds, **kwargs):
+        pass
+
+    def add_record(self, record):
+        pass
+
+    def take_records(self):
+        return []
+
+    def summary(self):
+        return {}
+
+    def close(self):
+        pass
+
+
+class StageTimer:
+
+    def __init__(self, jsonlfile=None):
+        """
+        :param jsonlfile: if not None, every frame record is appended to this file as a line of JSON
+        """
+        self.records = []
+        self.jsonl = open(jsonlfile, 'a') if jsonlfile is not None else None
+        self.current = None
+        self.framestart = None
+        self.lapstart = None
+
+    def start_frame(self):
+        self.framestart = self.lapstart = time.perf_counter()
+        self.current = {'stages': {}}
+
+    def lap(self, stage):
+        if self.current is None:
+            return
+        now = time.perf_counter()
+        stages = self.current['stages']
+        stages[stage] = stages.get(stage, 0.) + now - self.lapstart
+        self.lapstart = now
+
+    def annotate(self, **kwargs):
+        if self.current is not None:
+            self.current.update(kwargs)
+
+    def end_frame(self):
+        if self.current is None:
+            return
+        self.current['total'] = time.perf_counter() - self.framestart
+        self.add_record(self.current)
+        self.current = None
+
+    def event(self, stage, seconds, **kwargs):
+        """ Record seconds spent in stage outside of the per frame laps, with annotations. """
+        if self.current is not None:
+            self.lapstart += seconds
+        record = {'event': stage, 'seconds': seconds}
+        record.update(kwargs)
+        self.add_record(record)
+
+    def add_record(self, record):
+        self.records.append(record)
+        if self.jsonl is not None:
+            self.jsonl.write(json.dumps(record) + '\n')
+            self.jsonl.flush()
+
+    def take_records(self):
+        """ Return the records collected so far, and forget them. """
+        records = self.records
+        self.records = []
+        return records
+
+    def summary(self):
+        """ p50 / p95 / max / total time per stage over all frames.
+
+        :return: dictionary stage -> dictionary of 'n', 'p50', 'p95', 'max', 'sum' [s]
+        """
+        stagetimes = {}
+        for record in self.records:
+            if 'event' in record:
+                stagetimes.setdefault(record['event'], []).append(record['seconds'])
+                continue
+            for stage, seconds in record['stages'].items():
+                stagetimes.setdefault(stage, []).append(seconds)
+            stagetimes.setdefault('total', []).append(record['total'])
+        summary = {}
+        for stage, seconds in stagetimes.items():
+            seconds = np.asarray(seconds)
+            summary[stage] = {'n': len(seconds), 'p50': np.percentile(seconds, 50), 'p95': np.percentile(seconds, 95),
+                              'max': np.max(seconds), 'sum': np.sum(seconds)}
+        return summary
+
+    def format_summary(self):
+        lines = [f"{'stage':>12s} {'n':>7s} {'p50[s]':>9s} {'p95[s]':>9s} {'max[s]':>9s} {'sum[s]':>10s}"]
+        for stage, s in self.summary().items():
+            lines.append(f"{stage:>12s} {s['n']:7d} {s['p50']:9.3f} {s['p95']:9.3f} {s['max']:9.3f} {s['sum']:10.1f}")
+        return '\n'.join(lines)
+
+    def close(self):
+        if self.jsonl is not None:
+            self.jsonl.close()
+            self.jsonl = None
+
+
+_timer = NullStageTimer()
+
+
+def configure(enabled=False, jsonlfile=None):
+    """ Set up the timer of this process. """
+    global _timer
+    _timer.close()
+    _timer = StageTimer(jsonlfile=jsonlfile) if (enabled or jsonlfile is not None) else NullStageTimer()
+    return _timer
+
+
+def get_timer():
+    return _timer
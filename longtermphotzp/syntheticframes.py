@@ -0,0 +1,169 @@
+'''
+Synthetic BANZAI-like frames and reference catalogs with known photometric zeropoint and color term.
+
+Meant for offline tests and benchmarks of the zeropoint pipeline: a field of stars is written into a refcat2 sqlite
+database (the local stand-in for the refcat2 service, see refcat2backends), and frames are written with a SCI
+extension holding the header and WCS, and a CAT extension with the sources' positions and fluxes, such that
+
+    refmag - instmag = zp + colorterm * (g-i)
+
+in the same SDSS reference system that photcalibration fits in.
+'''
+import datetime
+import logging
+import os
+
+import numpy as np
+from astropy.io import fits
+from astropy.table import Table
+from astropy.wcs import WCS
+
+from longtermphotzp.atlasrefcat2 import atlas_refcat2
+from longtermphotzp.photdbinterface import PhotZPMeasurement
+from longtermphotzp.refcat2backends import write_refcat2_sqlite
+
+_logger = logging.getLogger(__name__)
+
+PIXELSCALE = 0.389 / 3600.
+NAXIS = 2048
+
+
+def make_synthetic_field(nstars, ra0=150., dec0=-20., radius=0.4, seed=1):
+    """ Random stars in a cone, with PS1-like magnitudes, in the column layout of the refcat2 backends. """
+    rng = np.random.default_rng(seed)
+    r = radius * np.sqrt(rng.uniform(0, 1, nstars))
+    phi = rng.uniform(0, 2 * np.pi, nstars)
+    table = Table()
+    table['ra'] = (ra0 + r * np.cos(phi) / np.cos(np.radians(dec0))) % 360.
+    table['dec'] = dec0 + r * np.sin(phi)
+    table['pmra'] = np.zeros(nstars)
+    table['pmdec'] = np.zeros(nstars)
+    rmag = rng.uniform(12, 20, nstars)
+    gi = rng.uniform(0., 2.5, nstars)
+    for band, color in (('g', 0.6 * gi), ('r', 0. * gi), ('i', -0.4 * gi), ('z', -0.55 * gi)):
+        table[f'{band}mag'] = rmag + color
+        table[f'{band}magerr'] = np.full(nstars, 0.01)
+    return table
+
+
+def write_synthetic_frame(filename, refcatalog, ra0, dec0, zp=23.0, colorterm=0.03, filter='rp', exptime=60.,
+                          dateobs='2024-01-01T01:00:00.000', site='cpt', dome='doma', telescope='1m0a',
+                          instrument='fa06', airmass=1.2, noise=0.01, seed=1):
+    """ Write a frame of the stars of refcatalog that fall onto the detector.
+
+    :param refcatalog: atlas_refcat2 instance that serves the field
+    """
+    rng = np.random.default_rng(seed)
+    wcs = WCS(naxis=2)
+    wcs.wcs.ctype = ['RA---TAN', 'DEC--TAN']
+    wcs.wcs.crval = [ra0, dec0]
+    wcs.wcs.crpix = [NAXIS / 2, NAXIS / 2]
+    wcs.wcs.cd = np.diag([-PIXELSCALE, PIXELSCALE])
+    header = wcs.to_header()
+    header['EXPTIME'] = exptime
+    header['FILTER'] = filter
+    header['SATURATE'] = 60000.
+    header['AIRMASS'] = airmass
+    header['DATE-OBS'] = dateobs
+    header['INSTRUME'] = instrument
+    header['SITEID'] = site
+    header['ENCID'] = dome
+    header['TELID'] = telescope
+    header['FOCOBOFF'] = 0.
+    header['WCSERR'] = 0
+
+    refband = atlas_refcat2.FILTERMAPPING[filter]['refMag']
+    stars = refcatalog.get_reference_catalog(ra0, dec0, 0.33, bands=[refband])
+    x, y = wcs.all_world2pix(stars['ra'], stars['dec'], 1)
+    ondetector = (x > 1) & (x < NAXIS) & (y > 1) & (y < NAXIS)
+    instmag = (stars[refband] - zp - colorterm * (stars['gmag'] - stars['imag']))[ondetector]
+    instmag = instmag + rng.normal(0, noise, len(instmag))
+    flux = exptime * 10 ** (-0.4 * instmag)
+
+    cat = fits.BinTableHDU(Table([x[ondetector], y[ondetector], flux, 0.1 * flux, np.full(len(flux), noise)],
+                                 names=['x', 'y', 'FLUX', 'peak', 'magerr']), name='CAT')
+    # The science pixels are not needed for the default analysis; keep the files small.
+    sci = fits.CompImageHDU(np.zeros((16, 16), dtype=np.float32), header=header, name='SCI')
+    fits.HDUList([fits.PrimaryHDU(), sci, cat]).writeto(filename, overwrite=True)
+    return int(np.sum(ondetector))
+
+
+def make_synthetic_dataset(directory, nframes=1, nstars=1000, zp=23.0, colorterm=0.03, filter='rp', seed=1):
+    """ Write a refcat2 sqlite database and nframes frames with about nstars stars each.
+
+    Frames are dithered by a few arcminutes around a common field center, and are named like LCO frames, e.g.,
+    cpt1m012-fa06-20240101-0001-e91.fits.fz
+
+    :return: list of frame filenames, refcat2 url of the database
+    """
+    ra0, dec0 = 150., -20.
+    # The detector covers about 0.22 x 0.22 deg^2 of the 0.4 deg radius field.
+    fieldstars = int(nstars * np.pi * 0.4 ** 2 / (NAXIS * PIXELSCALE) ** 2)
+    refcat2_url = f"sqlite:///{directory}/refcat2.db"
+    if os.path.exists(f"{directory}/refcat2.db"):
+        os.remove(f"{directory}/refcat2.db")
+    write_refcat2_sqlite(f"{directory}/refcat2.db", make_synthetic_field(fieldstars, ra0, dec0, seed=seed))
+    refcatalog = atlas_refcat2(refcat2_url)
+
+    rng = np.random.default_rng(seed)
+    filenames = []
+    for ii in range(nframes):
+        filename = f"{directory}/cpt1m012-fa06-20240101-{ii + 1:04d}-e91.fits.fz"
+        write_synthetic_frame(filename, refcatalog, ra0 + rng.uniform(-0.05, 0.05), dec0 + rng.uniform(-0.05, 0.05),
+                              zp=zp, colorterm=colorterm, filter=filter, seed=seed + ii,
+                              dateobs=f"2024-01-01T{1 + ii // 3600 % 10:02d}:{ii // 60 % 60:02d}:{ii % 60:02d}.000")
+        filenames.append(filename)
+    return filenames, refcat2_url
+
+
+def make_banzai_like_frame(filename, shape=(512, 512)):
+    """ Frame with SCI, CAT and BPM extensions of random content, for tests of frame reading and transfer. """
+    rng = np.random.default_rng(7)
+    header = fits.Header()
+    header['EXPTIME'] = 60.
+    header['FILTER'] = 'rp'
+    sci = fits.CompImageHDU(rng.normal(100, 10, shape).astype(np.float32), header=header, name='SCI')
+    cat = fits.BinTableHDU.from_columns([fits.Column(name='x', format='E', array=rng.uniform(0, 512, 100)),
+                                         fits.Column(name='y', format='E', array=rng.uniform(0, 512, 100)),
+                                         fits.Column(name='FLUX', format='E', array=rng.uniform(1, 1e5, 100))],
+                                        name='CAT')
+    bpm = fits.CompImageHDU(np.zeros(shape, dtype=np.uint8), name='BPM')
+    fits.HDUList([fits.PrimaryHDU(), sci, cat, bpm]).writeto(filename, overwrite=True)
+
+
+def make_fixture_catalog(nstars=5000, seed=11):
+    """ Random stars around ra 0, dec -10, across the 0/360 wrap, in the column layout of the refcat2 backends. """
+    rng = np.random.default_rng(seed)
+    table = Table()
+    table['ra'] = rng.uniform(-1, 1, nstars) % 360
+    table['dec'] = rng.uniform(-11, -9, nstars)
+    table['pmra'] = rng.normal(0, 5, nstars)
+    table['pmdec'] = rng.normal(0, 5, nstars)
+    for band in 'griz':
+        table[f'{band}mag'] = rng.uniform(12, 19, nstars)
+        table[f'{band}magerr'] = rng.uniform(0.001, 0.05, nstars)
+    return table
+
+
+def add_synthetic_measurements(db, nrecords, site='lsc', dome='doma', telescope='1m0a', camera='fa15', filter='rp',
+                               start=datetime.datetime(2016, 4, 1), end=datetime.datetime(2024, 1, 1), seed=1):
+    """ Fill a photdbinterface with zeropoint measurements of a slowly degrading telescope, for the long term trend
+    analysis. Nights are spread over [start, end), with a few frames per night and some cloudy, low outliers.
+    """
+    rng = np.random.default_rng(seed)
+    days = (end - start).days
+    dayoffsets = np.sort(rng.uniform(0, days, nrecords))
+    # throughput degrades by 0.2 mag / year, and is restored every year by a mirror cleaning
+    zp = 23.2 - 0.2 * (dayoffsets % 365.) / 365. + rng.normal(0, 0.02, nrecords)
+    clouds = rng.random(nrecords) < 0.2
+    zp[clouds] -= rng.exponential(0.5, np.sum(clouds))
+    measurements = []
+    for ii in range(nrecords):
+        dateobs = start + datetime.timedelta(days=float(dayoffsets[ii]))
+        measurements.append(PhotZPMeasurement(
+            name=f"{site}{telescope[0]}m0xx-{camera}-{dateobs:%Y%m%d}-{ii:06d}-e91.fits.fz",
+            dateobs=dateobs.strftime('%Y-%m-%d %H:%M:%S.%f'), site=site, dome=dome, telescope=telescope,
+            camera=camera, filter=filter, airmass=float(rng.uniform(1, 2)), zp=float(zp[ii]),
+            colorterm=float(rng.normal(0.03, 0.01)), zpsig=float(rng.uniform(0.01, 0.1))))
+    db.session.add_all(measurements)
+    db.session.commit()
@@ -0,0 +1,120 @@
+'''
+Robust photometric zeropoint and color term fits.
+
+A fit is a straight line deltamag = colorterm * refcol + zeropoint through the per star zeropoints of an image, with
+stars iteratively clipped:
+
+    pass 1:       refcol within colorrange, and |deltamag - median| < presigma * std(deltamag)
+    passes 2..n:  refcol within refitcolorrange, and |residual| < maxresidual, and |residual| < sigma * std(residual)
+
+Each pass solves the closed-form 2x2 normal equations of the line, so the fits of many images can be done at once:
+the per star data of all images are concatenated, and the image boundaries are given as offsets, i.e., the stars of
+image k are [offsets[k], offsets[k+1]). All sums are per image segment sums over the concatenated arrays.
+'''
+import logging
+
+import numpy as np
+
+_logger = logging.getLogger(__name__)
+
+
+class SegmentedArrays:
+    ''' Per segment reductions over concatenated arrays. '''
+
+    def __init__(self, offsets):
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.nsegments = len(self.offsets) - 1
+        self.counts = np.diff(self.offsets)
+        self.segment = np.repeat(np.arange(self.nsegments), self.counts)
+
+    def sum(self, values):
+        return np.bincount(self.segment, weights=values, minlength=self.nsegments)
+
+    def mean(self, values, weights):
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return self.sum(values * weights) / self.sum(weights)
+
+    def std(self, values, weights=None):
+        """ Population standard deviation (as np.std) of the values with non-zero weights. """
+        if weights is None:
+            weights = np.ones(len(values))
+        mean = self.mean(values, weights)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.sqrt(self.sum(weights * (values - mean[self.segment]) ** 2) / self.sum(weights))
+
+    def median(self, values):
+        # A selection per segment is cheaper than a sort of all values by segment and value.
+        median = np.full(self.nsegments, np.nan)
+        for ii in np.flatnonzero(self.counts > 0):
+            median[ii] = np.median(values[self.offsets[ii]:self.offsets[ii + 1]])
+        return median
+
+    def linefit(self, x, y, weights):
+        """ Weighted least squares line y = slope * x + intercept per segment, from the closed-form normal equations.
+
+        :return: slope, intercept; nan for segments with less than two distinct x values.
+        """
+        n = self.sum(weights)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            meanx = self.sum(weights * x) / n
+            meany = self.sum(weights * y) / n
+            dx = x - meanx[self.segment]
+            dy = y - meany[self.segment]
+            sxx = self.sum(weights * dx * dx)
+            sxy = self.sum(weights * dx * dy)
+            slope = sxy / sxx
+        slope[~(sxx > 0)] = np.nan
+        intercept = meany - slope * meanx
+        return slope, intercept
+
+
+def robust_colorfit_batch(deltamag, refcol, offsets, colorrange=(-0.5, 2.0), refitcolorrange=(-0.5, 3.0),
+                          presigma=5., maxresidual=0.5, sigma=1., niter=3, zpsigclip=3.):
+    """ Robust zeropoint and color term fits for many images at once.
+
+    :param deltamag: per star reference magnitude - instrumental magnitude, of all images concatenated
+    :param refcol: per star reference (g-i) color, of all images concatenated
+    :param offsets: image boundaries in the concatenated arrays, length number of images + 1
+    :param niter: total number of fit passes
+    :param zpsigclip: clipping of deltamag around its median for the zeropoint scatter zpsig, in units of its std
+    :return: dictionary of per image arrays 'zp', 'colorterm', 'rms' (scatter of the fit residuals), 'zpsig' (scatter
+             of the clipped per star zeropoints), and 'n' (number of stars in the final fit), and the boolean array of
+             stars used in the final fit. Images where the fit failed have nan zp and colorterm.
+    """
+    deltamag = np.asarray(deltamag, dtype=np.float64)
+    refcol = np.asarray(refcol, dtype=np.float64)
+    segments = SegmentedArrays(offsets)
+    ones = np.ones(len(deltamag))
+
+    median = segments.median(deltamag)[segments.segment]
+    std = segments.std(deltamag)[segments.segment]
+    offset = np.abs(deltamag - median)
+
+    clean = offset < zpsigclip * std
+    zpsig = segments.std(deltamag, clean.astype(np.float64))
+
+    cond = (refcol > colorrange[0]) & (refcol < colorrange[1]) & (offset < presigma * std)
+    colorterm, zp = segments.linefit(refcol, deltamag, cond.astype(np.float64))
+
+    for iteration in range(niter - 1):
+        residual = deltamag - (colorterm[segments.segment] * refcol + zp[segments.segment])
+        residualstd = segments.std(residual, ones)[segments.segment]
+        cond = (refcol > refitcolorrange[0]) & (refcol < refitcolorrange[1]) & (np.abs(residual) < maxresidual) & (
+                np.abs(residual) < sigma * residualstd)
+        colorterm, zp = segments.linefit(refcol, deltamag, cond.astype(np.float64))
+
+    residual = deltamag - (colorterm[segments.segment] * refcol + zp[segments.segment])
+    rms = segments.std(residual, cond.astype(np.float64))
+    n = segments.sum(cond.astype(np.float64)).astype(np.int64)
+    return {'zp': zp, 'colorterm': colorterm, 'rms': rms, 'zpsig': zpsig, 'n': n}, cond
+
+
+def robust_colorfit(deltamag, refcol, **kwargs):
+    """ Robust zeropoint and color term fit of a single image, see robust_colorfit_batch.
+
+    :return: dictionary of 'zp', 'colorterm', 'rms', 'zpsig', 'n' scalars, and the boolean array of stars used in the fit.
+    """
+    fit, cond = robust_colorfit_batch(deltamag, refcol, [0, len(deltamag)], **kwargs)
+    fit = {key: value[0] for key, value in fit.items()}
+    _logger.debug(f"Fit: zp = {fit['zp']} color = {fit['colorterm']} rms = {fit['rms']}")
+    return fit, cond
@@ -1,6 +1,16 @@
+import functools
+import http.server
 import logging
+import os
+import threading
 
-from longtermphotzp.es_aws_imagefinder import download_from_archive
+import numpy as np
+from astropy.io import fits
+from astropy.table import Table
+
+from longtermphotzp.es_aws_imagefinder import download_from_archive, fetch_extensions, photometry_search, \
+    group_frames, PHOTOMETRY_SOURCE_FIELDS
+from longtermphotzp.syntheticframes import make_banzai_like_frame
 
 logging.basicConfig()
 def no_test_aws_fits_access():
@@ -17,3 +27,81 @@ def no_test_aws_fits_access():
         assert fits is not None, f"Download of image {frameid}from lco aws archive"
 
 
+
+class RangeRequestHandler(http.server.SimpleHTTPRequestHandler):
+    """ Local stand-in for the archive file server, with support for single byte range requests. """
+
+    def do_GET(self):
+        path = self.translate_path(self.path)
+        with open(path, 'rb') as f:
+            data = f.read()
+        rangeheader = self.headers.get('Range')
+        if rangeheader is None or not self.server.honourranges:
+            self.send_response(200)
+        else:
+            start, end = (int(x) for x in rangeheader.replace('bytes=', '').split('-'))
+            if start >= len(data):
+                self.send_response(416)
+                self.end_headers()
+                return
+            data = data[start:end + 1]
+            self.send_response(206)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+        self.server.bytessent += len(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def do_fetch_extensions(directory, honourranges):
+    handler = functools.partial(RangeRequestHandler, directory=directory)
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    server.honourranges = honourranges
+    server.bytessent = 0
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        frame = fetch_extensions(f"http://127.0.0.1:{server.server_port}/frame.fits.fz")
+    finally:
+        server.shutdown()
+    return frame, server.bytessent
+
+
+def test_partial_download(tmpdir):
+    make_banzai_like_frame(f"{tmpdir}/frame.fits.fz", shape=(1536, 1536))
+    reference = fits.open(f"{tmpdir}/frame.fits.fz")
+    filesize = os.path.getsize(f"{tmpdir}/frame.fits.fz")
+
+    frame, bytessent = do_fetch_extensions(str(tmpdir), honourranges=True)
+    assert [hdu.name for hdu in frame] == ['PRIMARY', 'SCI', 'CAT']
+    assert np.all(frame['CAT'].data['FLUX'] == reference['CAT'].data['FLUX'])
+    assert bytessent < filesize / 2
+
+    # Server ignores ranges: fall back to streaming the full file.
+    frame, bytessent = do_fetch_extensions(str(tmpdir), honourranges=False)
+    assert np.all(frame['CAT'].data['FLUX'] == reference['CAT'].data['FLUX'])
+
+
+def test_photometry_search_query():
+    search = photometry_search('20240101', '20240131', sites=['lsc', 'cpt'], cameratypes=['fa', 'fs'],
+                               mintexp=30, filterlist=['gp', 'rp'], os_url='http://localhost:9200')
+    query = search.to_dict()
+    filters = query['query']['bool']['filter']
+    assert {'range': {'DAY-OBS': {'gte': '20240101', 'lte': '20240131'}}} in filters
+    assert {'terms': {'SITEID': ['lsc', 'cpt']}} in filters
+    assert {'terms': {'FILTER': ['gp', 'rp']}} in filters
+    assert {'bool': {'should': [{'prefix': {'INSTRUME': 'fa'}}, {'prefix': {'INSTRUME': 'fs'}}],
+                     'minimum_should_match': 1}} in filters
+    assert query['_source'] == PHOTOMETRY_SOURCE_FIELDS
+
+    # the client is reused between queries
+    assert photometry_search('20240101', '20240101', os_url='http://localhost:9200')._using is search._using
+
+
+def test_group_frames():
+    frames = Table([['a', 'b', 'c', 'd'], ['1', '2', '3', '4'], ['20240102', '20240101', '20240102', '20240101'],
+                    ['lsc', 'cpt', 'lsc', 'lsc']], names=['filename', 'frameid', 'dayobs', 'site'])
+    groups = [(key, list(group['filename'])) for key, group in group_frames(frames, keys=('dayobs',))]
+    assert groups == [(('20240101',), ['b', 'd']), (('20240102',), ['a', 'c'])]
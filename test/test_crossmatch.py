@@ -0,0 +1,50 @@
+import numpy as np
+from astropy.coordinates import SkyCoord
+from astropy import units as u
+from longtermphotzp.crossmatch import SkyMatcher, angular_separation
+
+
+def make_field(ra0, dec0, nref=2000, ninst=800, seed=42):
+    rng = np.random.default_rng(seed)
+    refra = ra0 + rng.uniform(-0.3, 0.3, nref) / np.cos(np.radians(dec0))
+    refdec = dec0 + rng.uniform(-0.3, 0.3, nref)
+    # image sources are a subset of the reference stars, with some astrometric noise.
+    pick = rng.choice(nref, ninst, replace=False)
+    instra = refra[pick] + rng.normal(0, 0.3 / 3600, ninst) / np.cos(np.radians(dec0))
+    instdec = refdec[pick] + rng.normal(0, 0.3 / 3600, ninst)
+    return refra % 360, refdec, instra % 360, instdec
+
+
+def do_compare_to_astropy(ra0, dec0):
+    refra, refdec, instra, instdec = make_field(ra0, dec0)
+
+    cInstrument = SkyCoord(ra=instra * u.degree, dec=instdec * u.degree)
+    cReference = SkyCoord(ra=refra * u.degree, dec=refdec * u.degree)
+    refidx, d2d, d3d = cReference.match_to_catalog_sky(cInstrument)
+
+    idx, distance = SkyMatcher(instra, instdec, ra0=ra0, dec0=dec0).match(refra, refdec)
+
+    good = d2d.arcsecond < 5
+    assert np.all(idx[good] == refidx[good])
+    assert np.allclose(distance, d2d.arcsecond, rtol=0, atol=1e-6)
+
+
+def test_crossmatch_matches_astropy():
+    do_compare_to_astropy(150, 2.)
+    do_compare_to_astropy(359.9, -30)
+    do_compare_to_astropy(10, 75)
+
+
+def test_mutual_match():
+    ra = np.asarray([10., 10.001])
+    dec = np.asarray([10., 10.])
+    # two reference stars close to the same image source: only the closer one is a mutual match.
+    idx, distance = SkyMatcher(ra[:1], dec[:1], 10, 10).match(ra, dec, mutual=True)
+    assert np.all(idx == 0)
+    assert distance[0] == 0
+    assert np.isinf(distance[1])
+
+
+def test_angular_separation():
+    assert np.isclose(angular_separation(0, 0, 90, 0), 90)
+    assert np.isclose(angular_separation(10, 89, 190, 89), 2)
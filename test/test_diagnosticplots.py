@@ -0,0 +1,35 @@
+import os
+
+import numpy as np
+from longtermphotzp import diagnosticplots
+
+
+def make_fit_result(nstars=300, seed=23):
+    rng = np.random.default_rng(seed)
+    refcol = rng.uniform(-0.5, 3, nstars)
+    retCatalog = {'refmag': rng.uniform(12, 19, nstars), 'refcol': refcol, 'peak': rng.uniform(100, 60000, nstars),
+                  'instflux': rng.uniform(1e3, 1e6, nstars), 'x': rng.uniform(0, 2048, nstars),
+                  'y': rng.uniform(0, 2048, nstars), 'instfilter': 'rp', 'reffilter': 'rmag', 'exptime': 60.,
+                  'saturate': 65000.}
+    magZP = 23.1 + 0.02 * refcol + rng.normal(0, 0.02, nstars)
+    cond = np.abs(magZP - 23.1 - 0.02 * refcol) < 0.03
+    return retCatalog, magZP, cond
+
+
+def test_render_payload(tmpdir):
+    retCatalog, magZP, cond = make_fit_result()
+    payload = diagnosticplots.make_payload(retCatalog, magZP, cond, 23.1, 0.02, str(tmpdir), 'frame',
+                                           plottypes=('zp', 'residuals'))
+    assert 'peak' not in payload
+    written = diagnosticplots.render(payload)
+    assert written == [f"{tmpdir}/frame_rp_zp.png", f"{tmpdir}/frame_rp_residuals.png"]
+    assert all(os.path.getsize(filename) > 0 for filename in written)
+
+
+def test_renderer_pool(tmpdir):
+    retCatalog, magZP, cond = make_fit_result()
+    with diagnosticplots.DiagnosticPlotRenderer(workers=2) as renderer:
+        for ii in range(5):
+            renderer.submit(diagnosticplots.make_payload(retCatalog, magZP, cond, 23.1, 0.02, str(tmpdir),
+                                                         f'frame{ii}', plottypes=diagnosticplots.PLOTTYPES))
+    assert len(os.listdir(str(tmpdir))) == 5 * len(diagnosticplots.PLOTTYPES)
@@ -0,0 +1,33 @@
+import io
+import numpy as np
+from astropy.io import fits
+from longtermphotzp.fitsframes import read_extensions
+from longtermphotzp.syntheticframes import make_banzai_like_frame
+
+
+class NonSeekableStream(io.RawIOBase):
+    """ Non-seekable stream, like a streamed http response. """
+
+    def __init__(self, data):
+        self.data = io.BytesIO(data)
+
+    def readable(self):
+        return True
+
+    def read(self, n=-1):
+        return self.data.read(n)
+
+
+def test_read_extensions(tmpdir):
+    filename = f"{tmpdir}/frame.fits.fz"
+    make_banzai_like_frame(filename)
+    reference = fits.open(filename)
+
+    with open(filename, 'rb') as f:
+        rawdata = f.read()
+    for source in (open(filename, 'rb'), NonSeekableStream(rawdata)):
+        frame = read_extensions(source)
+        assert [hdu.name for hdu in frame] == ['PRIMARY', 'SCI', 'CAT']
+        assert frame['SCI'].header['FILTER'] == 'rp'
+        assert frame['SCI'].header['NAXIS1'] == 512
+        assert np.all(frame['CAT'].data['FLUX'] == reference['CAT'].data['FLUX'])
@@ -0,0 +1,46 @@
+import http.server
+import threading
+
+import longtermphotzp.httpsession as httpsession
+
+
+class FlakyHandler(http.server.BaseHTTPRequestHandler):
+    """ Keep-alive server that answers the first requests with 503 Service Unavailable. """
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self.server.nrequests += 1
+        status = 503 if self.server.nrequests <= self.server.nfailures else 200
+        body = b'{"ok": true}'
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def test_session_retry_and_reuse():
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), FlakyHandler)
+    server.nrequests = 0
+    server.nfailures = 2
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    httpsession.configure(retries=3, backoff=0)
+    try:
+        session = httpsession.get_session()
+        assert session.timeout == (10., 120.)
+        for ii in range(5):
+            response = session.get(f"http://127.0.0.1:{server.server_port}/")
+            assert response.status_code == 200
+        assert httpsession.get_session() is session
+
+        # two retried 503 answers plus five successful requests, all over one kept-alive connection
+        assert server.nrequests == 7
+        nrequests, nconnections = httpsession.connection_statistics()['127.0.0.1']
+        assert nrequests == 7
+        assert nconnections == 1
+    finally:
+        server.shutdown()
+        httpsession.configure(retries=3, backoff=0.5)
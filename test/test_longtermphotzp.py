@@ -0,0 +1,329 @@
+import calendar
+import datetime
+
+import numpy as np
+import scipy.signal
+from astropy.table import Table
+
+from longtermphotzp.longtermphotzp import findUpperEnvelope, night_boundary_utc, trendcorrectthroughput, \
+    photometricnightcalendar, airmasscorrection
+
+
+def findUpperEnvelope_reference(dateobs, datum, ymax=24.2):
+    """ The day by day loop findUpperEnvelope was before vectorization. """
+    stderror = 0.03
+
+    alldata = zip(dateobs, datum)
+    sorted_points = sorted(alldata)
+    x = np.asarray([point[0] for point in sorted_points])
+    y = np.asarray([point[1] for point in sorted_points])
+
+    day_x = []
+    day_y = []
+
+    startdate = datetime.datetime(year=x[0].year, month=x[0].month,
+                                  day=x[0].day, hour=12)
+    enddate = x[len(x) - 1]
+    while startdate < enddate:
+        todayzps = y[
+            (x > startdate) & (x < startdate + datetime.timedelta(days=1)) & (
+                    y < ymax) & (y is not np.nan)]
+
+        if len(todayzps) > 3:
+            todayzps = np.sort(todayzps)[1:]
+            maxzp = np.nanmax(todayzps)
+            upperEnv = np.nanmean(todayzps[todayzps > (maxzp - stderror)])
+
+            if upperEnv is not np.nan:
+                day_x.append(startdate)
+                day_y.append(upperEnv)
+
+        startdate = startdate + datetime.timedelta(days=1)
+
+    medianrange = 9
+    newday_y = scipy.signal.medfilt(day_y, medianrange)
+
+    return np.asarray(day_x), newday_y
+
+
+def make_zeropoints(n, seed):
+    rng = np.random.default_rng(seed)
+    start = datetime.datetime(2016, 4, 1, 3, 17)
+    seconds = np.sort(rng.uniform(0, 400 * 86400, n))
+    # some exposures exactly on the night boundaries, and some at the same time
+    seconds[::97] = np.round(seconds[::97] / 86400) * 86400 + 8.7167 * 3600
+    seconds[1::89] = seconds[::89][:len(seconds[1::89])]
+    dateobs = [start + datetime.timedelta(seconds=float(s)) for s in seconds]
+    zp = 23.5 - 0.3 * (seconds % (180 * 86400)) / (180 * 86400) - rng.exponential(0.05, n)
+    zp[rng.random(n) < 0.1] += 1.
+    zp[rng.random(n) < 0.02] = np.nan
+    # dense nights with many zeropoints close to the best one
+    zp[(seconds // 86400) % 17 == 0] = np.round(zp[(seconds // 86400) % 17 == 0], 2)
+    order = rng.permutation(n)
+    return np.asarray(dateobs, dtype=object)[order], zp[order]
+
+
+def test_findupperenvelope_identical():
+    for n, seed in ((50, 1), (3000, 2), (20000, 3)):
+        dateobs, zp = make_zeropoints(n, seed)
+        x, y = findUpperEnvelope(dateobs, zp, ymax=23.6)
+        xref, yref = findUpperEnvelope_reference(dateobs, zp, ymax=23.6)
+        assert len(x) == len(xref)
+        assert all(a == b for a, b in zip(x, xref))
+        assert np.array_equal(y, yref)
+
+
+def test_findupperenvelope_nightboundary():
+    dateobs = [datetime.datetime(2020, 1, 10, 20)] + \
+              [datetime.datetime(2020, 1, 11, 14) + datetime.timedelta(minutes=20 * ii) for ii in range(12)]
+    zp = np.full(len(dateobs), 23.)
+    # With nights starting at 12:00 UTC, all exposures of Jan 11 are in one night.
+    x, y = findUpperEnvelope(dateobs, zp)
+    assert list(x) == [datetime.datetime(2020, 1, 11, 12)]
+    # In Chile, the night starts at local noon, 16:43 UTC, which splits the exposures of Jan 11.
+    x, y = findUpperEnvelope(dateobs, zp, dayboundary=night_boundary_utc('lsc'))
+    assert list(x) == [datetime.datetime(2020, 1, 10, 16, 43, 12)]
+    assert night_boundary_utc('cpt') < 12 < night_boundary_utc('elp')
+    assert night_boundary_utc('xyz') == 12
+
+
+def trendcorrectthroughput_reference(datadate, datazp, modeldate, modelzp):
+    """ The per point and day by day loops trendcorrectthroughput was before vectorization. """
+    modelgmt = np.zeros((len(modeldate)))
+    for ii in range(0, len(modeldate)):
+        modelgmt[ii] = calendar.timegm(modeldate[ii].timetuple())
+
+    corrected = np.zeros(len(datazp))
+    for ii in range(0, len(corrected)):
+        interpolated = np.interp(calendar.timegm(datadate[ii].timetuple()),
+                                 modelgmt, modelzp)
+        corrected[ii] = datazp[ii] - interpolated
+
+    day_x = []
+    day_y = []
+    alldata = zip(datadate, corrected)
+    sorted_points = sorted(alldata)
+    x = np.asarray([point[0] for point in sorted_points])
+    y = np.asarray([point[1] for point in sorted_points])
+    startdate = datetime.datetime(year=2016, month=4, day=1, hour=16)
+    enddate = x[len(x) - 1]
+
+    while startdate < enddate:
+        todayzps = y[
+            (x > startdate) & (x < startdate + datetime.timedelta(days=1))]
+        photometric = -1
+        if len(todayzps) > 0:
+            if np.min(todayzps > -0.15):
+                photometric = 1
+            else:
+                photometric = 0
+        day_x.append(startdate)
+        day_y.append(photometric)
+        startdate = startdate + datetime.timedelta(days=1)
+
+    return corrected, np.asarray(day_x), np.asarray(day_y)
+
+
+def make_mirrormodel(start=datetime.datetime(2016, 1, 1), ndays=500):
+    modeldate = [start + datetime.timedelta(days=ii, seconds=0.4) for ii in range(0, ndays, 7)]
+    modelzp = 23.5 - 0.3 * (np.arange(0, ndays, 7) % 180) / 180
+    return modeldate, modelzp
+
+
+def test_trendcorrectthroughput_identical():
+    dateobs, zp = make_zeropoints(600, 4)
+    modeldate, modelzp = make_mirrormodel()
+    corrected, day_x, day_y = trendcorrectthroughput(dateobs, zp, modeldate, modelzp)
+    corrected_ref, day_x_ref, day_y_ref = trendcorrectthroughput_reference(dateobs, zp, modeldate, modelzp)
+    assert np.array_equal(corrected, corrected_ref, equal_nan=True)
+    assert list(day_x) == list(day_x_ref)
+    assert np.array_equal(day_y, day_y_ref)
+    assert set(day_y) == {-1, 0, 1}
+
+
+def test_photometricnightcalendar():
+    rows = []
+    mirrormodels = {}
+    for ii, (site, filter) in enumerate((('lsc', 'rp'), ('lsc', 'gp'), ('coj', 'rp'))):
+        dateobs, zp = make_zeropoints(2000, 10 + ii)
+        airmass = np.random.default_rng(ii).uniform(1, 2, len(zp))
+        rows.append(Table([dateobs, [site] * len(zp), ['doma'] * len(zp), ['1m0a'] * len(zp), [filter] * len(zp),
+                           airmass, zp], names=['dateobs', 'site', 'dome', 'telescope', 'filter', 'airmass', 'zp']))
+        if site != 'coj':
+            mirrormodels[(f'{site}-doma-1m0a', filter)] = make_mirrormodel(ndays=300 + 50 * ii)
+    data = Table(np.concatenate([np.asarray(r) for r in rows]))
+    data['dateobs'] = np.concatenate([r['dateobs'] for r in rows])
+
+    nights = photometricnightcalendar(data, mirrormodels)
+    # no model for coj
+    assert set(zip(nights['telescope'], nights['filter'])) == set(mirrormodels)
+
+    for (telescope, filter), (modeldate, modelzp) in mirrormodels.items():
+        select = (data['site'] == telescope[:3]) & (data['filter'] == filter) & np.isfinite(data['zp'])
+        k = airmasscorrection[filter]
+        zp_air = data['zp'][select] + k * data['airmass'][select] - k
+        start = datetime.datetime(2016, 4, 1) + datetime.timedelta(hours=night_boundary_utc(telescope[:3]))
+        corrected, day_x, day_y = trendcorrectthroughput(list(data['dateobs'][select]), zp_air, modeldate, modelzp,
+                                                         startdate=start)
+        mine = nights[(nights['telescope'] == telescope) & (nights['filter'] == filter)]
+        assert list(mine['night']) == list(day_x[day_y >= 0])
+        assert np.array_equal(mine['photometric'], day_y[day_y >= 0])
+
+
+def test_plotlongtermtrends_multifilter(tmp_path):
+    import argparse
+    from longtermphotzp.longtermphotzp import plotlongtermtrend, plotlongtermtrends, mirrorreplacmenet
+    from longtermphotzp.photdbinterface import photdbinterface
+    from longtermphotzp.syntheticframes import add_synthetic_measurements
+
+    dburl = f'sqlite:///{tmp_path}/photzp.db'
+    db = photdbinterface(dburl)
+    for ii, (camera, filter) in enumerate((('fa15', 'rp'), ('fa16', 'gp'), ('fa17', 'zs'))):
+        add_synthetic_measurements(db, 1000, site='lsc', dome='domb', telescope='1m0a', camera=camera, filter=filter,
+                                   start=datetime.datetime(2016, 4, 1), end=datetime.datetime(2016, 8, 1), seed=ii)
+    context = argparse.Namespace(database=dburl, imagedbPrefix=str(tmp_path), errorhistogram=False)
+    replacements = {telid: list(events) for telid, events in mirrorreplacmenet.items()}
+
+    filters = ['rp', 'gp', 'zp', 'ip']
+    filenames = plotlongtermtrends('lsc', 'domb-1m0a', filters, context, cacheddb=db)
+    models = {f: db.readmirrormodel('lsc-domb-1m0a', f) for f in filters}
+    assert models['ip'] is None
+    assert models['rp'] is not None and models['gp'] is not None
+    assert mirrorreplacmenet == replacements
+
+    singlefilenames = []
+    for f in filters[:3]:
+        singlefilenames += plotlongtermtrend('lsc', 'domb-1m0a', f, context, cacheddb=db)
+        model = db.readmirrormodel('lsc-domb-1m0a', f)
+        if model is None:
+            # synthetic zeropoints are above the envelope limit of the filter
+            assert models[f] is None
+            continue
+        assert list(model['dateobs']) == list(models[f]['dateobs'])
+        assert np.array_equal(model['zp'], models[f]['zp'])
+    assert filenames == singlefilenames
+    db.close()
+
+
+def test_plottelescopetrends_workers(tmp_path):
+    import argparse
+    from longtermphotzp.longtermphotzp import plottelescopetrends, mergecolorterms
+    from longtermphotzp.photdbinterface import photdbinterface
+    from longtermphotzp.syntheticframes import add_synthetic_measurements
+
+    dburl = f'sqlite:///{tmp_path}/photzp.db'
+    db = photdbinterface(dburl)
+    for ii, (site, dome) in enumerate((('lsc', 'domb'), ('coj', 'doma'))):
+        for jj, filter in enumerate(('rp', 'gp')):
+            add_synthetic_measurements(db, 1000, site=site, dome=dome, telescope='1m0a', camera=f'fa1{jj}',
+                                       filter=filter, start=datetime.datetime(2016, 4, 1),
+                                       end=datetime.datetime(2016, 8, 1), seed=2 * ii + jj)
+    db.close()
+    # a malformed telescope id fails its job, which is skipped with and without workers
+    jobs = [('lsc', 'domb-1m0a'), ('lsc', 'broken'), ('coj', 'doma-1m0a'), ('elp', 'doma-1m0a')]
+
+    results = {}
+    for workers in (1, 2):
+        context = argparse.Namespace(database=dburl, imagedbPrefix=str(tmp_path), errorhistogram=False,
+                                     log_level='INFO', workers=workers)
+        filenames = []
+        colorterms = {}
+        njobs = 0
+        for jobfilenames, jobcolorterms in plottelescopetrends(jobs, ['rp', 'gp'], context):
+            filenames += jobfilenames
+            mergecolorterms(colorterms, jobcolorterms)
+            njobs += 1
+        assert njobs == 3
+        results[workers] = filenames, colorterms
+
+    assert results[1] == results[2]
+    filenames, colorterms = results[2]
+    assert set(colorterms) == {'rp', 'gp'}
+    assert set(colorterms['rp']) == {'lsc-domb-1m0a', 'coj-doma-1m0a'}
+    assert 'photzptrend-coj-doma-1m0a-gp.png' in filenames
+
+
+def test_renderhtmlpage_filters(tmp_path, monkeypatch):
+    import argparse
+    from longtermphotzp.longtermphotzp import renderHTMLPage
+
+    monkeypatch.delenv('AWS_ACCESS_KEY_ID', raising=False)
+    context = argparse.Namespace(imagedbPrefix=str(tmp_path), filter='rp', filters=['rp', 'gp'])
+    filenames = ['photzptrend-lsc-domb-1m0a-rp.png', 'photzptrend-lsc-domb-1m0a-gp.png',
+                 'photzptrend-coj-doma-1m0a-gp.png', 'allmodels_2m01m0_rp.png']
+    renderHTMLPage(context, filenames)
+    page = (tmp_path / 'index.html').read_text()
+
+    assert 'allmodels_2m01m0_gp.png' in page and 'allmodels_0m4_rp.png' in page
+    rp, gp = page.split('Details by Site in gp')
+    rp = rp.split('Details by Site in rp')[1]
+    assert 'photzptrend-lsc-domb-1m0a-rp.png' in rp and 'photzptrend-lsc-domb-1m0a-gp.png' not in rp
+    assert 'photzptrend-coj-doma-1m0a-gp.png' in gp and 'photzptrend-lsc-domb-1m0a-rp.png' not in gp
+    # each trend plot is listed once, under its site
+    assert page.count('href="photzptrend-coj-doma-1m0a-gp.png"') == 1
+    lsc, coj = gp.split('<h2> coj </h2>')[0], gp.split('<h2> coj </h2>')[1].split('<h2>')[0]
+    assert 'photzptrend-lsc-domb-1m0a-gp.png' in lsc and 'photzptrend-coj-doma-1m0a-gp.png' in coj
+
+
+def test_plotlongtermtrends_failing_filter(tmp_path, monkeypatch):
+    import argparse
+    import matplotlib.pyplot as plt
+    import longtermphotzp.longtermphotzp as ltz
+    from longtermphotzp.photdbinterface import photdbinterface
+    from longtermphotzp.syntheticframes import add_synthetic_measurements
+
+    dburl = f'sqlite:///{tmp_path}/photzp.db'
+    db = photdbinterface(dburl)
+    for ii, filter in enumerate(('rp', 'gp', 'ip')):
+        add_synthetic_measurements(db, 1000, site='lsc', dome='domb', telescope='1m0a', camera=f'fa1{ii}',
+                                   filter=filter, start=datetime.datetime(2016, 4, 1),
+                                   end=datetime.datetime(2016, 8, 1), seed=ii)
+    context = argparse.Namespace(database=dburl, imagedbPrefix=str(tmp_path), errorhistogram=False)
+
+    referencethroughput = ltz.plot_referencethoughput
+
+    def failing_in_gp(start, end, select_filter, select_telescope):
+        if select_filter == 'gp':
+            raise ValueError('broken plot')
+        return referencethroughput(start, end, select_filter, select_telescope)
+
+    monkeypatch.setattr(ltz, 'plot_referencethoughput', failing_in_gp)
+    plt.close('all')
+    filenames, jobcolorterms = ltz.telescopetrendjob('lsc', 'domb-1m0a', ['rp', 'gp', 'ip'], context, cacheddb=db)
+    db.close()
+
+    assert set(jobcolorterms) == {'rp', 'ip'}
+    assert 'photzptrend-lsc-domb-1m0a-rp.png' in filenames
+    assert 'photzptrend-lsc-domb-1m0a-ip.png' in filenames
+    assert not any(f.endswith('-gp.png') for f in filenames)
+    assert plt.get_fignums() == []
+
+
+def test_plotlongtermtrend_default_nights_unchanged(tmp_path):
+    """ By default, the stored mirror model is the one of the day by day loop, with nights starting at 12:00 UTC. """
+    import argparse
+    from longtermphotzp.longtermphotzp import plotlongtermtrend, telescopereferencethroughput
+    from longtermphotzp.photdbinterface import photdbinterface
+    from longtermphotzp.syntheticframes import add_synthetic_measurements
+
+    dburl = f'sqlite:///{tmp_path}/photzp.db'
+    db = photdbinterface(dburl)
+    add_synthetic_measurements(db, 3000, site='lsc', dome='domb', telescope='1m0a', filter='rp',
+                               start=datetime.datetime(2016, 4, 1), end=datetime.datetime(2016, 10, 1))
+    context = argparse.Namespace(database=dburl, imagedbPrefix=str(tmp_path), errorhistogram=False)
+    plotlongtermtrend('lsc', 'domb-1m0a', 'rp', context, cacheddb=db)
+    model = db.readmirrormodel('lsc-domb-1m0a', 'rp')
+
+    data = db.readRecords('lsc')
+    good = data['zpsig'] < 0.2
+    zp_air = data['zp'] + airmasscorrection['rp'] * data['airmass'] - airmasscorrection['rp']
+    x, y = findUpperEnvelope_reference(data['dateobs'][good], zp_air[good],
+                                       ymax=telescopereferencethroughput['rp']['1m0'] + 1)
+    assert list(model['dateobs']) == list(x)
+    assert np.array_equal(model['zp'], y)
+
+    context.localnoonnights = True
+    plotlongtermtrend('lsc', 'domb-1m0a', 'rp', context, cacheddb=db)
+    localmodel = db.readmirrormodel('lsc-domb-1m0a', 'rp')
+    db.close()
+    assert localmodel['dateobs'][0].hour == 16
@@ -0,0 +1,42 @@
+import numpy as np
+
+from longtermphotzp.matchedcatalogstore import MatchedCatalogStore, make_frame, frame_offsets, STAR_COLUMNS
+
+
+def make_catalog(nstars, site='lsc', filter='rp', seed=1):
+    rng = np.random.default_rng(seed)
+    catalog = {name: rng.uniform(10, 20, nstars) for name in STAR_COLUMNS}
+    catalog.update({'siteid': site, 'domid': 'domb', 'telescope': '1m0a', 'instfilter': filter, 'reffilter': 'r',
+                    'instrument': 'fa15', 'dateobs': '2024-01-02T03:00:00.000', 'exptime': 60., 'airmass': 1.3})
+    return catalog
+
+
+def test_store_roundtrip(tmpdir):
+    with MatchedCatalogStore(str(tmpdir), maxrows=40) as store:
+        store.addframe(make_frame('lsc1m009-fa15-20240101-0001-e91.fits.fz', make_catalog(20, seed=1)))
+        store.addframe(make_frame('lsc1m009-fa15-20240101-0002-e91.fits.fz', make_catalog(30, seed=2)))
+        # first two frames exceeded maxrows and are written
+        assert store.nfiles == 1
+        store.addframe(make_frame('lsc1m009-fa15-20240101-0003-e91.fits.fz', make_catalog(10, seed=3)))
+        store.addframe(make_frame('cpt1m010-fa16-20240101-0001-e91.fits.fz', make_catalog(5, site='cpt')))
+        store.addframe(make_frame('lsc1m009-fa15-20240103-0001-e91.fits.fz', make_catalog(7, filter='gp')))
+    assert store.nfiles == 4
+
+    stars = store.read(telescope='lsc-domb-1m0a', filter='rp')
+    assert stars.num_rows == 60
+    assert set(stars['night'].to_pylist()) == {'20240101'}
+    assert np.allclose(np.sort(stars['refmag'].to_numpy()),
+                       np.sort(np.concatenate([make_catalog(n, seed=s)['refmag'] for n, s in ((20, 1), (30, 2), (10, 3))])))
+
+    assert store.read(start='20240102').num_rows == 7
+    assert store.read(end='20240102').num_rows == 65
+    assert store.read(sites=['cpt']).num_rows == 5
+    assert store.read(filter=['rp', 'gp'], sites=['lsc', 'ogg']).num_rows == 67
+
+    nframes = 0
+    for table in store.iter_tables(telescope='lsc-domb-1m0a', columns=['name', 'refmag', 'filter']):
+        names, offsets = frame_offsets(table)
+        assert len(set(names)) == len(names)
+        assert offsets[-1] == table.num_rows
+        nframes += len(names)
+    assert nframes == 4
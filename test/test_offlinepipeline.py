@@ -0,0 +1,134 @@
+import os
+
+import numpy as np
+from astropy.table import Table
+
+import longtermphotzp.photcalibration as photcal
+from longtermphotzp.matchedcatalogstore import MatchedCatalogStore
+from longtermphotzp.photdbinterface import photdbinterface
+from longtermphotzp.syntheticframes import make_synthetic_dataset
+
+
+def test_analyzeimage_synthetic(tmpdir):
+    filenames, refcat2_url = make_synthetic_dataset(str(tmpdir), nframes=1, nstars=500, zp=23.4, colorterm=0.05)
+    p = photcal.PhotCalib(refcat2_url)
+    photzp, photzpsig, colorterm = p.analyzeImage(Table([filenames, [-1]], names=['filename', 'frameid']), mintexp=0)
+    assert abs(photzp - 23.4) < 0.01
+    assert abs(colorterm - 0.05) < 0.01
+    assert photzpsig < 0.1
+
+
+def test_process_imagelist_synthetic(tmpdir):
+    filenames, refcat2_url = make_synthetic_dataset(str(tmpdir), nframes=3, nstars=300, zp=22.8, colorterm=-0.02)
+    args = photcal.parseCommandLine(['--refcat2-url', refcat2_url, '--photodb', f'sqlite:///{tmpdir}/photzp.db',
+                                     '--mintexp', '0', '--plotworkers', '0'])
+    db = photdbinterface(args.imagedbPrefix)
+    photcal.process_imagelist(Table([filenames, [-1] * len(filenames)], names=['filename', 'frameid']), db, args,
+                              rewritetoarchivename=False)
+    records = db.readRecords('cpt')
+    db.close()
+    assert sorted(records['name']) == sorted(os.path.basename(f) for f in filenames)
+    assert np.all(np.abs(records['zp'] - 22.8) < 0.01)
+    assert np.all(np.abs(records['colorterm'] + 0.02) < 0.01)
+
+
+def test_process_imagelist_matchedcatalogs(tmpdir):
+    filenames, refcat2_url = make_synthetic_dataset(str(tmpdir), nframes=3, nstars=300)
+    args = photcal.parseCommandLine(['--refcat2-url', refcat2_url, '--mintexp', '0', '--plotworkers', '0',
+                                     '--matchedcatalogdir', f'{tmpdir}/matched', '--workers', '2'])
+    photcal.process_imagelist(Table([filenames, [-1] * len(filenames)], names=['filename', 'frameid']), None, args,
+                              rewritetoarchivename=False)
+    store = MatchedCatalogStore(f'{tmpdir}/matched')
+    stars = store.read(telescope='cpt-doma-1m0a', filter='rp', start='20240101', end='20240102')
+    assert set(stars['name'].to_pylist()) == set(os.path.basename(f) for f in filenames)
+    assert set(stars['night'].to_pylist()) == {'20240101'}
+    zp = stars['refmag'].to_numpy() - stars['instmag'].to_numpy() - 0.03 * stars['refcol'].to_numpy()
+    assert abs(np.median(zp) - 23.0) < 0.01
+
+
+def test_refit_matchedcatalogs(tmpdir):
+    filenames, refcat2_url = make_synthetic_dataset(str(tmpdir), nframes=3, nstars=300, zp=22.8, colorterm=-0.02)
+    dburl = f'sqlite:///{tmpdir}/photzp.db'
+    options = ['--refcat2-url', refcat2_url, '--photodb', dburl, '--mintexp', '0', '--plotworkers', '0',
+               '--matchedcatalogdir', f'{tmpdir}/matched']
+    args = photcal.parseCommandLine(options)
+    db = photdbinterface(dburl)
+    photcal.process_imagelist(Table([filenames, [-1] * len(filenames)], names=['filename', 'frameid']), db, args,
+                              rewritetoarchivename=False)
+    analyzed = db.readRecords('cpt')
+
+    # Same recipe from the stored catalogs reproduces the original fit.
+    store = MatchedCatalogStore(f'{tmpdir}/matched')
+    args = photcal.parseCommandLine(options + ['--refit', '--date', '20240101'])
+    assert photcal.refit_matchedcatalogs(store, db, args) == 3
+    refitted = db.readRecords('cpt')
+    assert np.allclose(refitted['zp'], analyzed['zp'], atol=1e-4)
+    assert np.allclose(refitted['colorterm'], analyzed['colorterm'], atol=1e-4)
+
+    # A different selection of stars changes the fit, but not the answer.
+    args = photcal.parseCommandLine(options + ['--refit', '--fit-maglimits', '12', '15', '--fit-niter', '2'])
+    assert photcal.refit_matchedcatalogs(store, db, args) == 3
+    refitted = db.readRecords('cpt')
+    db.close()
+    assert not np.allclose(refitted['zp'], analyzed['zp'], atol=1e-6)
+    assert np.all(np.abs(refitted['zp'] - 22.8) < 0.01)
+
+    # Nothing stored for other nights.
+    args = photcal.parseCommandLine(options + ['--refit', '--date', '20240102'])
+    assert photcal.refit_matchedcatalogs(store, None, args) == 0
+
+
+def test_process_framestream(tmpdir):
+    filenames, refcat2_url = make_synthetic_dataset(str(tmpdir), nframes=5, nstars=300)
+    dburl = f'sqlite:///{tmpdir}/photzp.db'
+    db = photdbinterface(dburl)
+    args = photcal.parseCommandLine(['--refcat2-url', refcat2_url, '--photodb', dburl, '--mintexp', '0',
+                                     '--plotworkers', '0', '--workers', '2'])
+    photcal.process_imagelist(Table([filenames[:2], [-1] * 2], names=['filename', 'frameid']), db, args,
+                              rewritetoarchivename=False)
+
+    received = []
+
+    def framestream():
+        for filename in filenames:
+            received.append(filename)
+            yield {'filename': filename, 'frameid': -1}
+
+    analyzed = []
+    original = photcal.PhotCalib.analyzeImage
+
+    def counting_analyzeimage(self, imageentry, *a, **kw):
+        analyzed.append(imageentry['filename'][0])
+        return original(self, imageentry, *a, **kw)
+
+    photcal.PhotCalib.analyzeImage = counting_analyzeimage
+    try:
+        args.workers = 1
+        batches = list(photcal.deduplicated_frames(framestream(), db, args, batchsize=2))
+        assert [frame['filename'] for frame in batches] == filenames[2:]
+        photcal.process_framestream(framestream(), db, args, rewritetoarchivename=False, batchsize=2)
+    finally:
+        photcal.PhotCalib.analyzeImage = original
+    records = db.readRecords('cpt')
+    db.close()
+    assert analyzed == filenames[2:]
+    assert sorted(records['name']) == sorted(os.path.basename(f) for f in filenames)
+
+
+def test_photzpmain_one_imagelist_for_all_nights(tmpdir, monkeypatch):
+    frames = Table([['a.fits.fz', 'b.fits.fz', 'c.fits.fz', 'd.fits.fz'], [1, 2, 3, 4],
+                    ['20240102', '20240101', '20240103', '20240101'], ['lsc', 'cpt', 'lsc', 'lsc']],
+                   names=['filename', 'frameid', 'dayobs', 'site'])
+    calls = []
+    monkeypatch.setattr(photcal.es_aws_imagefinder, 'get_frames_for_photometry_daterange',
+                        lambda daystart, dayend, **query: frames)
+    monkeypatch.setattr(photcal, 'process_imagelist', lambda inputlist, db, args: calls.append(inputlist))
+    monkeypatch.setattr('sys.argv', ['photcalibration', '--photodb', f'sqlite:///{tmpdir}/photzp.db', '--cameratype',
+                                     'fa', '--date', '20240101', '20240102'])
+    try:
+        photcal.photzpmain()
+    except SystemExit:
+        pass
+    # one worker pool and database writer for all nights, night by night
+    assert len(calls) == 1
+    assert list(calls[0]['filename']) == ['b.fits.fz', 'd.fits.fz', 'a.fits.fz']
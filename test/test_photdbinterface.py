@@ -0,0 +1,133 @@
+import datetime
+import math
+
+import astropy.time as astt
+import numpy as np
+from astropy.table import Table
+from sqlalchemy.dialects import postgresql
+
+from longtermphotzp.photdbinterface import photdbinterface, PhotZPMeasurement, PhotZPWriter
+
+
+def make_measurement(name, zp=23.0):
+    return PhotZPMeasurement(name=name, dateobs='2020-01-13 10:00:00.000', site='cpt', dome='doma', telescope='1m0a',
+                             camera='fa06', filter='rp', airmass=1.2, zp=zp, colorterm=0.01, zpsig=0.02)
+
+
+def test_existing_names(tmpdir):
+    db = photdbinterface(f"sqlite:///{tmpdir}/photzp.db")
+    for ii in range(5):
+        db.addphotzp(make_measurement(f"cpt1m012-fa06-20200113-{ii:04d}-e91.fits.fz"))
+
+    names = [f"cpt1m012-fa06-20200113-{ii:04d}-e91.fits.fz" for ii in range(3, 8)]
+    existing = db.existing_names(names, chunksize=2)
+    db.close()
+
+    assert existing == {"cpt1m012-fa06-20200113-0003-e91.fits.fz", "cpt1m012-fa06-20200113-0004-e91.fits.fz"}
+
+
+def test_photzpwriter_upsert(tmpdir):
+    db = photdbinterface(f"sqlite:///{tmpdir}/photzp.db")
+    db.addphotzp(make_measurement("cpt1m012-fa06-20200113-0001-e91.fits.fz", zp=20.0))
+
+    with PhotZPWriter(db, batchsize=3) as writer:
+        for ii in range(5):
+            writer.addphotzp(make_measurement(f"cpt1m012-fa06-20200113-{ii:04d}-e91.fits.fz"))
+        # first batch of three is written, the rest is pending until the writer is closed.
+        assert writer.nwritten == 3
+        # duplicate within a batch, last one wins
+        writer.addphotzp(make_measurement("cpt1m012-fa06-20200113-0004-e91.fits.fz", zp=24.0))
+    assert writer.nwritten == 5
+
+    records = db.readRecords()
+    db.close()
+    assert len(records) == 5
+    zp = dict(zip(records['name'], records['zp']))
+    assert zp["cpt1m012-fa06-20200113-0001-e91.fits.fz"] == 23.0
+    assert zp["cpt1m012-fa06-20200113-0004-e91.fits.fz"] == 24.0
+
+
+def test_photzpwriter_failing_row(tmpdir):
+    db = photdbinterface(f"sqlite:///{tmpdir}/photzp.db")
+    writer = PhotZPWriter(db, batchsize=10, maxdelay=3600.)
+    for ii in range(4):
+        writer.addphotzp(make_measurement(f"cpt1m012-fa06-20200113-{ii:04d}-e91.fits.fz"))
+    # a value the database driver cannot bind fails the batch; the other measurements are still written
+    bad = make_measurement("cpt1m012-fa06-20200113-0099-e91.fits.fz")
+    bad.zp = {'not': 'a number'}
+    writer.addphotzp(bad)
+    writer.flush_if_due()
+    assert writer.nwritten == 0
+    writer.maxdelay = 0.
+    writer.flush_if_due()
+    assert writer.nwritten == 4
+    assert len(writer.pending) == 0
+
+    records = db.readRecords()
+    db.close()
+    assert len(records) == 4
+
+
+def test_photzpwriter_postgres_statement(tmpdir):
+    db = photdbinterface(f"sqlite:///{tmpdir}/photzp.db")
+    writer = PhotZPWriter(db)
+    writer.dialect = 'postgresql'
+    sql = str(writer.upsert_statement().compile(dialect=postgresql.dialect()))
+    db.close()
+    assert 'ON CONFLICT (name) DO UPDATE SET' in sql
+    assert 'zp = excluded.zp' in sql
+
+
+def readRecords_reference(db):
+    """ readRecords as it was before the typed arrays: ORM objects, string arrays, astropy Time parsing. """
+    allrows = [[e.name, e.dateobs, e.site, e.dome, e.telescope, e.camera, e.filter, e.airmass, e.zp, e.colorterm,
+                e.zpsig] for e in db.session.query(PhotZPMeasurement).all()]
+    t = Table(np.asarray(allrows), names=['name', 'dateobs', 'site', 'dome', 'telescope', 'camera', 'filter',
+                                          'airmass', 'zp', 'colorterm', 'zpsig'])
+    # mixed date formats are parsed one by one
+    t['dateobs'] = [astt.Time(d, scale='utc', format=None).to_datetime() for d in t['dateobs'].astype(str)]
+    for name in ('zp', 'airmass', 'zpsig', 'colorterm'):
+        t[name] = t[name].astype(float)
+    dateselect = (t['dateobs'] < datetime.datetime(year=2017, month=11, day=17)) & (t['camera'] == 'fl06')
+    t['zp'][dateselect] = t['zp'][dateselect] - 2.5 * math.log10(1.82 / 2.45)
+    dateselect = (t['dateobs'] > datetime.datetime(year=2017, month=11, day=15)) & (
+            t['dateobs'] < datetime.datetime(year=2018, month=4, day=10)) & (t['camera'] == 'kb96')
+    t['zp'][dateselect] = t['zp'][dateselect] - 2.5 * math.log10(0.851 / 2.74)
+    return t
+
+
+def test_readrecordarrays(tmpdir):
+    db = photdbinterface(f"sqlite:///{tmpdir}/photzp.db")
+    rng = np.random.default_rng(1)
+    start = datetime.datetime(2017, 9, 1)
+    for ii in range(300):
+        dateobs = start + datetime.timedelta(days=float(rng.uniform(0, 365)))
+        camera = ['fl06', 'kb96', 'fa06'][ii % 3]
+        # dates as written by different versions of the pipeline
+        dateformat = '%Y-%m-%dT%H:%M:%S.%f' if ii % 2 else '%Y-%m-%d %H:%M:%S'
+        m = make_measurement(f"lsc1m005-{camera}-{dateobs:%Y%m%d}-{ii:04d}-e91.fits.fz", zp=float(rng.normal(23, 1)))
+        m.dateobs = dateobs.strftime(dateformat)
+        m.camera = camera
+        m.filter = ['rp', 'gp'][ii % 2]
+        m.airmass = None if ii % 7 == 0 else float(rng.uniform(1, 2))
+        db.session.add(m)
+    db.session.commit()
+
+    records = db.readRecordArrays(chunksize=64)
+    assert records['dateobs'].dtype == np.dtype('datetime64[us]')
+    assert records['site'].dtype == np.int32
+    assert set(records.categories['camera']) == {'fl06', 'kb96', 'fa06'}
+
+    t = db.readRecords()
+    reference = readRecords_reference(db)
+    assert t.colnames == reference.colnames
+    for name in ('name', 'site', 'dome', 'telescope', 'camera', 'filter', 'dateobs'):
+        assert list(t[name]) == list(reference[name])
+    for name in ('airmass', 'zp', 'colorterm', 'zpsig'):
+        assert np.array_equal(t[name], reference[name], equal_nan=True)
+
+    selected = db.readRecordArrays(camera='kb96', filter=['gp'])
+    assert len(selected) == 50
+    assert set(selected.decoded('filter')) == {'gp'}
+    assert db.readRecords(camera='kb96', filter=['ip']) is None
+    db.close()
@@ -0,0 +1,45 @@
+import numpy as np
+import longtermphotzp.atlasrefcat2 as refcat2
+from longtermphotzp.crossmatch import angular_separation
+from longtermphotzp.refcat2backends import write_refcat2_sqlite, REFCAT2_COLUMNS
+from longtermphotzp.syntheticframes import make_fixture_catalog
+
+
+def test_sqlite_backend(tmpdir):
+    fixture = make_fixture_catalog()
+    write_refcat2_sqlite(f"{tmpdir}/refcat2.db", fixture)
+
+    referencecatalog = refcat2.atlas_refcat2(f"sqlite:///{tmpdir}/refcat2.db")
+    for ra, dec in ((0.2, -10.), (359.9, -10.3)):
+        raw = referencecatalog.backend.query(ra, dec, 0.33)
+        expected = angular_separation(ra, dec, fixture['ra'], fixture['dec']) <= 0.33
+        assert len(raw) == np.sum(expected)
+        assert raw.colnames == list(REFCAT2_COLUMNS.values())
+        assert np.allclose(np.sort(raw['gmag']), np.sort(fixture['gmag'][expected].astype(np.float32)))
+
+    cat = referencecatalog.get_reference_catalog(0.2, -10., 0.33)
+    assert len(cat.columns) == 16
+
+
+def test_band_selective_transforms(tmpdir):
+    fixture = make_fixture_catalog()
+    write_refcat2_sqlite(f"{tmpdir}/refcat2.db", fixture)
+    referencecatalog = refcat2.atlas_refcat2(f"sqlite:///{tmpdir}/refcat2.db")
+    full = referencecatalog.get_reference_catalog(0.2, -10., 0.33, generateJohnson=True)
+
+    nqueries = 0
+    query = referencecatalog.backend.query
+
+    def countingquery(*args):
+        nonlocal nqueries
+        nqueries += 1
+        return query(*args)
+
+    referencecatalog.backend.query = countingquery
+    for band in set(mapping['refMag'] for mapping in refcat2.atlas_refcat2.FILTERMAPPING.values()):
+        cat = referencecatalog.get_reference_catalog(0.2, -10., 0.33, bands=[band])
+        assert set(cat.colnames) >= {'ra', 'dec', 'gmag', 'imag', band, f'{band}err'}
+        for column in ('gmag', 'imag', 'imagerr', band, f'{band}err'):
+            assert np.allclose(cat[column], full[column], atol=1e-5)
+    # All bands are served from one catalog query of the field.
+    assert nqueries == 1
@@ -0,0 +1,104 @@
+import os
+import numpy as np
+from astropy.table import Table
+from longtermphotzp.crossmatch import angular_separation
+from longtermphotzp.refcat2cache import TiledCatalogCache
+
+
+class FakeCatalog:
+    """ A random patch of sky standing in for the refcat2 service. """
+
+    def __init__(self, nstars=20000, seed=3):
+        rng = np.random.default_rng(seed)
+        ra = rng.uniform(-2, 2, nstars) % 360
+        dec = rng.uniform(-31, -29, nstars)
+        self.table = Table([ra.astype(np.float32), dec.astype(np.float32),
+                            rng.uniform(12, 20, nstars).astype(np.float32)], names=['ra', 'dec', 'gmag'])
+        self.nqueries = 0
+
+    def query(self, ra, dec, radius):
+        self.nqueries += 1
+        incone = angular_separation(ra, dec, self.table['ra'], self.table['dec']) <= radius
+        return self.table[incone]
+
+
+def test_tiled_cache(tmpdir):
+    catalog = FakeCatalog()
+    cache = TiledCatalogCache(str(tmpdir), catalog.query, tilesize=0.25)
+
+    for ra, dec in ((0.1, -30.), (359.8, -30.2), (0.15, -30.05)):
+        expected = catalog.query(ra, dec, 0.33)
+        result = cache.query(ra, dec, 0.33)
+        assert len(result) == len(expected)
+        assert set(result['gmag']) == set(expected['gmag'])
+
+    # The last cone is fully covered by tiles fetched for the first one.
+    assert catalog.nqueries == 3 + 2
+
+    # A second cache on the same directory, e.g., in another worker process, does not query again.
+    secondcache = TiledCatalogCache(str(tmpdir), catalog.query, tilesize=0.25)
+    secondcache.query(0.1, -30., 0.33)
+    assert catalog.nqueries == 3 + 2
+
+
+def test_cache_eviction(tmpdir):
+    catalog = FakeCatalog()
+    cache = TiledCatalogCache(str(tmpdir), catalog.query, tilesize=0.25, maxbytes=20000)
+    cache.query(0.1, -30., 0.33)
+    cache.query(359.5, -29.5, 0.33)
+
+    totalsize = sum(os.path.getsize(os.path.join(dirpath, f))
+                    for dirpath, dirnames, filenames in os.walk(str(tmpdir)) for f in filenames)
+    assert totalsize <= 20000
+
+
+def test_fetch_radius_close_to_query_radius(tmpdir):
+    radii = []
+
+    def fetch(ra, dec, radius):
+        radii.append(radius)
+        return Table([np.zeros(0), np.zeros(0)], names=['ra', 'dec'])
+
+    cache = TiledCatalogCache(str(tmpdir), fetch)
+    for ra, dec in ((150.1, -20.1), (150.24, 0.24), (83.8, -5.4), (10., -60.), (0.05, -30.), (200., 75.)):
+        radii.clear()
+        cache.query(ra, dec, 0.33)
+        assert len(radii) == 1
+        assert radii[0] <= 0.33 + np.sqrt(2) * cache.tilesize + 2e-3
+        assert radii[0] < 1.5 * 0.33
+
+
+def test_tiles_for_cone_complete(tmpdir):
+    cache = TiledCatalogCache(str(tmpdir), None, tilesize=0.25)
+    rng = np.random.default_rng(5)
+    for ra, dec in ((0.1, -30.), (120., 0.1), (240., 70.), (359.9, -80.), (45., 89.9)):
+        tiles = set(cache.tiles_for_cone(ra, dec, 0.33))
+        pointra = (ra + rng.uniform(-10, 10, 20000)) % 360
+        pointdec = np.clip(dec + rng.uniform(-0.4, 0.4, 20000), -90, 89.999)
+        incone = angular_separation(ra, dec, pointra, pointdec) <= 0.33
+        for pra, pdec in zip(pointra[incone], pointdec[incone]):
+            band = int((pdec + 90.) / cache.tilesize)
+            index = int(pra / (360. / cache.tiles_in_band(band)))
+            assert (band, index) in tiles
+
+
+def test_cache_eviction_scans(tmpdir, monkeypatch):
+    import longtermphotzp.refcat2cache as refcat2cache
+    nwalks = []
+    walk = os.walk
+    monkeypatch.setattr(refcat2cache.os, 'walk', lambda *args: nwalks.append(1) or walk(*args))
+
+    catalog = FakeCatalog()
+    cache = TiledCatalogCache(str(tmpdir), catalog.query, tilesize=0.25)
+    for ra in (0.1, 0.8, 359.2, 1.5):
+        cache.query(ra, -30., 0.33)
+    # the directory is scanned once; afterwards the size is tracked as tiles are written
+    assert len(nwalks) == 1
+    totalsize = sum(os.path.getsize(os.path.join(dirpath, f))
+                    for dirpath, dirnames, filenames in walk(str(tmpdir)) for f in filenames)
+    assert cache.estimatedsize == totalsize
+
+    cache.maxbytes = totalsize // 2
+    cache.query(-0.5, -29.5, 0.33)
+    assert len(nwalks) == 2
+    assert cache.estimatedsize <= cache.maxbytes
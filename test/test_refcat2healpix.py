@@ -0,0 +1,32 @@
+import numpy as np
+from longtermphotzp.crossmatch import angular_separation
+from longtermphotzp.refcat2backends import write_refcat2_sqlite, make_backend
+from longtermphotzp.refcat2healpix import write_healpix_store, sqlite_chunks, ang2pix_nest, cone_pixels
+from longtermphotzp.syntheticframes import make_fixture_catalog
+
+
+def test_cone_pixels():
+    # Every position within the cone has to fall into one of the cone's pixels.
+    rng = np.random.default_rng(5)
+    for ra, dec in ((10., 20.), (0., 89.9), (359.9, 0.), (180., -60.)):
+        pixels = cone_pixels(64, ra, dec, 0.5)
+        samplera = ra + rng.uniform(-30, 30, 100000)
+        sampledec = np.clip(dec + rng.uniform(-0.6, 0.6, 100000), -90, 90)
+        incone = angular_separation(ra, dec, samplera, sampledec) <= 0.5
+        assert np.all(np.isin(ang2pix_nest(64, samplera[incone], sampledec[incone]), pixels))
+
+
+def test_healpix_backend(tmpdir):
+    fixture = make_fixture_catalog()
+    write_refcat2_sqlite(f"{tmpdir}/refcat2.db", fixture)
+    write_healpix_store(sqlite_chunks(f"sqlite:///{tmpdir}/refcat2.db", chunksize=1000), f"{tmpdir}/healpix", nside=64)
+
+    sqlitebackend = make_backend(f"sqlite:///{tmpdir}/refcat2.db")
+    healpixbackend = make_backend(f"healpix:///{tmpdir}/healpix")
+    assert len(healpixbackend.rows) == len(fixture)
+    for ra, dec in ((0.2, -10.), (359.9, -10.3)):
+        expected = sqlitebackend.query(ra, dec, 0.33)
+        result = healpixbackend.query(ra, dec, 0.33)
+        assert result.colnames == expected.colnames
+        assert len(result) == len(expected)
+        assert np.all(np.sort(result['gmag']) == np.sort(expected['gmag']))
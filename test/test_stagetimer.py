@@ -0,0 +1,55 @@
+import json
+import time
+
+from longtermphotzp import stagetimer
+
+
+def test_stagetimer(tmpdir):
+    timer = stagetimer.configure(enabled=True, jsonlfile=f"{tmpdir}/timing.jsonl")
+    assert stagetimer.get_timer() is timer
+    for ii in range(4):
+        timer.start_frame()
+        timer.annotate(image=f"frame{ii}", nsources=100 + ii)
+        time.sleep(0.01)
+        timer.lap('load')
+        timer.lap('fit')
+        timer.end_frame()
+    summary = timer.summary()
+    assert set(summary) == {'load', 'fit', 'total'}
+    assert summary['load']['n'] == 4
+    assert 0.01 <= summary['load']['p50'] <= summary['load']['max'] <= summary['total']['max']
+    stagetimer.configure(enabled=False)
+
+    with open(f"{tmpdir}/timing.jsonl") as f:
+        records = [json.loads(line) for line in f]
+    assert [record['image'] for record in records] == ['frame0', 'frame1', 'frame2', 'frame3']
+    assert records[3]['nsources'] == 103
+
+
+def test_stagetimer_events():
+    timer = stagetimer.configure(enabled=True)
+    timer.start_frame()
+    time.sleep(0.01)
+    # e.g. a database batch written while the frame's result is handed over
+    start = time.perf_counter()
+    time.sleep(0.1)
+    timer.event('db-flush', time.perf_counter() - start, nrows=200)
+    timer.lap('db-queue')
+    timer.end_frame()
+    timer.event('db-flush', 1., nrows=10)
+    summary = timer.summary()
+    stagetimer.configure(enabled=False)
+    assert summary['db-flush']['n'] == 2
+    assert summary['db-flush']['sum'] >= 1.1
+    assert summary['total']['n'] == 1
+    # event time is not booked to the lap of the open frame, but is part of the frame's wall clock total
+    assert 0.01 <= summary['db-queue']['max'] < 0.1 <= summary['total']['max']
+
+
+def test_nullstagetimer():
+    timer = stagetimer.configure(enabled=False)
+    timer.start_frame()
+    timer.lap('load')
+    timer.end_frame()
+    timer.event('db-flush', 1.)
+    assert timer.take_records() == []
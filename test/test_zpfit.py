@@ -0,0 +1,49 @@
+import numpy as np
+from longtermphotzp.zpfit import robust_colorfit, robust_colorfit_batch
+
+
+def reference_robustfit(deltamag, refcol):
+    """ The polyfit based implementation the closed-form fit has to reproduce. """
+    cond = (refcol > -0.5) & (refcol < 2.0) & (np.abs((deltamag - np.median(deltamag))) < 5 * np.std(deltamag))
+    colorparams = np.polyfit(refcol[cond], deltamag[cond], 1)
+    for iteration in range(2):
+        delta = deltamag - np.poly1d(colorparams)(refcol)
+        cond = (refcol > -0.5) & (refcol < 3) & (np.abs(delta) < 0.5) & (np.abs(delta) < 1 * np.std(delta))
+        colorparams = np.polyfit(refcol[cond], deltamag[cond], 1)
+    return colorparams, cond
+
+
+def make_matched_stars(rng, nstars, zp=23.1, colorterm=0.05):
+    refcol = rng.uniform(-1, 3.5, nstars)
+    deltamag = zp + colorterm * refcol + rng.normal(0, 0.03, nstars)
+    outliers = rng.random(nstars) < 0.1
+    deltamag[outliers] += rng.normal(0, 1, np.sum(outliers))
+    return deltamag, refcol
+
+
+def test_robust_colorfit():
+    rng = np.random.default_rng(17)
+    deltamag, refcol = make_matched_stars(rng, 500)
+    fit, cond = robust_colorfit(deltamag, refcol)
+    colorparams, referencecond = reference_robustfit(deltamag, refcol)
+    assert np.array_equal(cond, referencecond)
+    assert np.isclose(fit['colorterm'], colorparams[0], rtol=0, atol=1e-10)
+    assert np.isclose(fit['zp'], colorparams[1], rtol=0, atol=1e-10)
+    assert fit['n'] == np.sum(cond)
+    clean = deltamag[np.abs(deltamag - np.median(deltamag)) < 3 * np.std(deltamag)]
+    assert np.isclose(fit['zpsig'], np.std(clean))
+
+
+def test_robust_colorfit_batch():
+    rng = np.random.default_rng(5)
+    images = [make_matched_stars(rng, n, zp=20 + ii) for ii, n in enumerate((40, 1000, 300, 1))]
+    offsets = np.concatenate([[0], np.cumsum([len(image[0]) for image in images])])
+    fit, cond = robust_colorfit_batch(np.concatenate([image[0] for image in images]),
+                                      np.concatenate([image[1] for image in images]), offsets)
+    for ii, (deltamag, refcol) in enumerate(images[:-1]):
+        single, singlecond = robust_colorfit(deltamag, refcol)
+        assert np.array_equal(cond[offsets[ii]:offsets[ii + 1]], singlecond)
+        assert np.isclose(fit['zp'][ii], single['zp'], rtol=0, atol=1e-10)
+        assert np.isclose(fit['zp'][ii], 20 + ii, atol=0.01)
+    # a single star can not constrain a color term.
+    assert np.isnan(fit['zp'][-1])